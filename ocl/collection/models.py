@@ -11,7 +11,8 @@ from oclapi.settings.common import Common
 from collection.validation_messages import REFERENCE_ALREADY_EXISTS, CONCEPT_FULLY_SPECIFIED_NAME_UNIQUE_PER_COLLECTION_AND_LOCALE, \
     CONCEPT_PREFERRED_NAME_UNIQUE_PER_COLLECTION_AND_LOCALE
 from oclapi.models import ConceptContainerModel, ConceptContainerVersionModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, CUSTOM_VALIDATION_SCHEMA_OPENMRS
-from oclapi.utils import reverse_resource, S3ConnectionFactory, get_class, compact
+from oclapi.utils import reverse_resource, get_class, compact, iterate_by_id
+from oclapi.exports import ExportStorageFactory, EXPORT_FORMAT_JSON, EXPORT_FORMAT_NDJSON
 from concepts.models import Concept, ConceptVersion
 from mappings.models import Mapping, MappingVersion
 from django.db.models import Max
@@ -408,6 +409,16 @@ class CollectionVersion(ConceptContainerVersionModel):
         """
         return self.__get_mapping_ids().count()
 
+    def get_export_concept_id_batches(self, batch_size):
+        """ Yields the ids of the concept versions of this collection version in the order they were added """
+        for batch in iterate_by_id(CollectionConcept.objects.filter(collection_id=self.id), batch_size):
+            yield [membership.concept_id for membership in batch]
+
+    def get_export_mapping_id_batches(self, batch_size):
+        """ Yields the ids of the mapping versions of this collection version in the order they were added """
+        for batch in iterate_by_id(CollectionMapping.objects.filter(collection_id=self.id), batch_size):
+            yield [membership.mapping_id for membership in batch]
+
     def fill_data_for_reference(self, a_reference):
         if a_reference.concepts:
             for concept in a_reference.concepts:
@@ -437,12 +448,20 @@ class CollectionVersion(ConceptContainerVersionModel):
         if seed_references_from:
             self.references = list(seed_references_from.references)
 
-    def get_export_key(self):
-        bucket = S3ConnectionFactory.get_export_bucket()
-        return bucket.get_key(self.export_path)
+    def has_export(self, export_format=EXPORT_FORMAT_JSON):
+        return ExportStorageFactory.get_export_storage().exists(self.get_export_path(export_format))
+
+    def get_export_path(self, export_format=EXPORT_FORMAT_JSON):
+        if export_format == EXPORT_FORMAT_NDJSON:
+            return '%s.ndjson.gz' % self.export_path[:-len('.zip')]
+        return self.export_path
 
-    def has_export(self):
-        return bool(self.get_export_key())
+    def has_export_manifest(self):
+        return ExportStorageFactory.get_export_storage().exists(self.export_manifest_path)
+
+    @property
+    def export_manifest_path(self):
+        return '%s.manifest.json' % self.export_path[:-len('.zip')]
 
     @property
     def export_path(self):
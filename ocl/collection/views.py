@@ -24,8 +24,9 @@ from oclapi.permissions import CanViewConceptDictionary, CanEditConceptDictionar
 from oclapi.permissions import HasAccessToVersionedObject
 from oclapi.views import ResourceVersionMixin, ResourceAttributeChildMixin, ConceptDictionaryUpdateMixin, \
     ConceptDictionaryCreateMixin, ConceptDictionaryExtrasView, ConceptDictionaryExtraRetrieveUpdateDestroyView, \
-    BaseAPIView
+    BaseAPIView, ExportManifestMixin, parse_export_format_param, get_export_download_response
 from oclapi.models import ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, ACCESS_TYPE_NONE
+from oclapi.exports import EXPORT_FORMAT_JSON, ExportStorageFactory
 from rest_framework import mixins, status
 from rest_framework.generics import RetrieveAPIView, UpdateAPIView, get_object_or_404, DestroyAPIView
 from rest_framework.response import Response
@@ -286,6 +287,7 @@ class CollectionListView(CollectionBaseView,
                          ListWithHeadersMixin):
     serializer_class = CollectionCreateSerializer
     filter_backends = [CollectionSearchFilter]
+    csv_format = 'collections'
     contains_uri = None
     user = None
     solr_fields = {
@@ -577,25 +579,20 @@ class CollectionVersionExportView(ResourceAttributeChildMixin):
 
     def get(self, request, *args, **kwargs):
         version = self.get_object()
-        logger.debug('Export requested for collection version %s - Requesting AWS-S3 key' % version)
+        logger.debug('Export requested for collection version %s - Looking up export' % version)
 
         if version.mnemonic == 'HEAD':
             return HttpResponse(status=405)
 
-        key = version.get_export_key()
-        url, status = None, 204
+        export_format = parse_export_format_param(request)
 
-        if key:
-            logger.debug('   Key retreived for collection version %s - Generating URL' % version)
-            url, status = key.generate_url(60), 303
-            logger.debug('   URL retreived for collection version %s - Responding to client' % version)
+        if version.has_export(export_format):
+            logger.debug('   Export exists for collection version %s - Responding to client' % version)
+            response = get_export_download_response(version.get_export_path(export_format))
         else:
-            logger.debug('   Key does not exist for collection version %s' % version)
+            logger.debug('   Export does not exist for collection version %s' % version)
             return HttpResponse(status=204)
 
-        response = HttpResponse(status=status)
-        response['Location'] = url
-
         # Set headers to ensure sure response is not cached by a client
         response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
         response['Pragma'] = 'no-cache'
@@ -632,11 +629,14 @@ class CollectionVersionExportView(ResourceAttributeChildMixin):
             return HttpResponse(status=405)  # export of head version is not allowed
 
         status = 303
-        if not version.has_export():
-            status = self.handle_export_collection_version()
+        export_format = parse_export_format_param(request)
+        if not version.has_export(export_format):
+            status = self.handle_export_collection_version(export_format)
         else:
             response = HttpResponse(status=status)
             response['URL'] = self.resource_version_path_info + 'export/'
+            if export_format != EXPORT_FORMAT_JSON:
+                response['URL'] += '?format=' + export_format
             return response
 
         return HttpResponse(status=status)
@@ -652,18 +652,25 @@ class CollectionVersionExportView(ResourceAttributeChildMixin):
 
         if not permitted:
             return HttpResponseForbidden()
-        if version.has_export():
-            key = version.get_export_key()
-            if key:
-                key.delete()
-                return HttpResponse(status=200)
+        export_format = parse_export_format_param(request)
+        if version.has_export(export_format):
+            storage = ExportStorageFactory.get_export_storage()
+            storage.delete(version.get_export_path(export_format))
+            # The chunks may be shared with other versions, only the manifest goes
+            if export_format == EXPORT_FORMAT_JSON and version.has_export_manifest():
+                storage.delete(version.export_manifest_path)
+            return HttpResponse(status=200)
 
         return HttpResponse(status=204)
 
-    def handle_export_collection_version(self):
+    def handle_export_collection_version(self, export_format=EXPORT_FORMAT_JSON):
         version = self.get_object()
         try:
-            export_collection.delay(version.id)
+            export_collection.delay(version.id, export_format)
             return 202
         except AlreadyQueued:
             return 409
+
+
+class CollectionVersionExportManifestView(ExportManifestMixin, CollectionVersionExportView):
+    pass
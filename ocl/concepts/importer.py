@@ -10,15 +10,23 @@ from django.core.management import CommandError
 from concepts.models import Concept, ConceptVersion
 from concepts.serializers import ConceptDetailSerializer, ConceptVersionUpdateSerializer
 from oclapi.management.commands import MockRequest, ImportActionHelper
+from oclapi.management.import_checkpoints import ImportCheckpointer
+from oclapi.utils import SavedIdsRecorder, update_ids_in_index
 from sources.models import SourceVersion
 
-from haystack.management.commands import update_index
 import haystack
 from datetime import datetime
 
 __author__ = 'misternando,paynejd'
 logger = logging.getLogger('batch')
 
+# Number of concept ids per query when loading the latest concept versions of a source
+SNAPSHOT_QUERY_SIZE = 5000
+# Number of concept versions deactivated per update when deactivating old records
+DEACTIVATION_QUERY_SIZE = 10000
+# Number of processes pushing the concept versions touched by an import to the search index
+INDEX_WORKERS = 4
+
 
 class IllegalInputException(Exception):
     """ Exception for invalid JSON read from input file """
@@ -70,6 +78,9 @@ class ConceptsImporter(object):
         self.source_version = SourceVersion.get_head_of(self.source)
         self.validation_logger = validation_logger
         self.save_validation_errors = save_validation_errors
+        self.checkpointer = None
+        # Concept versions created or changed by the import, the only ones to index afterwards
+        self.touched_versions = SavedIdsRecorder(ConceptVersion)
 
         if self.save_validation_errors and self.validation_logger is None:
             self.validation_logger = ValidationLogger()
@@ -86,39 +97,103 @@ class ConceptsImporter(object):
         if flush:
             self.stderr.flush()
 
-    def import_concepts(self, new_version=False, total=0, test_mode=False, deactivate_old_records=False, **kwargs):
+    def import_concepts(self, new_version=False, total=0, test_mode=False, deactivate_old_records=False, batch_size=None,
+                        skip_index=False, file_hash=None, resume=False, **kwargs):
         initial_signal_processor = haystack.signal_processor
         try:
             haystack.signal_processor.teardown()
             haystack.signal_processor = haystack.signals.BaseSignalProcessor
+            self.touched_versions.start()
             import_start_time = datetime.now()
             self.info('Started import at {}'.format(import_start_time.strftime("%Y-%m-%dT%H:%M:%S")))
 
             self.action_count = {}
             self.test_mode = test_mode
+            self.batch_size = batch_size or 0
             self.info('Import concepts to source...')
-            self.handle_new_source_version(new_version)
+            if file_hash and not test_mode:
+                self.checkpointer = ImportCheckpointer('concepts', self.source, file_hash)
+            checkpoint = self.checkpointer.load() if self.checkpointer and resume else None
+
+            if checkpoint:
+                self.resume_from_checkpoint(checkpoint)
+            else:
+                self.handle_new_source_version(new_version)
+                self.concept_version_ids = set(self.source_version.get_concept_ids())
+                if self.checkpointer:
+                    self.checkpointer.start(self.source_version, self.concept_version_ids, import_start_time)
 
             # Load the JSON file line by line and import each line
             self.user = User.objects.filter(is_superuser=True)[0]
-            self.concept_version_ids = set(self.source_version.get_concept_ids())
+            # A partition worker only diffs the concepts of its own part of the input
+            self.load_concept_snapshot(self.read_input_mnemonics() if kwargs.get('worker_summary_file') else None)
 
-            lines_handled = self.handle_lines_in_input_file(total)
+            self.lines_handled = self.handle_lines_in_input_file(total, checkpoint)
             self.output_unhandled_concept_version_ids()
             self.handle_deactivation__of_old_records(deactivate_old_records)  # Display final summary
-            self.output_summary(lines_handled, total)
+            self.output_summary(self.lines_handled, total)
+            if self.checkpointer:
+                self.checkpointer.finish()
 
-            actions = self.action_count
-            update_index_required = actions.get(ImportActionHelper.IMPORT_ACTION_ADD, 0) > 0
-            update_index_required |= actions.get(ImportActionHelper.IMPORT_ACTION_UPDATE, 0) > 0
+            if not skip_index:
+                self.update_index_if_required()
+        finally:
+            self.touched_versions.stop()
+            haystack.signal_processor = initial_signal_processor
+            haystack.signal_processor.setup()
 
-            if update_index_required:
-                self.info('Indexing objects updated since {}'.format(import_start_time.strftime("%Y-%m-%dT%H:%M:%S")))
-                update_index.Command().handle(start_date=import_start_time.strftime("%Y-%m-%dT%H:%M:%S"), verbosity=2, workers=4, batchsize=100)
+    def resume_from_checkpoint(self, checkpoint):
+        self.source_version = SourceVersion.objects.get(id=checkpoint.source_version_id)
+        self.concept_version_ids = self.checkpointer.resume(checkpoint)
+        # Versions changed by the failed run have to be indexed as well, they are already part of the checkpoint
+        self.touched_versions.add(self.checkpointer.touched_ids)
+        self.touched_versions.pop_recent_ids()
+        self.action_count = checkpoint.get_action_count()
+        self.concepts_file.seek(checkpoint.offset)
+        self.info('Resuming import after line %s of the previous run...\n' % checkpoint.lines_handled)
+
+    def get_import_summary(self):
+        """ Returns what a partition worker reports back to the process that merges the import """
+        return {
+            'lines_handled': self.lines_handled,
+            'action_count': self.action_count,
+            'unhandled_ids': list(self.concept_version_ids),
+            'touched_ids': list(self.touched_versions.ids),
+        }
+
+    def finish_partitioned_import(self, lines_handled, total, action_count, unhandled_ids, touched_ids,
+                                  test_mode=False, deactivate_old_records=False):
+        """
+        Completes an import whose partitions were imported by separate worker processes: deactivates the concept
+        versions that no worker handled, displays the merged summary and indexes the versions touched by the
+        workers and the deactivation once.
+        """
+        initial_signal_processor = haystack.signal_processor
+        try:
+            haystack.signal_processor.teardown()
+            haystack.signal_processor = haystack.signals.BaseSignalProcessor
+            self.touched_versions.start()
+            self.touched_versions.add(touched_ids)
+
+            self.action_count = action_count
+            self.test_mode = test_mode
+            self.user = User.objects.filter(is_superuser=True)[0]
+            self.concept_version_ids = unhandled_ids
+            self.output_unhandled_concept_version_ids()
+            self.handle_deactivation__of_old_records(deactivate_old_records)
+            self.output_summary(lines_handled, total)
+            self.update_index_if_required()
         finally:
+            self.touched_versions.stop()
             haystack.signal_processor = initial_signal_processor
             haystack.signal_processor.setup()
 
+    def update_index_if_required(self):
+        touched_ids = self.touched_versions.ids
+        if touched_ids:
+            self.info('Indexing %s created or changed concept versions' % len(touched_ids))
+            update_ids_in_index(ConceptVersion, touched_ids, workers=INDEX_WORKERS)
+
     def output_unhandled_concept_version_ids(self):
         # Log remaining unhandled IDs
         self.info('Remaining %s unhandled concept versions' % len(self.concept_version_ids))
@@ -146,24 +221,29 @@ class ConceptsImporter(object):
 
         self.info('Deactivating old concepts...\n')
 
-        for version_id in self.concept_version_ids:
-            try:
-                self.remove_concept_version(version_id)
-                self.count_action(ImportActionHelper.IMPORT_ACTION_DEACTIVATE)
-
-                # Log the mapping deactivation
-                self.info('Deactivated concept version: %s\n' % version_id)
+        version_ids = list(self.concept_version_ids)
+        for start in range(0, len(version_ids), DEACTIVATION_QUERY_SIZE):
+            self.deactivate_concept_versions(version_ids[start:start + DEACTIVATION_QUERY_SIZE])
 
-            except InvalidStateException as exc:
-                self.error('Failed to inactivate concept version on ID %s! %s\n' % (version_id, exc.args[0]))
-
-    def handle_lines_in_input_file(self, total):
-        lines_handled = 0
+    def handle_lines_in_input_file(self, total, checkpoint=None):
+        lines_handled = checkpoint.lines_handled if checkpoint else 0
+        offset = checkpoint.offset if checkpoint else 0
+        batch = []
         for line in self.concepts_file:
             # Load the next JSON line
             lines_handled += 1
+            offset += len(line)
             data = self.json_to_concept(line)  # Process the import for the current JSON line
-            self.try_import_concept(data)
+            if self.batch_size > 1:
+                if data:
+                    batch.append(data)
+                if len(batch) >= self.batch_size:
+                    self.import_concept_batch(batch)
+                    batch = []
+                    self.save_checkpoint(offset, lines_handled)
+            else:
+                self.try_import_concept(data)
+                self.save_checkpoint(offset, lines_handled)
 
             # Simple progress bar
             if (lines_handled % 100) == 0:
@@ -174,6 +254,10 @@ class ConceptsImporter(object):
                 if (lines_handled % 1000) == 0:
                     logger.info(log)
 
+        if batch:
+            self.import_concept_batch(batch)
+        self.save_checkpoint(offset, lines_handled, force=True)
+
         # Done with the input file, so close it
         self.concepts_file.close()
         if self.validation_logger:
@@ -190,21 +274,106 @@ class ConceptsImporter(object):
         try:
             update_action = self.handle_concept(self.source, data)
             self.count_action(update_action)
-        except IllegalInputException as exc:
+        except Exception as exc:
+            self.handle_import_error(data, exc)
+
+    def handle_import_error(self, data, exc):
+        """ Reports a line that could not be imported and counts it as skipped """
+        if isinstance(exc, IllegalInputException):
             exc_message = unicode('%s\nFailed to parse line: %s. Skipping it...\n' % (exc.args[0], data))
-            self.handle_exception(exc_message)
-        except InvalidStateException as exc:
+        elif isinstance(exc, InvalidStateException):
             exc_message = unicode('Source is in an invalid state!\n%s\n%s\n' % (exc.args[0], data))
-            self.handle_exception(exc_message)
-        except ValidationError as exc:
+        elif isinstance(exc, ValidationError):
             if self.save_validation_errors:
                 self.validation_logger.append_concept(data, exc.messages)
 
             exc_message = unicode('%s\nValidation failed: %s. Skipping it...\n' % (''.join(exc.messages), data))
-            self.handle_exception(exc_message)
-        except Exception as exc:
+        else:
             exc_message = unicode('%s\nSomething unexpected occured: %s. Skipping it...\n' % (exc, data))
-            self.handle_exception(exc_message)
+        self.handle_exception(exc_message)
+
+    def import_concept_batch(self, batch):
+        """
+        Imports a block of parsed lines. Concepts that already exist are handled line by line, while new concepts
+        are validated in memory and inserted together with their initial versions using bulk writes.
+        """
+        mnemonics = [unicode(data['id']) for data in batch if data.get('id')]
+        existing_mnemonics = set(Concept.objects.filter(
+            parent_id=self.source.id, mnemonic__in=mnemonics).values_list('mnemonic', flat=True))
+
+        pending = []
+        pending_mnemonics = set()
+        pending_names = set()
+        for data in batch:
+            mnemonic = unicode(data['id']) if data.get('id') else None
+            if mnemonic in pending_mnemonics:
+                # A repeated mnemonic updates the concept, so the pending block has to be persisted first
+                self.insert_new_concepts(pending)
+                existing_mnemonics.update(pending_mnemonics)
+                pending, pending_mnemonics, pending_names = [], set(), set()
+
+            if not mnemonic or mnemonic in existing_mnemonics:
+                self.try_import_concept(data)
+                continue
+
+            try:
+                concept = self.build_new_concept(self.source, data)
+                names = set((name.name, name.locale) for name in concept.names or [])
+                if self.source.custom_validation_schema and names & pending_names:
+                    # Name uniqueness is validated against the database, so persist the pending block and validate again
+                    self.insert_new_concepts(pending)
+                    existing_mnemonics.update(pending_mnemonics)
+                    pending, pending_mnemonics, pending_names = [], set(), set()
+                    concept = self.build_new_concept(self.source, data)
+            except Exception as exc:
+                self.handle_import_error(data, exc)
+                continue
+
+            pending.append((data, concept))
+            pending_mnemonics.add(mnemonic)
+            pending_names.update(names)
+
+        self.insert_new_concepts(pending)
+
+    def build_new_concept(self, source, data):
+        """ Builds and validates a new concept without saving it -- NOTE: data['id'] is the concept mnemonic """
+        serializer = ConceptDetailSerializer(data=data, context={'request': MockRequest(self.user)})
+        if not serializer.is_valid():
+            raise IllegalInputException('Could not parse new concept %s' % data['id'])
+        concept = serializer.object
+        concept.created_by = self.user
+        concept.updated_by = self.user
+        concept.parent = source
+        concept.public_access = source.public_access
+        # Uniqueness of the mnemonic within the source has been checked for the whole batch
+        concept.clean_fields()
+        concept.clean()
+        return concept
+
+    def insert_new_concepts(self, pending):
+        """ Persists a block of validated (data, concept) pairs with bulk writes """
+        if not pending:
+            return
+        if not self.test_mode:
+            try:
+                initial_versions = Concept.persist_new_in_bulk(
+                    [concept for (_, concept) in pending], SourceVersion.get_head_of(self.source))
+            except Exception as exc:
+                for (data, _) in pending:
+                    self.handle_import_error(data, exc)
+                return
+            # Bulk writes do not send post_save
+            self.touched_versions.add([version.id for version in initial_versions])
+
+        for (data, concept) in pending:
+            self.count_action(ImportActionHelper.IMPORT_ACTION_ADD)
+            self.info('Created new concept: %s = %s\n' % (concept.mnemonic, concept.concept_class))
+
+    def save_checkpoint(self, offset, lines_handled, force=False):
+        touched_ids = self.touched_versions.pop_recent_ids()
+        if self.checkpointer:
+            self.checkpointer.add_touched_ids(touched_ids)
+            self.checkpointer.save(offset, lines_handled, self.action_count, force=force)
 
     def json_to_concept(self, line):
         data = None
@@ -231,6 +400,49 @@ class ConceptsImporter(object):
 
         self.source_version = new_source_version
 
+    def read_input_mnemonics(self):
+        """ Returns the mnemonics of the concepts in the rest of the input file, leaving its position unchanged """
+        position = self.concepts_file.tell()
+        input_mnemonics = set()
+        for line in self.concepts_file:
+            try:
+                mnemonic = json.loads(line).get('id')
+            except (ValueError, AttributeError):
+                continue
+            if mnemonic:
+                input_mnemonics.add(unicode(mnemonic))
+        self.concepts_file.seek(position)
+        return input_mnemonics
+
+    def load_concept_snapshot(self, input_mnemonics=None):
+        """ Loads the id and latest version of the concepts of the source, or only of those with input_mnemonics """
+        self.concept_snapshot = {}
+        concepts = Concept.objects.filter(parent_id=self.source.id).values_list('id', 'mnemonic')
+        if input_mnemonics is None:
+            mnemonics = dict(concepts)
+        else:
+            input_mnemonics = list(input_mnemonics)
+            mnemonics = {}
+            for start in range(0, len(input_mnemonics), SNAPSHOT_QUERY_SIZE):
+                mnemonics.update(concepts.filter(mnemonic__in=input_mnemonics[start:start + SNAPSHOT_QUERY_SIZE]))
+        concept_ids = mnemonics.keys()
+        for start in range(0, len(concept_ids), SNAPSHOT_QUERY_SIZE):
+            versions = ConceptVersion.objects.filter(
+                versioned_object_id__in=concept_ids[start:start + SNAPSHOT_QUERY_SIZE], is_latest_version=True)
+            for version in versions:
+                self.concept_snapshot[mnemonics[version.versioned_object_id]] = (version.versioned_object_id, version)
+        self.info('Loaded %s existing concepts of source %s\n' % (len(self.concept_snapshot), self.source.mnemonic))
+
+    def get_existing_concept(self, source, mnemonic):
+        """ Returns (concept id, latest concept version), raising DoesNotExist if the concept or version is missing """
+        # Entries are removed once used, later lines for the same mnemonic read the versions they created
+        snapshot_entry = self.concept_snapshot.pop(unicode(mnemonic), None)
+        if snapshot_entry:
+            return snapshot_entry
+
+        concept = Concept.objects.get(parent_id=source.id, mnemonic=mnemonic)
+        return concept.id, ConceptVersion.objects.get(versioned_object_id=concept.id, is_latest_version=True)
+
     def handle_concept(self, source, data):
         """ Adds, updates, retires/unretires a single concept, or skips if no diff """
         update_action = retire_action = ImportActionHelper.IMPORT_ACTION_NONE
@@ -242,15 +454,25 @@ class ConceptsImporter(object):
         concept_name = data['concept_class']
         # If concept exists, update the concept with the new data (ignoring retired status for now)
         try:
-            concept = Concept.objects.get(parent_id=source.id, mnemonic=mnemonic)
-            concept_version = ConceptVersion.objects.get(versioned_object_id=concept.id, is_latest_version=True)
+            concept_id, concept_version = self.get_existing_concept(source, mnemonic)
             update_action = self.update_concept_version(concept_version, data)
 
             # Remove ID from the concept version list so that we know concept has been handled
-            if concept_version.id not in self.concept_version_ids:
+            handled_id = concept_version.id
+            replayed_ids = []
+            if handled_id not in self.concept_version_ids and self.checkpointer:
+                # A resumed import finds the versions created by the failed run after its last checkpoint
+                replayed_ids, handled_id = self.checkpointer.find_replayed_versions(
+                    concept_version, self.concept_version_ids)
+                self.touched_versions.add(replayed_ids)
+            if handled_id in self.concept_version_ids:
+                self.concept_version_ids.remove(handled_id)
+                if replayed_ids:
+                    self.touched_versions.add([handled_id])
+                if self.checkpointer:
+                    self.checkpointer.add_handled_id(handled_id)
+            elif not replayed_ids:
                 self.error('Key not found. Could not remove key %s from list of concept version IDs: %s\n' % (concept_version.id, data))
-            else:
-                self.concept_version_ids.remove(concept_version.id)
 
             # Log the update
             if update_action is ImportActionHelper.IMPORT_ACTION_UPDATE:
@@ -265,17 +487,21 @@ class ConceptsImporter(object):
                 self.info('Created new concept: %s = %s\n' % (mnemonic, concept_name))
 
             # Reload the concept so that the retire/unretire step will work
-            concept = Concept.objects.get(parent_id=source.id, mnemonic=mnemonic)
+            concept_id = Concept.objects.get(parent_id=source.id, mnemonic=mnemonic).id
+            concept_version = None
 
         # Concept exists, but not in this source version
         except (ConceptVersion.DoesNotExist, KeyError):
             raise InvalidStateException(
                 "Source %s has concept %s, but source version %s does not." %
-                (source.mnemonic, concept.mnemonic, self.source_version.mnemonic))
+                (source.mnemonic, mnemonic, self.source_version.mnemonic))
 
         # Handle retired status - if different, will create an additional concept version
         if 'retired' in data:
-            retire_action = self.update_concept_retired_status(concept, data['retired'])
+            # Without an update the version used for the diff is still the latest one
+            if update_action != ImportActionHelper.IMPORT_ACTION_NONE:
+                concept_version = None
+            retire_action = self.update_concept_retired_status(concept_id, data['retired'], concept_version)
             if retire_action == ImportActionHelper.IMPORT_ACTION_RETIRE:
                 str_log = 'Retired concept: %s = %s\n' % (mnemonic, concept_name)
                 self.stdout.write(str_log)
@@ -303,6 +529,10 @@ class ConceptsImporter(object):
     def update_concept_version(self, concept_version, data):
         """ Updates the concept, or skips if no diff. Ignores retired status. """
 
+        # Unchanged concepts are skipped without building a serializer
+        if concept_version.content_hash and concept_version.content_hash == ConceptVersion.get_payload_content_hash(data):
+            return ImportActionHelper.IMPORT_ACTION_NONE
+
         # Generate the diff
         clone = concept_version.clone()
         serializer = ConceptVersionUpdateSerializer(
@@ -329,14 +559,17 @@ class ConceptsImporter(object):
         # No diff, so do nothing
         return ImportActionHelper.IMPORT_ACTION_NONE
 
-    def update_concept_retired_status(self, concept, new_retired_state):
+    def update_concept_retired_status(self, concept_id, new_retired_state, concept_version=None):
         """ Updates and persists a new retired status for a concept """
 
         # Do nothing if retired status is unchanged
-        concept_version = ConceptVersion.get_latest_version_of(concept)
+        if concept_version is None:
+            concept_version = ConceptVersion.get_latest_version_by_id(concept_id)
         if concept_version.retired == new_retired_state:
             return ImportActionHelper.IMPORT_ACTION_NONE
 
+        concept = Concept.objects.get(id=concept_id)
+
         # Retire/un-retire the concept
         if new_retired_state:
             if not self.test_mode:
@@ -351,23 +584,24 @@ class ConceptsImporter(object):
                     raise IllegalInputException('Failed to un-retire concept due to %s' % errors)
             return ImportActionHelper.IMPORT_ACTION_UNRETIRE
 
-    def remove_concept_version(self, version_id):
-        """ Deactivates a concept """
-        version_query = ConceptVersion.objects.filter(id=version_id)
-
-        if version_query.count() is 0:
-            raise InvalidStateException(
-                "Cannot deactivate concept version %s because it doesn't exist!" % version_id)
-
-        version = version_query.get()
-        if not version.is_active:
-            return ImportActionHelper.IMPORT_ACTION_NONE
-
-        if not self.test_mode:
-            version.is_active = False
-            version.save()
-
-        return ImportActionHelper.IMPORT_ACTION_DEACTIVATE
+    def deactivate_concept_versions(self, version_ids):
+        """
+        Deactivates a block of concept versions with a single update and reports the result for each id. The update
+        does not send post_save, so the deactivated versions are recorded for the index update explicitly.
+        """
+        is_active = dict(ConceptVersion.objects.filter(id__in=version_ids).values_list('id', 'is_active'))
+        active_ids = [version_id for version_id in version_ids if is_active.get(version_id)]
+        if active_ids and not self.test_mode:
+            ConceptVersion.objects.filter(id__in=active_ids).update(is_active=False, updated_at=datetime.now())
+            self.touched_versions.add(active_ids)
+
+        for version_id in version_ids:
+            if version_id not in is_active:
+                self.error('Failed to inactivate concept version on ID %s! '
+                           'Cannot deactivate concept version %s because it doesn\'t exist!\n' % (version_id, version_id))
+                continue
+            self.count_action(ImportActionHelper.IMPORT_ACTION_DEACTIVATE)
+            self.info('Deactivated concept version: %s\n' % version_id)
 
     def count_action(self, update_action):
         """ Increments the counter for the specified action """
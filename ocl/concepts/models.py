@@ -1,3 +1,6 @@
+import copy
+
+from bson import ObjectId
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
@@ -7,16 +10,23 @@ from django.db import models
 from django.db.models import Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils.encoding import smart_text
 from django_mongodb_engine.contrib import MongoDBManager
 from djangotoolbox.fields import SetField, ListField, EmbeddedModelField
 from uuidfield import UUIDField
 
 from concepts.mixins import DictionaryItemMixin, ConceptValidationMixin
-from oclapi.models import (ConceptBaseModel, ResourceVersionModel,
+from oclapi.models import (ConceptBaseModel, ResourceVersionModel, stamp_uri,
                            VERSION_TYPE, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW)
+from oclapi.utils import compute_content_hash
 from sources.models import SourceVersion, Source
 
 
+def text_fingerprint(value):
+    """ Text as it is stored by a TextField """
+    return None if value is None else smart_text(value)
+
+
 class LocalizedText(models.Model):
     uuid = UUIDField(auto=True)
     external_id = models.TextField(null=True, blank=True)
@@ -35,6 +45,36 @@ class LocalizedText(models.Model):
             locale_preferred=self.locale_preferred
         )
 
+    def get_fingerprint(self):
+        return LocalizedText.fingerprint(self.external_id, self.name, self.type, self.locale, self.locale_preferred)
+
+    @staticmethod
+    def fingerprint(external_id, name, type, locale, locale_preferred):
+        """ Canonical list used when hashing the content of a version """
+        return [text_fingerprint(external_id), text_fingerprint(name), text_fingerprint(type),
+                text_fingerprint(locale), bool(locale_preferred)]
+
+    @staticmethod
+    def payload_fingerprints(elements, name_attr='name'):
+        """
+        Fingerprints localized texts the way LocalizedTextListField would parse them from elements.
+        Returns None if elements would not parse.
+        """
+        if not isinstance(elements, list):
+            return None
+        fingerprints = []
+        for element in elements:
+            if not isinstance(element, dict):
+                return None
+            name = element.get(name_attr)
+            locale = element.get('locale')
+            if not isinstance(name, unicode) or not isinstance(locale, unicode):
+                return None
+            fingerprints.append(LocalizedText.fingerprint(
+                element.get('external_id') or None, name, element.get('%s_type' % name_attr), locale,
+                element.get('locale_preferred', False) in [True, 'True', 'true', 'TRUE']))
+        return fingerprints
+
     @property
     def is_fully_specified(self):
         return self.type == "FULLY_SPECIFIED" or self.type == "Fully Specified"
@@ -154,6 +194,43 @@ class Concept(ConceptValidationMixin, ConceptBaseModel, DictionaryItemMixin):
         initial_version.save()
         return initial_version
 
+    @classmethod
+    def persist_new_in_bulk(cls, concepts, parent_resource_version):
+        """
+        Inserts already validated concepts together with their initial versions using one bulk write per collection.
+        Ids are assigned up front so that every initial version is inserted complete, i.e. referencing its concept,
+        pointing at itself as root version and belonging to parent_resource_version.
+        """
+        initial_versions = []
+        for concept in concepts:
+            concept.id = str(ObjectId())
+            initial_version = ConceptVersion.for_concept(concept, '--TEMP--')
+            # Extras are encoded in place, so the version must not share the dict with its concept
+            initial_version.extras = copy.deepcopy(concept.extras)
+            initial_version.id = str(ObjectId())
+            initial_version.mnemonic = initial_version.id
+            initial_version.root_version_id = initial_version.id
+            initial_version.released = True
+            initial_version.versioned_object = concept
+            initial_version.source_version_ids = set([parent_resource_version.id])
+            initial_version.content_hash = initial_version.get_content_hash()
+            initial_versions.append(initial_version)
+
+        # bulk_create bypasses save() and the pre_save signal
+        for obj in concepts + initial_versions:
+            obj.encode_extras()
+            stamp_uri(obj.__class__, obj)
+
+        Concept.objects.bulk_create(concepts)
+        try:
+            ConceptVersion.objects.bulk_create(initial_versions)
+        except Exception:
+            Concept.objects.filter(id__in=[concept.id for concept in concepts]).delete()
+            raise
+
+        parent_resource_version.add_new_concept_versions(len(initial_versions))
+        return initial_versions
+
     @classmethod
     def retire(cls, concept, user, update_comment=None):
         if concept.retired:
@@ -232,6 +309,7 @@ class ConceptVersion(ConceptValidationMixin, ResourceVersionModel):
     version_created_by = models.TextField()
     update_comment = models.TextField(null=True, blank=True)
     source_version_ids = SetField()
+    content_hash = models.TextField(null=True, blank=True)
 
     class MongoMeta:
         indexes = [[ ('uri', 1) ],
@@ -240,6 +318,53 @@ class ConceptVersion(ConceptValidationMixin, ResourceVersionModel):
 
     objects = MongoDBManager()
 
+    def save(self, *args, **kwargs):
+        self.content_hash = self.get_content_hash()
+        super(ConceptVersion, self).save(*args, **kwargs)
+
+    def get_content_hash(self):
+        extras = copy.deepcopy(self.extras)
+        if self.extras_have_been_encoded:
+            self.decode_extras(extras)
+        return ConceptVersion.compute_content_hash(
+            self.external_id, self.concept_class, self.datatype,
+            None if self.names is None else [name.get_fingerprint() for name in self.names],
+            None if self.descriptions is None else [desc.get_fingerprint() for desc in self.descriptions],
+            self.retired, extras)
+
+    @classmethod
+    def get_payload_content_hash(cls, data):
+        """
+        Returns the content hash of the version that would result from the concept JSON in data, or None if data
+        cannot be fingerprinted. Missing keys are hashed as field defaults: when the stored value differs from the
+        default the hashes differ and the caller falls back to a full diff, so equal hashes always mean no change.
+        """
+        names = LocalizedText.payload_fingerprints(data.get('names', []))
+        descriptions = data.get('descriptions')
+        if descriptions is not None:
+            descriptions = LocalizedText.payload_fingerprints(descriptions, name_attr='description')
+            if descriptions is None:
+                return None
+        retired = data.get('retired', False)
+        if names is None or not isinstance(retired, bool):
+            return None
+        return cls.compute_content_hash(
+            data.get('external_id'), data.get('concept_class'), data.get('datatype'), names, descriptions,
+            retired, data.get('extras'))
+
+    @classmethod
+    def compute_content_hash(cls, external_id, concept_class, datatype, name_fingerprints, description_fingerprints,
+                             retired, extras):
+        return compute_content_hash({
+            'external_id': text_fingerprint(external_id),
+            'concept_class': text_fingerprint(concept_class),
+            'datatype': text_fingerprint(datatype),
+            'names': None if name_fingerprints is None else sorted(name_fingerprints),
+            'descriptions': None if description_fingerprints is None else sorted(description_fingerprints),
+            'retired': bool(retired),
+            'extras': extras or {},
+        })
+
     def clone(self):
         concept_version = ConceptVersion(
             mnemonic='--TEMP--',
@@ -306,6 +431,12 @@ class ConceptVersion(ConceptValidationMixin, ResourceVersionModel):
         from collection.models import CollectionVersion
         return CollectionVersion.get_collection_versions_with_concept(self.id)
 
+    @classmethod
+    def get_collection_memberships(cls, ids):
+        """ Returns (concept version id, collection version id) pairs of the collection versions containing ids """
+        from collection.models import CollectionConcept
+        return CollectionConcept.objects.filter(concept_id__in=ids).values_list('concept_id', 'collection_id')
+
     @property
     def mappings_url(self):
         concept = self.versioned_object
@@ -359,6 +490,22 @@ class ConceptVersion(ConceptValidationMixin, ResourceVersionModel):
     def get_bidirectional_mappings(self):
         return self.versioned_object.get_bidirectional_mappings()
 
+    @classmethod
+    def resolve_export_relations(cls, versions, sources):
+        """
+        Attaches their concepts, loaded with one query, to versions and the sources of the concepts from the sources
+        dict, so that serializing the versions does not resolve the same source and owner for every concept.
+        """
+        concepts = dict((concept.id, concept) for concept in Concept.objects.filter(
+            id__in=list(set(version.versioned_object_id for version in versions))))
+        Source.add_to_cache(sources, [concept.parent_id for concept in concepts.values()])
+        for concept in concepts.values():
+            if concept.parent_id in sources:
+                concept.parent = sources[concept.parent_id]
+        for version in versions:
+            if version.versioned_object_id in concepts:
+                version.versioned_object = concepts[version.versioned_object_id]
+
     @classmethod
     def get_latest_version_of(cls, concept):
         versions = ConceptVersion.objects.filter(
@@ -44,6 +44,12 @@ class ConceptVersionIndex(OCLSearchIndex, indexes.Indexable):
     def get_model(self):
         return ConceptVersion
 
+    def prepare_batch(self, objs):
+        versions = super(ConceptVersionIndex, self).prepare_batch(objs)
+        ConceptVersion.resolve_export_relations(versions, {})
+        ConceptVersion.resolve_collection_ids(versions)
+        return versions
+
     def prepare_locale(self, obj):
         locales = set()
         if obj.names:
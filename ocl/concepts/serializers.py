@@ -171,6 +171,20 @@ class ConceptVersionDetailSerializer(ResourceVersionSerializer):
             mappings_field.source = 'get_empty_mappings'
 
 
+class ConceptVersionExportSerializer(ConceptVersionDetailSerializer):
+    """
+    Serializes concept versions exactly like ConceptVersionDetailSerializer. Before serializing many versions it
+    resolves their concepts in bulk and takes sources and owners from context['export_sources'], a dict shared by
+    all batches of an export.
+    """
+
+    def __init__(self, instance=None, *args, **kwargs):
+        if instance is not None and kwargs.get('many'):
+            instance = list(instance)
+            ConceptVersion.resolve_export_relations(instance, kwargs.get('context', {}).get('export_sources', {}))
+        super(ConceptVersionExportSerializer, self).__init__(instance, *args, **kwargs)
+
+
 # class ReferencesToVersionsSerializer(ConceptVersionListSerializer):
 #
 #     def to_native(self, obj):
@@ -15,6 +15,7 @@ from concepts.validation_messages import OPENMRS_ONE_FULLY_SPECIFIED_NAME_PER_LO
     OPENMRS_SHORT_NAME_CANNOT_BE_PREFERRED, OPENMRS_DESCRIPTION_LOCALE, OPENMRS_NAME_LOCALE, OPENMRS_DESCRIPTION_TYPE, \
     OPENMRS_NAME_TYPE, OPENMRS_DATATYPE, OPENMRS_CONCEPT_CLASS, BASIC_DESCRIPTION_CANNOT_BE_EMPTY, \
     OPENMRS_PREFERRED_NAME_UNIQUE_PER_SOURCE_LOCALE, OPENMRS_AT_LEAST_ONE_FULLY_SPECIFIED_NAME
+from concepts.serializers import ConceptVersionDetailSerializer, ConceptVersionExportSerializer
 from concepts.validators import ValidatorSpecifier
 from concepts.views import ConceptVersionListView
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
@@ -812,6 +813,23 @@ class ConceptVersionTest(ConceptBaseTest):
             concept_version.full_clean()
             concept_version.save()
 
+    def test_content_hash_matches_payload_hash(self):
+        concept_version = ConceptVersion.get_latest_version_of(self.concept1)
+        self.assertIsNotNone(concept_version.content_hash)
+
+        data = {
+            'concept_class': concept_version.concept_class,
+            'datatype': concept_version.datatype,
+            'names': [{'name': name.name, 'locale': name.locale, 'name_type': name.type,
+                       'locale_preferred': name.locale_preferred} for name in reversed(concept_version.names)],
+            'descriptions': [{'description': desc.name, 'locale': desc.locale, 'description_type': desc.type,
+                              'locale_preferred': desc.locale_preferred} for desc in concept_version.descriptions],
+        }
+        self.assertEquals(concept_version.content_hash, ConceptVersion.get_payload_content_hash(data))
+
+        data['datatype'] = 'Numeric'
+        self.assertNotEquals(concept_version.content_hash, ConceptVersion.get_payload_content_hash(data))
+
     def test_concept_version_clone(self):
         self.assertEquals(1, self.concept1.num_versions)
         concept_version = ConceptVersion(
@@ -1052,6 +1070,36 @@ class ConceptVersionTest(ConceptBaseTest):
         self.assertEquals(concept_version.get_collection_version_ids()[1],
                           CollectionVersion.objects.get(mnemonic='version1').id)
 
+    def test_resolve_collection_ids(self):
+        collection = Collection(
+            name='collection3',
+            mnemonic='collection3',
+            full_name='Collection Three',
+            collection_type='Dictionary',
+            public_access=ACCESS_TYPE_EDIT,
+            default_locale='en',
+            supported_locales=['en'],
+            website='www.collection3.com',
+            description='This is the third test collection'
+        )
+        Collection.persist_new(collection, self.user1, parent_resource=self.userprofile1)
+
+        (referenced_concept, errors) = create_concept(mnemonic='referenced', user=self.user1, source=self.source1)
+        (other_concept, errors) = create_concept(mnemonic='notReferenced', user=self.user1, source=self.source1)
+
+        collection.expressions = ['/orgs/org1/sources/source1/concepts/referenced/']
+        collection.full_clean()
+        collection.save()
+        CollectionVersion.persist_new(CollectionVersion.for_base_object(collection, 'version1'))
+
+        concept_versions = list(ConceptVersion.objects.filter(
+            versioned_object_id__in=[referenced_concept.id, other_concept.id]))
+        expected_ids = [(concept_version.get_collection_ids(), concept_version.get_collection_version_ids())
+                        for concept_version in concept_versions]
+        ConceptVersion.resolve_collection_ids(concept_versions)
+        self.assertEquals(expected_ids, [(concept_version._collection_ids, concept_version._collection_version_ids)
+                                         for concept_version in concept_versions])
+
 
 class ConceptVersionStaticMethodsTest(ConceptBaseTest):
     def setUp(self):
@@ -1152,6 +1200,15 @@ class ConceptVersionStaticMethodsTest(ConceptBaseTest):
         self.assertEquals(
             self.concept_version, ConceptVersion.get_latest_version_of(self.concept1))
 
+    def test_export_serializer_matches_detail_serializer(self):
+        versions = ConceptVersion.objects.filter(versioned_object_id__in=[self.concept1.id, self.concept2.id])
+        export_sources = {}
+        export_data = ConceptVersionExportSerializer(versions, many=True, context={'export_sources': export_sources}).data
+
+        self.assertEquals(3, len(export_data))
+        self.assertEquals(ConceptVersionDetailSerializer(versions, many=True).data, export_data)
+        self.assertItemsEqual([self.source1.id, self.source2.id], export_sources.keys())
+
 
 class ConceptVersionListViewTest(ConceptBaseTest):
     def test_get_csv_rows(self):
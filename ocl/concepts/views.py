@@ -256,13 +256,27 @@ class ConceptVersionListView(ConceptVersionMixin, VersionedResourceChildMixin,
 
     def get_queryset(self):
         queryset = super(ConceptVersionListView, self).get_queryset()
-        queryset = queryset.filter(is_active=True)
-        if not self.include_retired:
-            queryset = queryset.filter(~Q(retired=True))
-        if self.updated_since:
-            queryset = queryset.filter(updated_at__gte=self.updated_since)
+        (filters, excludes) = self.get_version_filters()
+        queryset = queryset.filter(**filters)
+        if excludes:
+            queryset = queryset.exclude(**excludes)
         return queryset
 
+    def get_version_filters(self):
+        """ Returns the filter and exclude kwargs selecting the versions listed among the children """
+        filters = {'is_active': True}
+        if self.updated_since:
+            filters['updated_at__gte'] = self.updated_since
+        excludes = {} if self.include_retired else {'retired': True}
+        return filters, excludes
+
+    def get_csv_query(self):
+        (filters, excludes) = self.get_version_filters()
+        filters.update(self.get_child_filters())
+        if self.updated_since:
+            filters['updated_at__gte'] = self.updated_since.isoformat()
+        return self.model, filters, excludes
+
     def get_owner(self):
         owner = None
         if 'user' in self.kwargs:
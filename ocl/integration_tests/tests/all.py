@@ -9,6 +9,8 @@ from django.test.client import MULTIPART_CONTENT, FakePayload
 from django.utils.encoding import force_str
 from django.utils.unittest.case import skip
 from haystack.management.commands import update_index
+from haystack.query import SearchQuerySet
+from mock import patch
 from moto import mock_s3
 from rest_framework import status
 
@@ -21,9 +23,12 @@ from concepts.validation_messages import OPENMRS_DESCRIPTION_TYPE, OPENMRS_NAME_
 from mappings.models import Mapping, MappingVersion
 from mappings.tests import MappingBaseTest
 from oclapi.models import ACCESS_TYPE_EDIT, ACCESS_TYPE_NONE, LOOKUP_CONCEPT_CLASSES
+from oclapi.search_index_queue import flush_index_queue, get_index_queue_stats
+from oclapi.signals import QueuedSignalProcessor
+from orgs.models import Organization
 from sources.models import Source, SourceVersion
 from sources.tests import SourceBaseTest
-from test_helper.base import create_user, create_source, create_organization, create_concept
+from test_helper.base import create_user, create_source, create_organization, create_concept, OclApiBaseTestCase
 
 logger = logging.getLogger('oclapi')
 
@@ -3695,3 +3700,45 @@ class OrganizationDeleteViewTest(SourceBaseTest):
             'To delete this source, you must first delete all linked mappings and references' in message)
 
 
+class IndexQueueTest(OclApiBaseTestCase):
+    def setUp(self):
+        super(IndexQueueTest, self).setUp()
+        import haystack
+        self.signal_processor = QueuedSignalProcessor(haystack.connections, haystack.connection_router)
+        # Flushes are made by the test instead of a worker
+        self.patchers = [patch('haystack.signal_processor', self.signal_processor),
+                         patch('tasks.flush_index_queue.apply_async')]
+        for patcher in self.patchers:
+            patcher.start()
+        flush_index_queue()
+
+    def tearDown(self):
+        self.signal_processor.teardown()
+        for patcher in self.patchers:
+            patcher.stop()
+        super(IndexQueueTest, self).tearDown()
+
+    def search_organizations(self, name):
+        return [result.pk for result in SearchQuerySet().models(Organization).filter(name=name)]
+
+    def test_save_flush_and_search(self):
+        organization = Organization.objects.create(name='queuedorg', mnemonic='queuedorg')
+        self.assertEquals(1, get_index_queue_stats()['size'])
+
+        self.assertEquals(1, flush_index_queue())
+        self.assertEquals([organization.id], self.search_organizations('queuedorg'))
+
+        organization.delete()
+        flush_index_queue()
+        self.assertEquals([], self.search_organizations('queuedorg'))
+
+    def test_failed_flush_keeps_updates(self):
+        organization = Organization.objects.create(name='requeuedorg', mnemonic='requeuedorg')
+
+        with patch('oclapi.search_index_queue.update_index', side_effect=IOError('Solr timed out')):
+            with self.assertRaises(IOError):
+                flush_index_queue()
+        self.assertEquals(1, get_index_queue_stats()['size'])
+
+        self.assertEquals(1, flush_index_queue())
+        self.assertEquals([organization.id], self.search_organizations('requeuedorg'))
@@ -1,4 +1,9 @@
+import json
+from datetime import datetime
+from StringIO import StringIO
+
 from django.contrib.auth.models import User
+from mock import patch
 
 from concepts.importer import ConceptsImporter, ValidationLogger
 from concepts.validation_messages import OPENMRS_NAMES_EXCEPT_SHORT_MUST_BE_UNIQUE, OPENMRS_MUST_HAVE_EXACTLY_ONE_PREFERRED_NAME, \
@@ -7,12 +12,16 @@ from concepts.validation_messages import OPENMRS_NAMES_EXCEPT_SHORT_MUST_BE_UNIQ
 from concepts.models import Concept, ConceptVersion
 from concepts.tests import ConceptBaseTest
 from integration_tests.models import TestStream
+from manage.imports.bulk_import import ImportLineReader
+from manage.imports.native_importer import NativeFlexImporter
 from mappings.importer import MappingsImporter
 from mappings.models import Mapping
 from mappings.models import MappingVersion
 from mappings.tests import MappingBaseTest
 from sources.models import SourceVersion
-from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS, LOOKUP_CONCEPT_CLASSES
+from oclapi.management.commands import ImportActionHelper
+from oclapi.management.import_checkpoints import ImportCheckpointer
+from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS, LOOKUP_CONCEPT_CLASSES, ImportCheckpoint
 from test_helper.base import create_source, create_user, create_concept
 
 
@@ -90,6 +99,18 @@ class BulkConceptImporterTest(ConceptBaseTest):
         self.assertTrue('4;%s' % OPENMRS_AT_LEAST_ONE_FULLY_SPECIFIED_NAME  in logger.output.getvalue())
         self.assertTrue('7;%s' % OPENMRS_FULLY_SPECIFIED_NAME_UNIQUE_PER_SOURCE_LOCALE  in logger.output.getvalue())
 
+    def test_import_concepts_with_invalid_records_in_batches(self):
+        self.testfile = open('./integration_tests/fixtures/valid_invalid_concepts.json', 'rb')
+        stderr_stub = TestStream()
+        source = create_source(self.user1, validation_schema=CUSTOM_VALIDATION_SCHEMA_OPENMRS)
+        importer = ConceptsImporter(source, self.testfile, 'test', TestStream(), stderr_stub, save_validation_errors=False)
+        importer.import_concepts(total=7, batch_size=3)
+        self.assertTrue(OPENMRS_AT_LEAST_ONE_FULLY_SPECIFIED_NAME in stderr_stub.getvalue())
+        self.assertTrue(OPENMRS_FULLY_SPECIFIED_NAME_UNIQUE_PER_SOURCE_LOCALE in stderr_stub.getvalue())
+        self.assertEquals(5, Concept.objects.exclude(concept_class__in=LOOKUP_CONCEPT_CLASSES).count())
+        self.assertEquals(5, ConceptVersion.objects.exclude(concept_class__in=LOOKUP_CONCEPT_CLASSES).count())
+        self.assertEquals(5, SourceVersion.get_head_of(source).active_concepts)
+
     def test_validation_error_file_exists(self):
         self.testfile = open('./integration_tests/fixtures/valid_invalid_concepts.json', 'rb')
         stderr_stub = TestStream()
@@ -131,6 +152,47 @@ class ConceptImporterTest(ConceptBaseTest):
 
         self.assertItemsEqual(source_version_latest.get_concept_ids(), [inserted_concept_version.id])
 
+    def test_import_job_for_one_record_in_batches(self):
+        stdout_stub = TestStream()
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1, batch_size=100)
+        self.assertTrue('Created new concept: 1 = Diagnosis' in stdout_stub.getvalue())
+        inserted_concept = Concept.objects.get(mnemonic='1')
+        self.assertEquals(inserted_concept.parent, self.source1)
+        self.assertEquals(inserted_concept.uri, '/orgs/org1/sources/source1/concepts/1/')
+        inserted_concept_version = ConceptVersion.objects.get(versioned_object_id=inserted_concept.id)
+        self.assertEquals(inserted_concept_version.mnemonic, inserted_concept_version.id)
+        self.assertEquals(inserted_concept_version.root_version_id, inserted_concept_version.id)
+        self.assertTrue(inserted_concept_version.released)
+        source_version_latest = SourceVersion.get_latest_version_of(self.source1)
+
+        self.assertItemsEqual(source_version_latest.get_concept_ids(), [inserted_concept_version.id])
+
+    def test_import_job_for_unchanged_record(self):
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', TestStream(), TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1)
+
+        stdout_stub = TestStream()
+        testfile = open('./integration_tests/fixtures/one_concept.json', 'rb')
+        importer = ConceptsImporter(self.source1, testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1)
+
+        self.assertTrue('Loaded 1 existing concepts of source source1' in stdout_stub.getvalue())
+        self.assertTrue('**** Processed 1 out of 1 concepts - 1 no action/no diff, ****' in stdout_stub.getvalue())
+        self.assertEquals(1, ConceptVersion.objects.exclude(concept_class__in=LOOKUP_CONCEPT_CLASSES).count())
+        self.assertEquals({}, importer.concept_snapshot)
+
+    def test_partition_worker_loads_snapshot_of_its_concepts(self):
+        create_concept(mnemonic='1', user=self.user1, source=self.source1)
+        create_concept(mnemonic='2', user=self.user1, source=self.source1)
+
+        stdout_stub = TestStream()
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1, worker_summary_file='summary.json')
+
+        self.assertTrue('Loaded 1 existing concepts of source source1' in stdout_stub.getvalue())
+        self.assertTrue('**** Processed 1 out of 1 concepts - 1 updated, ****' in stdout_stub.getvalue())
+
     def test_import_job_for_change_in_data(self):
         stdout_stub = TestStream()
         create_concept(mnemonic='1', user=self.user1, source=self.source1)
@@ -147,6 +209,69 @@ class ConceptImporterTest(ConceptBaseTest):
         self.assertTrue(('Updated concept, replacing version ID ' + latest_concept_version.previous_version.id) in stdout_stub.getvalue())
         self.assertTrue('**** Processed 1 out of 1 concepts - 1 updated, ****' in stdout_stub.getvalue())
 
+    def test_import_job_records_touched_concept_versions(self):
+        (concept, _) = create_concept(mnemonic='1', user=self.user1, source=self.source1)
+        (untouched_concept, _) = create_concept(mnemonic='2', user=self.user1, source=self.source1)
+
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', TestStream(), TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1, skip_index=True)
+
+        # The replaced version is no longer the latest one, so it has to be indexed as well
+        concept_version_ids = set(ConceptVersion.objects.filter(versioned_object_id=concept.id).values_list('id', flat=True))
+        self.assertEquals(2, len(concept_version_ids))
+        self.assertEquals(concept_version_ids, importer.touched_versions.ids)
+        self.assertFalse(ConceptVersion.get_latest_version_of(untouched_concept).id in importer.touched_versions.ids)
+
+    def test_import_job_deactivates_old_concept_versions(self):
+        create_concept(mnemonic='1', user=self.user1, source=self.source1)
+        (old_concept, _) = create_concept(mnemonic='2', user=self.user1, source=self.source1)
+        old_version_id = ConceptVersion.get_latest_version_of(old_concept).id
+
+        stdout_stub = TestStream()
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1, deactivate_old_records=True, skip_index=True)
+
+        self.assertTrue(('Deactivated concept version: %s' % old_version_id) in stdout_stub.getvalue())
+        self.assertFalse(ConceptVersion.objects.get(id=old_version_id).is_active)
+        self.assertTrue(old_version_id in importer.touched_versions.ids)
+
+    def test_import_job_resumes_from_checkpoint(self):
+        file_size = len(open('./integration_tests/fixtures/one_concept.json', 'rb').read())
+        checkpointer = ImportCheckpointer('concepts', self.source1, 'hash')
+        checkpointer.start(SourceVersion.get_head_of(self.source1), [], datetime.now())
+        checkpointer.save(file_size, 1, {ImportActionHelper.IMPORT_ACTION_ADD: 1}, force=True)
+
+        stdout_stub = TestStream()
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1, file_hash='hash', resume=True)
+
+        self.assertTrue('Resuming import after line 1 of the previous run' in stdout_stub.getvalue())
+        self.assertTrue('**** Processed 1 out of 1 concepts - 1 added, ****' in stdout_stub.getvalue())
+        self.assertFalse(Concept.objects.filter(mnemonic='1').exists())
+        self.assertEquals(0, ImportCheckpoint.objects.count())
+
+    def test_import_job_resumes_between_checkpoints(self):
+        (concept, _) = create_concept(mnemonic='1', user=self.user1, source=self.source1)
+        old_version_id = ConceptVersion.get_latest_version_of(concept).id
+
+        # The run fails after importing the line, before a checkpoint is written
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', TestStream(), TestStream(), save_validation_errors=False)
+        with patch.object(ConceptsImporter, 'save_checkpoint', side_effect=Exception('Import interrupted')):
+            with self.assertRaises(Exception):
+                importer.import_concepts(total=1, file_hash='hash', deactivate_old_records=True, skip_index=True)
+        new_version_id = ConceptVersion.get_latest_version_of(concept).id
+        self.assertNotEquals(old_version_id, new_version_id)
+
+        stderr_stub = TestStream()
+        concepts_file = open('./integration_tests/fixtures/one_concept.json', 'rb')
+        importer = ConceptsImporter(self.source1, concepts_file, 'test', TestStream(), stderr_stub, save_validation_errors=False)
+        importer.import_concepts(total=1, file_hash='hash', resume=True, deactivate_old_records=True, skip_index=True)
+
+        self.assertFalse('Key not found' in stderr_stub.getvalue())
+        self.assertEquals(set(), importer.concept_version_ids)
+        self.assertTrue(ConceptVersion.objects.get(id=old_version_id).is_active)
+        self.assertEquals(set([old_version_id, new_version_id]), importer.touched_versions.ids)
+        self.assertEquals(0, ImportCheckpoint.objects.count())
 
 class MappingImporterTest(MappingBaseTest):
     def setUp(self):
@@ -233,6 +358,21 @@ class MappingImporterTest(MappingBaseTest):
         self.assertTrue(
             "Must specify either 'to_concept' or 'to_source' & 'to_concept_code'. Cannot specify both." in stderr_stub.getvalue())
 
+    def test_import_job_prefetches_references(self):
+        lines = [
+            '{"from_concept_url": "/orgs/org2/sources/source2/concepts/concept3/", "to_source_url": "/users/user1/sources/source1/"}',
+            '{"from_concept_url": "/orgs/org2/sources/source2/concepts/missing/"}',
+            'not json',
+        ]
+        importer = MappingsImporter(self.source1, self.testfile, TestStream(), TestStream(), 'test')
+        importer.prefetch_references(lines)
+
+        self.assertEquals('concept3', importer.concepts_cache['/orgs/org2/sources/source2/concepts/concept3/'].mnemonic)
+        self.assertEquals(self.source1, importer.get_source('/users/user1/sources/source1/'))
+        self.assertIsNone(importer.concepts_cache['/orgs/org2/sources/source2/concepts/missing/'])
+        with self.assertRaises(Concept.DoesNotExist):
+            importer.get_concept('/orgs/org2/sources/source2/concepts/missing/')
+
     def test_import_valid_invalid_mappings(self):
         stdout_stub = TestStream()
         stderr_stub = TestStream()
@@ -242,4 +382,51 @@ class MappingImporterTest(MappingBaseTest):
         self.assertTrue('Cannot map concept to itself.' in stderr_stub.getvalue())
         self.assertTrue("Must specify either 'to_concept' or 'to_source' & " in stderr_stub.getvalue())
         self.assertEquals(3, Mapping.objects.count())
-        self.assertEquals(3, MappingVersion.objects.count())
\ No newline at end of file
+        self.assertEquals(3, MappingVersion.objects.count())
+
+
+class NativeFlexImporterTest(ConceptBaseTest):
+    def get_concept_line(self, mnemonic):
+        return json.dumps({
+            'type': 'Concept', 'id': mnemonic, 'source_url': self.source1.uri, 'concept_class': 'Diagnosis',
+            'datatype': 'None', 'names': [{'name': 'Concept %s' % mnemonic, 'locale': 'en', 'name_type': 'FULLY_SPECIFIED'}]
+        })
+
+    def test_import_concepts_and_mapping(self):
+        input_list = [
+            self.get_concept_line('A'),
+            self.get_concept_line('B'),
+            json.dumps({'type': 'Mapping', 'source_url': self.source1.uri, 'map_type': 'SAME-AS',
+                        'from_concept_url': self.source1.uri + 'concepts/A/',
+                        'to_concept_url': self.source1.uri + 'concepts/B/'}),
+            '{"type": "Unknown"}',
+        ]
+        importer = NativeFlexImporter(input_list, self.user1)
+        importer.process()
+
+        self.assertEquals(2, Concept.objects.filter(parent_id=self.source1.id, mnemonic__in=['A', 'B']).count())
+        self.assertEquals(1, Mapping.objects.filter(parent_id=self.source1.id).count())
+        self.assertTrue('Processed 4 of 4' in importer.import_results.get_detailed_summary())
+        self.assertTrue('3 new (201:3)' in importer.import_results.get_detailed_summary(root_key=self.source1.uri))
+
+    def test_import_existing_concept_without_update(self):
+        importer = NativeFlexImporter([self.get_concept_line('A')], self.user1)
+        importer.process()
+        importer = NativeFlexImporter([self.get_concept_line('A')], self.user1)
+        importer.process()
+
+        self.assertEquals(1, Concept.objects.filter(parent_id=self.source1.id, mnemonic='A').count())
+        self.assertTrue('1 skip' in importer.import_results.get_detailed_summary(root_key=self.source1.uri))
+
+    def test_import_lines_from_stream(self):
+        stream = StringIO('%s\n\nnot json\n%s\n' % (self.get_concept_line('A'), self.get_concept_line('B')))
+        progress = []
+        reader = ImportLineReader(stream)
+        importer = NativeFlexImporter(reader, self.user1, progress_callback=progress.append)
+        importer.PROGRESS_INTERVAL = 1
+        importer.process()
+
+        self.assertEquals(len(stream.getvalue()), reader.offset)
+        self.assertEquals([1, 2, 3], progress)
+        self.assertEquals(2, Concept.objects.filter(parent_id=self.source1.id, mnemonic__in=['A', 'B']).count())
+        self.assertTrue('Processed 3 of 3' in importer.import_results.get_detailed_summary())
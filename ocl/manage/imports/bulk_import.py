@@ -1,10 +1,51 @@
-import json
-
+from bson import ObjectId
+from django.db import connections
 from django.utils.text import compress_string
-from ocldev.oclfleximporter import OclFlexImporter
+import gridfs
 
+from manage.imports.native_importer import NativeFlexImporter
 from users.models import UserProfile
 
+# GridFS collection holding uploaded import files until a worker has processed them
+UPLOADS_COLLECTION = 'bulk_import_uploads'
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+PROGRESS_STATE = 'PROGRESS'
+
+
+def get_uploads_fs():
+    return gridfs.GridFS(connections['default'].database, collection=UPLOADS_COLLECTION)
+
+
+def stage_upload(stream, username):
+    """
+    Copies an uploaded import from a file-like object into GridFS in fixed size chunks, so that neither the
+    request handler nor the task queue hold the whole file. Returns the id of the stored file.
+    """
+    upload = get_uploads_fs().new_file(content_type='application/json', username=username)
+    try:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        while chunk:
+            upload.write(chunk)
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+    finally:
+        upload.close()
+    return str(upload._id)
+
+
+class ImportLineReader(object):
+    """ Iterates over the non-empty lines of a file-like object, keeping track of the byte offset reached """
+    def __init__(self, stream):
+        self.stream = stream
+        self.offset = 0
+
+    def __iter__(self):
+        for line in iter(self.stream.readline, ''):
+            self.offset += len(line)
+            if line.strip():
+                yield line
+
+
 class ImportResults:
     def __init__(self, importer):
         self.json = compress_string(importer.import_results.to_json())
@@ -13,17 +54,33 @@ class ImportResults:
 
 
 class BulkImport:
-    def __init__(self):
-        pass
+    def __init__(self, task=None):
+        self.task = task
+
+    def run_import(self, upload_id, username, update_if_exists):
+        """ Streams the staged upload through the importer and removes it once the import is done """
+        fs = get_uploads_fs()
+        try:
+            upload = fs.get(ObjectId(upload_id))
+            reader = ImportLineReader(upload)
 
-    def run_import(self, to_import, username, update_if_exists):
-        input_list = []
-        for line in to_import.splitlines():
-            input_list.append(json.loads(line))
+            def report_progress(lines_processed):
+                self.report_progress(lines_processed, reader.offset, upload.length)
 
-        profile = UserProfile.objects.get(mnemonic=username)
-        importer = OclFlexImporter(input_list=input_list, api_url_root='http://api.openconceptlab.org:8000',
-                                   api_token=profile.user.auth_token.key, do_update_if_exists=update_if_exists)
-        importer.process()
+            profile = UserProfile.objects.get(mnemonic=username)
+            importer = NativeFlexImporter(input_lines=reader, user=profile.user, do_update_if_exists=update_if_exists,
+                                          progress_callback=report_progress)
+            importer.process()
+        finally:
+            fs.delete(ObjectId(upload_id))
 
         return ImportResults(importer)
+
+    def report_progress(self, lines_processed, bytes_processed, total_bytes):
+        if not self.task or not self.task.request.id:
+            return
+        self.task.update_state(state=PROGRESS_STATE, meta={
+            'lines_processed': lines_processed,
+            'bytes_processed': bytes_processed,
+            'total_bytes': total_bytes,
+        })
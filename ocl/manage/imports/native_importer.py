@@ -0,0 +1,491 @@
+""" In-process executor for OCL flex-import JSON lines """
+import json
+import logging
+import time
+
+from django.core.exceptions import ValidationError
+from ocldev.oclconstants import OclConstants
+from ocldev.oclfleximporter import OclFlexImporter, OclImportResults
+
+from collection.models import Collection, CollectionVersion, CollectionReferenceUtils
+from collection.serializers import CollectionCreateSerializer, CollectionDetailSerializer, \
+    CollectionVersionCreateSerializer, CollectionVersionUpdateSerializer
+from concepts.models import Concept, ConceptVersion
+from concepts.serializers import ConceptDetailSerializer, ConceptVersionUpdateSerializer
+from mappings.models import Mapping, MappingVersion
+from mappings.serializers import MappingCreateSerializer, MappingUpdateSerializer
+from oclapi.management.commands import MockRequest
+from oclapi.search_index_queue import buffer_index_updates, push_buffered_index_updates
+from oclapi.utils import add_user_to_org, update_all_in_index
+from orgs.models import Organization
+from orgs.serializers import OrganizationCreateSerializer, OrganizationDetailSerializer
+from sources.models import Source, SourceVersion
+from sources.serializers import SourceCreateSerializer, SourceDetailSerializer, SourceVersionCreateSerializer, \
+    SourceVersionUpdateSerializer
+from tasks import export_source, export_collection, update_collection_in_solr
+from users.models import UserProfile
+
+logger = logging.getLogger('batch')
+
+
+class ImportItem(object):
+    """ A single line of the import with its resolved URLs and the fields that will be written """
+    def __init__(self, obj_type, obj_id, owner_url, repo_url, obj_url, obj, text):
+        self.obj_type = obj_type
+        self.obj_id = obj_id
+        self.owner_url = owner_url
+        self.repo_url = repo_url
+        self.obj_url = obj_url
+        self.obj = obj
+        self.text = text
+
+
+class NativeFlexImporter(object):
+    """
+    Imports the OCL flex-import JSON lines format (see ocldev's OclFlexImporter) by writing straight through the
+    serializers and models instead of sending every resource back to the API over HTTP. Consecutive concepts of the
+    same source are handled in batches: one query finds the existing ones and new concepts are inserted in bulk.
+    Results are collected in an OclImportResults using the status codes the API would have responded with.
+    """
+    ACTION_TYPE_NEW = OclFlexImporter.ACTION_TYPE_NEW
+    ACTION_TYPE_UPDATE = OclFlexImporter.ACTION_TYPE_UPDATE
+    ACTION_TYPE_SKIP = OclFlexImporter.ACTION_TYPE_SKIP
+
+    DEFAULT_BATCH_SIZE = 500
+    # Number of lines between two calls of the progress callback
+    PROGRESS_INTERVAL = 100
+
+    obj_def = OclFlexImporter.obj_def
+
+    def __init__(self, input_lines, user, do_update_if_exists=False, batch_size=DEFAULT_BATCH_SIZE,
+                 progress_callback=None):
+        self.input_lines = input_lines
+        self.user = user
+        self.do_update_if_exists = do_update_if_exists
+        self.batch_size = batch_size
+        self.progress_callback = progress_callback
+        self.serializer_context = {'request': MockRequest(user)}
+        self.resource_cache = {}
+        self.import_results = None
+
+    def process(self):
+        """ Imports the JSON lines one by one as they are read and returns the number of lines processed """
+        start_time = time.time()
+        self.import_results = OclImportResults()
+        concept_batch = []
+        count = 0
+        # Search index updates are buffered to be queued together, once per progress interval
+        with buffer_index_updates():
+            for json_line_raw in self.input_lines:
+                count += 1
+                if count % self.PROGRESS_INTERVAL == 0:
+                    push_buffered_index_updates()
+                    if self.progress_callback:
+                        self.progress_callback(count)
+
+                try:
+                    obj = json.loads(json_line_raw)
+                except ValueError as exc:
+                    self.add_skip_result(None, json_line_raw, 'Invalid JSON line: %s' % exc.args[0])
+                    continue
+                text = json.dumps(obj)
+                obj_type = obj.pop('type', None)
+                if obj_type is None:
+                    self.add_skip_result(None, text, "No 'type' attribute: %s" % text)
+                    continue
+                if obj_type not in self.obj_def:
+                    self.add_skip_result(obj_type, text, "Unrecognized 'type' attribute '%s' for object: %s" % (obj_type, text))
+                    continue
+                if obj_type == OclConstants.RESOURCE_TYPE_USER:
+                    self.add_skip_result(obj_type, text, "Users cannot be created by a bulk import: %s" % text)
+                    continue
+
+                try:
+                    item = self.build_item(obj_type, obj, text)
+                except ValueError as exc:
+                    self.add_skip_result(obj_type, text, exc.args[0])
+                    continue
+
+                if obj_type == OclConstants.RESOURCE_TYPE_CONCEPT:
+                    if concept_batch and concept_batch[0].repo_url != item.repo_url:
+                        self.import_concept_batch(concept_batch)
+                        concept_batch = []
+                    concept_batch.append(item)
+                    if len(concept_batch) >= self.batch_size:
+                        self.import_concept_batch(concept_batch)
+                        concept_batch = []
+                    continue
+
+                # Later lines may refer to the concepts, so pending concepts are persisted first
+                if concept_batch:
+                    self.import_concept_batch(concept_batch)
+                    concept_batch = []
+                self.import_item(item)
+
+            if concept_batch:
+                self.import_concept_batch(concept_batch)
+
+        self.import_results.total_lines = count
+        self.import_results.elapsed_seconds = time.time() - start_time
+        return count
+
+    def build_item(self, obj_type, obj, text):
+        """ Resolves the owner, repository and object URLs the same way OclFlexImporter does """
+        definition = self.obj_def[obj_type]
+        obj_id = unicode(obj[definition['id_field']]) if obj.get(definition.get('id_field')) is not None else ''
+
+        owner_url = None
+        if definition['has_owner']:
+            if 'owner_url' in obj:
+                owner_url = obj.pop('owner_url')
+            elif 'owner' in obj and 'owner_type' in obj:
+                owner_type = obj.pop('owner_type')
+                if owner_type not in [OclConstants.RESOURCE_TYPE_ORGANIZATION, OclConstants.RESOURCE_TYPE_USER]:
+                    raise ValueError("Valid owner information required for object of type '%s'" % obj_type)
+                owner_url = '/%s/%s/' % (self.obj_def[owner_type]['url_name'], obj['owner'])
+            elif definition['has_source'] and obj.get('source_url'):
+                owner_url = '/'.join(obj['source_url'].split('/')[:3]) + '/'
+            elif definition['has_collection'] and obj.get('collection_url'):
+                owner_url = '/'.join(obj['collection_url'].split('/')[:3]) + '/'
+            else:
+                raise ValueError("Valid owner information required for object of type '%s'" % obj_type)
+            obj.pop('owner', None)
+            obj.pop('owner_type', None)
+
+        repo_url = None
+        for (has_repo, repo_key) in [(definition['has_source'], 'source'), (definition['has_collection'], 'collection')]:
+            if not has_repo:
+                continue
+            if repo_key + '_url' in obj:
+                repo_url = obj.pop(repo_key + '_url')
+            elif repo_key in obj:
+                repo_url = '%s%ss/%s/' % (owner_url, repo_key, obj[repo_key])
+            else:
+                raise ValueError("Valid %s information required for object of type '%s'" % (repo_key, obj_type))
+            obj.pop(repo_key, None)
+
+        if repo_url and definition.get('omit_resource_name_on_get'):
+            obj_url = repo_url + obj_id + '/'
+        elif repo_url and obj_id:
+            obj_url = '%s%s/%s/' % (repo_url, definition['url_name'], obj_id)
+        elif repo_url:
+            obj_url = '%s%s/' % (repo_url, definition['url_name'])
+        else:
+            obj_url = '%s%s/%s/' % (owner_url or '/', definition['url_name'], obj_id)
+
+        allowed_fields = definition['allowed_fields'] + ['__cascade']
+        obj = dict((key, value) for (key, value) in obj.items() if key in allowed_fields)
+        return ImportItem(obj_type, obj_id, owner_url, repo_url, obj_url, obj, text)
+
+    def import_item(self, item):
+        handlers = {
+            OclConstants.RESOURCE_TYPE_ORGANIZATION: self.import_organization,
+            OclConstants.RESOURCE_TYPE_SOURCE: self.import_repository,
+            OclConstants.RESOURCE_TYPE_COLLECTION: self.import_repository,
+            OclConstants.RESOURCE_TYPE_MAPPING: self.import_mapping,
+            OclConstants.RESOURCE_TYPE_REFERENCE: self.import_references,
+            OclConstants.RESOURCE_TYPE_SOURCE_VERSION: self.import_repository_version,
+            OclConstants.RESOURCE_TYPE_COLLECTION_VERSION: self.import_repository_version,
+        }
+        try:
+            handlers[item.obj_type](item)
+        except Exception as exc:
+            logger.exception('Failed to import %s' % item.text)
+            self.add_result(item, self.ACTION_TYPE_SKIP, 500, 'Unexpected error occurred: %s' % exc)
+
+    def import_organization(self, item):
+        organization = self.get_resource(Organization, item.obj_url)
+        if organization and not self.check_update_allowed(item):
+            return
+
+        if organization:
+            serializer = OrganizationDetailSerializer(
+                organization, data=item.obj, partial=True, context=self.serializer_context)
+            self.save(item, serializer, force_update=True)
+        else:
+            serializer = OrganizationCreateSerializer(data=item.obj, context=self.serializer_context)
+            organization = self.save(item, serializer, force_insert=True)
+            if organization:
+                add_user_to_org(self.user.get_profile(), organization)
+
+    def import_repository(self, item):
+        owner = self.get_owner(item)
+        if not owner:
+            return
+
+        if item.obj_type == OclConstants.RESOURCE_TYPE_SOURCE:
+            model, create_serializer_class, detail_serializer_class = \
+                Source, SourceCreateSerializer, SourceDetailSerializer
+        else:
+            model, create_serializer_class, detail_serializer_class = \
+                Collection, CollectionCreateSerializer, CollectionDetailSerializer
+
+        repository = self.get_resource(model, item.obj_url)
+        if repository and not self.check_update_allowed(item):
+            return
+
+        if repository:
+            serializer = detail_serializer_class(
+                repository, data=item.obj, partial=True, context=self.serializer_context)
+            self.save(item, serializer, force_update=True, parent_resource=owner)
+        else:
+            serializer = create_serializer_class(data=item.obj, context=self.serializer_context)
+            self.save(item, serializer, force_insert=True, parent_resource=owner)
+
+    def import_repository_version(self, item):
+        if item.obj_type == OclConstants.RESOURCE_TYPE_SOURCE_VERSION:
+            repository = self.get_repository(item, Source)
+            version_model, export = SourceVersion, export_source
+            create_serializer_class, update_serializer_class = \
+                SourceVersionCreateSerializer, SourceVersionUpdateSerializer
+        else:
+            repository = self.get_repository(item, Collection)
+            version_model, export = CollectionVersion, export_collection
+            create_serializer_class, update_serializer_class = \
+                CollectionVersionCreateSerializer, CollectionVersionUpdateSerializer
+        if not repository:
+            return
+
+        versions = version_model.objects.filter(versioned_object_id=repository.id, mnemonic=item.obj_id)
+        if versions and not self.check_update_allowed(item):
+            return
+
+        if versions:
+            serializer = update_serializer_class(
+                versions[0], data=item.obj, partial=True, context=self.serializer_context)
+            self.save(item, serializer, force_update=True, versioned_object=repository)
+        else:
+            serializer = create_serializer_class(data=item.obj, context=self.serializer_context)
+            version = self.save(item, serializer, force_insert=True, versioned_object=repository)
+            if version:
+                export.delay(version.id)
+
+    def import_concept_batch(self, batch):
+        """
+        Imports consecutive concepts of one source. Existing concepts are looked up with a single query and updated
+        one by one, new concepts are validated in memory and inserted together with their initial versions in bulk.
+        """
+        source = self.get_repository(batch[0], Source)
+        if not source:
+            for item in batch[1:]:
+                self.add_result(item, self.ACTION_TYPE_SKIP, None, 'Repository does not exist at: %s' % item.repo_url)
+            return
+
+        existing_ids = dict(Concept.objects.filter(
+            parent_id=source.id, mnemonic__in=[item.obj_id for item in batch]).values_list('mnemonic', 'id'))
+
+        pending = []
+        pending_ids = set()
+        pending_names = set()
+        for item in batch:
+            if item.obj_id in pending_ids:
+                # A repeated mnemonic updates the concept, so the pending block has to be persisted first
+                existing_ids.update(self.insert_new_concepts(source, pending))
+                pending, pending_ids, pending_names = [], set(), set()
+
+            if item.obj_id in existing_ids:
+                if self.check_update_allowed(item):
+                    self.try_import(item, self.ACTION_TYPE_UPDATE, self.update_concept, existing_ids[item.obj_id])
+                continue
+
+            concept = self.try_import(item, self.ACTION_TYPE_NEW, self.build_new_concept, source)
+            if not concept:
+                continue
+            names = set((name.name, name.locale) for name in concept.names or [])
+            if source.custom_validation_schema and names & pending_names:
+                # Name uniqueness is validated against the database, so persist the pending block and validate again
+                existing_ids.update(self.insert_new_concepts(source, pending))
+                pending, pending_ids, pending_names = [], set(), set()
+                concept = self.try_import(item, self.ACTION_TYPE_NEW, self.build_new_concept, source)
+                if not concept:
+                    continue
+            pending.append((item, concept))
+            pending_ids.add(item.obj_id)
+            pending_names.update(names)
+
+        self.insert_new_concepts(source, pending)
+
+    def build_new_concept(self, item, source):
+        serializer = ConceptDetailSerializer(data=item.obj, context=self.serializer_context)
+        if not serializer.is_valid():
+            self.add_result(item, self.ACTION_TYPE_NEW, 400, self.format_errors(serializer.errors))
+            return None
+        concept = serializer.object
+        concept.created_by = self.user
+        concept.updated_by = self.user
+        concept.parent = source
+        concept.public_access = source.public_access
+        concept.clean_fields()
+        concept.clean()
+        return concept
+
+    def insert_new_concepts(self, source, pending):
+        """ Persists a block of validated (item, concept) pairs, returns mnemonic -> id of the inserted concepts """
+        if not pending:
+            return {}
+        concepts = [concept for (_, concept) in pending]
+        try:
+            versions = Concept.persist_new_in_bulk(concepts, SourceVersion.get_head_of(source))
+        except Exception as exc:
+            logger.exception('Failed to insert concepts into %s' % source.uri)
+            for (item, _) in pending:
+                self.add_result(item, self.ACTION_TYPE_NEW, 500, 'Unexpected error occurred: %s' % exc)
+            return {}
+
+        # bulk_create bypasses the signals that keep the search index up to date
+        update_all_in_index(ConceptVersion, ConceptVersion.objects.filter(id__in=[version.id for version in versions]))
+        for (item, concept) in pending:
+            self.resource_cache.pop((Concept, concept.uri), None)
+            self.add_result(item, self.ACTION_TYPE_NEW, 201, 'Created %s' % concept.uri)
+        return dict((concept.mnemonic, concept.id) for concept in concepts)
+
+    def update_concept(self, item, concept_id):
+        data = item.obj
+        concept_version = ConceptVersion.get_latest_version_by_id(concept_id)
+
+        if not concept_version.content_hash or \
+                concept_version.content_hash != ConceptVersion.get_payload_content_hash(data):
+            clone = concept_version.clone()
+            serializer = ConceptVersionUpdateSerializer(clone, data=data, context=self.serializer_context)
+            if not serializer.is_valid():
+                self.add_result(item, self.ACTION_TYPE_UPDATE, 400, self.format_errors(serializer.errors))
+                return
+            diffs = ConceptVersion.diff(concept_version, serializer.object)
+            if diffs:
+                if 'names' in diffs:
+                    diffs['names'] = {'is': data.get('names')}
+                if 'descriptions' in diffs:
+                    diffs['descriptions'] = {'is': data.get('descriptions')}
+                clone.update_comment = json.dumps(diffs)
+                serializer.save()
+                if not serializer.is_valid():
+                    self.add_result(item, self.ACTION_TYPE_UPDATE, 400, self.format_errors(serializer.errors))
+                    return
+
+        if 'retired' in data and data['retired'] != concept_version.retired:
+            concept = Concept.objects.get(id=concept_id)
+            if data['retired']:
+                errors = Concept.retire(concept, self.user)
+            else:
+                errors = Concept.unretire(concept, self.user)
+            if errors:
+                self.add_result(item, self.ACTION_TYPE_UPDATE, 400, self.format_errors(errors))
+                return
+
+        self.add_result(item, self.ACTION_TYPE_UPDATE, 200, 'Updated %s' % item.obj_url)
+
+    def import_mapping(self, item):
+        source = self.get_repository(item, Source)
+        if not source:
+            return
+
+        data = item.obj
+        payload = dict(data)
+        query = {'parent_id': source.id, 'map_type': data.get('map_type')}
+        for (url_key, key, model) in [('from_concept_url', 'from_concept', Concept),
+                                      ('to_concept_url', 'to_concept', Concept),
+                                      ('to_source_url', 'to_source', Source)]:
+            if not data.get(url_key):
+                continue
+            payload[key] = self.get_resource(model, data[url_key])
+            if not payload[key]:
+                self.add_result(item, self.ACTION_TYPE_NEW, 400, '%s %s does not exist' % (url_key, data[url_key]))
+                return
+            query[key + '_id'] = payload[key].id
+        if 'to_concept_id' not in query:
+            query.update({'to_concept_code': data.get('to_concept_code'), 'to_concept_name': data.get('to_concept_name')})
+
+        mappings = Mapping.objects.filter(**query)[:1]
+        if mappings and not self.check_update_allowed(item):
+            return
+
+        if not mappings:
+            serializer = MappingCreateSerializer(data=data, context=self.serializer_context)
+            self.save(item, serializer, force_insert=True, parent_resource=source)
+            return
+
+        mapping = mappings[0]
+        mapping_version = MappingVersion.objects.get(versioned_object_id=mapping.id, is_latest_version=True)
+        if mapping_version.content_hash and mapping_version.content_hash == MappingVersion.get_payload_content_hash(payload):
+            self.add_result(item, self.ACTION_TYPE_UPDATE, 200, 'Updated %s' % mapping.uri)
+            return
+        serializer = MappingUpdateSerializer(mapping, data=data, partial=True, context=self.serializer_context)
+        self.save(item, serializer, force_update=True, parent_resource=source)
+
+    def import_references(self, item):
+        collection = self.get_repository(item, Collection)
+        if not collection:
+            return
+
+        data = item.obj.get('data') or {}
+        expressions = set(data.get('expressions', []) + data.get('concepts', []) + data.get('mappings', []))
+        if item.obj.get('__cascade', 'none').lower() == 'sourcemappings':
+            expressions = expressions.union(CollectionReferenceUtils.get_all_related_mappings(expressions, collection))
+
+        added_references, errors = collection.add_references_in_bulk(expressions)
+        update_collection_in_solr.delay(collection.get_head().id, added_references)
+        self.add_result(item, self.ACTION_TYPE_NEW, 200, self.format_errors({
+            'added': [reference.expression for reference in added_references], 'errors': errors}))
+
+    def save(self, item, serializer, **kwargs):
+        """ Saves through the serializer as the API views do and records the outcome, returns the saved object """
+        created = kwargs.get('force_insert', False)
+        action_type = self.ACTION_TYPE_NEW if created else self.ACTION_TYPE_UPDATE
+        if serializer.is_valid():
+            obj = serializer.save(**kwargs)
+            if serializer.is_valid():
+                self.resource_cache.pop((type(obj), item.obj_url), None)
+                self.add_result(item, action_type, 201 if created else 200, '%s %s' % (
+                    'Created' if created else 'Updated', getattr(obj, 'uri', None) or item.obj_url))
+                return obj
+        self.add_result(item, action_type, 400, self.format_errors(serializer.errors))
+        return None
+
+    def try_import(self, item, action_type, handler, *args):
+        """ Runs a handler for a single item, recording validation and unexpected errors as failed results """
+        try:
+            return handler(item, *args)
+        except ValidationError as exc:
+            self.add_result(item, action_type, 400, self.format_errors(exc.messages))
+        except Exception as exc:
+            logger.exception('Failed to import %s' % item.text)
+            self.add_result(item, self.ACTION_TYPE_SKIP, 500, 'Unexpected error occurred: %s' % exc)
+        return None
+
+    def check_update_allowed(self, item):
+        if self.do_update_if_exists:
+            return True
+        self.add_result(item, self.ACTION_TYPE_SKIP, None, 'Object already exists at: %s' % item.obj_url)
+        return False
+
+    def get_owner(self, item):
+        model = Organization if item.owner_url.startswith('/orgs/') else UserProfile
+        owner = self.get_resource(model, item.owner_url)
+        if not owner:
+            self.add_result(item, self.ACTION_TYPE_SKIP, None, 'Owner does not exist at: %s' % item.owner_url)
+        return owner
+
+    def get_repository(self, item, model):
+        repository = self.get_resource(model, item.repo_url)
+        if not repository:
+            self.add_result(item, self.ACTION_TYPE_SKIP, None, 'Repository does not exist at: %s' % item.repo_url)
+        return repository
+
+    def get_resource(self, model, uri):
+        """ Looks up an active resource by URI, remembering the outcome until the resource is saved by this import """
+        key = (model, uri)
+        if key not in self.resource_cache:
+            resources = model.objects.filter(uri=uri, is_active=True)[:1]
+            self.resource_cache[key] = resources[0] if resources else None
+        return self.resource_cache[key]
+
+    def format_errors(self, errors):
+        return json.dumps(errors, default=unicode)
+
+    def add_result(self, item, action_type, status_code, message):
+        self.import_results.add(
+            obj_url=item.obj_url, action_type=action_type, obj_type=item.obj_type, obj_repo_url=item.repo_url,
+            obj_owner_url=item.owner_url, status_code=status_code, text=item.text, message=message)
+
+    def add_skip_result(self, obj_type, text, message):
+        self.import_results.add(action_type=self.ACTION_TYPE_SKIP, obj_type=obj_type, text=text, message=message)
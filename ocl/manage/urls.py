@@ -1,10 +1,12 @@
 from rest_framework import routers
 
-from manage.views import ManageBrokenReferencesView, BulkImportView
+from manage.views import ManageBrokenReferencesView, BulkImportView, CSVExportView, IndexQueueView
 
 router = routers.DefaultRouter()
 router.register(r'brokenreferences', ManageBrokenReferencesView, base_name='brokenreferences')
 router.register(r'bulkimport', BulkImportView, base_name='bulkimport')
+router.register(r'csvexport', CSVExportView, base_name='csvexport')
+router.register(r'indexqueue', IndexQueueView, base_name='indexqueue')
 
 urlpatterns = router.urls
 
@@ -1,5 +1,6 @@
 import logging
 import uuid
+from StringIO import StringIO
 
 from celery.result import AsyncResult
 from django.http import HttpResponse
@@ -8,6 +9,9 @@ from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
 from manage import serializers
+from manage.imports.bulk_import import stage_upload, PROGRESS_STATE
+from oclapi.search_index_queue import get_index_queue_stats
+from oclapi.exports import ExportStorageFactory, CSV_EXPORT_URL_EXPIRY
 from tasks import find_broken_references, bulk_import, bulk_priority_import
 
 logger = logging.getLogger('oclapi')
@@ -87,6 +91,10 @@ class BulkImportView(viewsets.ViewSet):
                 return HttpResponse(result.detailed_summary)
         elif task.failed():
             return Response({'exception': str(task.result)}, status=status.HTTP_400_BAD_REQUEST)
+        elif task.state == PROGRESS_STATE:
+            response = {'task': task.id, 'state': task.state}
+            response.update(task.info)
+            return Response(response)
         else:
             return Response({'task': task.id, 'state': task.state})
 
@@ -101,9 +109,37 @@ class BulkImportView(viewsets.ViewSet):
         else:
             return Response({'exception': 'update_if_exists must be either \'true\' or \'false\''}, status=status.HTTP_400_BAD_REQUEST)
 
+        # Only a handle to the staged upload is queued, the worker streams the file from GridFS
+        upload_id = stage_upload(request.stream or StringIO(), username)
         if username == 'root':
-            task = bulk_priority_import.apply_async((request.body, username, update_if_exists), task_id=str(uuid.uuid4()) + '-' + username)
+            task = bulk_priority_import.apply_async((upload_id, username, update_if_exists), task_id=str(uuid.uuid4()) + '-' + username)
         else:
-            task = bulk_import.apply_async((request.body, username, update_if_exists), task_id=str(uuid.uuid4()) + '-' + username)
+            task = bulk_import.apply_async((upload_id, username, update_if_exists), task_id=str(uuid.uuid4()) + '-' + username)
 
-        return Response({'task': task.id, 'state': task.state})
\ No newline at end of file
+        return Response({'task': task.id, 'state': task.state})
+
+
+class CSVExportView(viewsets.ViewSet):
+    """ Reports the state of a CSV export queued by a list view, and the URL of the CSV once written """
+
+    def list(self, request):
+        task = AsyncResult(request.GET.get('task'))
+
+        if task.successful():
+            url = ExportStorageFactory.get_export_storage().get_url(task.get(), CSV_EXPORT_URL_EXPIRY)
+            return Response({'task': task.id, 'state': task.state, 'url': url})
+        elif task.failed():
+            return Response({'exception': str(task.result)}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            return Response({'task': task.id, 'state': task.state})
+
+
+class IndexQueueView(viewsets.ViewSet):
+    """ Reports the number of queued search index updates and the seconds the oldest one has been waiting """
+
+    def initial(self, request, *args, **kwargs):
+        self.permission_classes = (IsAdminUser, )
+        super(IndexQueueView, self).initial(request, *args, **kwargs)
+
+    def list(self, request):
+        return Response(get_index_queue_stats())
@@ -4,14 +4,16 @@ import logging
 
 import haystack
 from datetime import datetime
+from itertools import islice
 from django.core.management import CommandError
 from django.db.models import Q
-from haystack.management.commands import update_index
 
 from mappings.models import Mapping
 from concepts.models import Concept
 from mappings.serializers import MappingCreateSerializer, MappingUpdateSerializer
 from oclapi.management.commands import MockRequest, ImportActionHelper
+from oclapi.management.import_checkpoints import ImportCheckpointer
+from oclapi.utils import LRUCache, SavedIdsRecorder, compact, update_ids_in_index
 from sources.models import Source, SourceVersion
 
 from mappings.models import MappingVersion
@@ -19,6 +21,18 @@ from mappings.models import MappingVersion
 __author__ = 'misternando,paynejd'
 logger = logging.getLogger('batch')
 
+# Number of lines whose concept and source URLs are resolved together before the lines are imported
+PREFETCH_WINDOW = 1000
+# Number of URLs per query when resolving them
+URI_QUERY_SIZE = 500
+# A window references at most two concepts per line, so the caches hold several windows
+CONCEPTS_CACHE_SIZE = 20000
+SOURCES_CACHE_SIZE = 1000
+# Number of mappings deactivated per update when deactivating old records
+DEACTIVATION_QUERY_SIZE = 10000
+# Number of processes pushing the mapping versions touched by an import to the search index
+INDEX_WORKERS = 4
+
 
 class IllegalInputException(Exception):
     """ Exception for invalid JSON read from input file """
@@ -36,8 +50,8 @@ class MappingsImporter(object):
     def __init__(self, source, mappings_file, output_stream, error_stream, user):
         """ Initialize mapping importer """
         self.source = source
-        self.sources_cache = {}
-        self.concepts_cache = {}
+        self.sources_cache = LRUCache(SOURCES_CACHE_SIZE)
+        self.concepts_cache = LRUCache(CONCEPTS_CACHE_SIZE)
         self.mappings_file = mappings_file
         self.stdout = output_stream
         self.stderr = error_stream
@@ -45,41 +59,57 @@ class MappingsImporter(object):
         self.count = 0
         self.test_mode = False
         self.action_count = {}
+        self.checkpointer = None
+        # Mapping versions created or changed by the import, the only ones to index afterwards
+        self.touched_versions = SavedIdsRecorder(MappingVersion)
 
-    def import_mappings(self, new_version=False, total=0, test_mode=False, deactivate_old_records=False, **kwargs):
+    def import_mappings(self, new_version=False, total=0, test_mode=False, deactivate_old_records=False,
+                        skip_index=False, file_hash=None, resume=False, **kwargs):
         initial_signal_processor = haystack.signal_processor
         try:
             haystack.signal_processor.teardown()
             haystack.signal_processor = haystack.signals.BaseSignalProcessor
+            self.touched_versions.start()
             import_start_time = datetime.now()
             logger.info('Started import at {}'.format(import_start_time.strftime("%Y-%m-%dT%H:%M:%S")))
 
             """ Main mapping importer loop """
             logger.info('Import mappings to source...')
             self.test_mode = test_mode
+            if file_hash and not test_mode:
+                self.checkpointer = ImportCheckpointer('mappings', self.source, file_hash)
+            checkpoint = self.checkpointer.load() if self.checkpointer and resume else None
 
-            # Retrieve latest source version and, if specified, create a new one
-            self.source_version = SourceVersion.get_head_of(self.source)
-            if new_version:
-                try:
-                    new_version = SourceVersion.for_base_object(
-                        self.source, new_version, previous_version=self.source_version)
-                    new_version.full_clean()
-                    new_version.save()
-                    new_version.seed_concepts()
-                    new_version.seed_mappings()
-
-                    self.source_version = new_version
-                except Exception as exc:
-                    raise CommandError('Failed to create new source version due to %s' % exc.args[0])
+            if checkpoint:
+                self.resume_from_checkpoint(checkpoint)
+            else:
+                # Retrieve latest source version and, if specified, create a new one
+                self.source_version = SourceVersion.get_head_of(self.source)
+                if new_version:
+                    try:
+                        new_version = SourceVersion.for_base_object(
+                            self.source, new_version, previous_version=self.source_version)
+                        new_version.full_clean()
+                        new_version.save()
+                        new_version.seed_concepts()
+                        new_version.seed_mappings()
+
+                        self.source_version = new_version
+                    except Exception as exc:
+                        raise CommandError('Failed to create new source version due to %s' % exc.args[0])
+
+                self.mapping_ids = set(self.source_version.get_mapping_ids())
+                self.count = 0
+                if self.checkpointer:
+                    self.checkpointer.start(self.source_version, self.mapping_ids, import_start_time)
 
             # Load the JSON file line by line and import each line
-            self.mapping_ids = set(self.source_version.get_mapping_ids())
-            self.count = 0
-            for line in self.mappings_file:
+            offset = checkpoint.offset if checkpoint else 0
+            for line in self.prefetching_lines():
 
                 # Load the next JSON line
                 self.count += 1
+                offset += len(line)
                 data = None
                 try:
                     data = json.loads(line)
@@ -104,6 +134,7 @@ class MappingsImporter(object):
                         self.stderr.write(str_log)
                         logger.warning(str_log)
                         self.count_action(ImportActionHelper.IMPORT_ACTION_SKIP)
+                self.save_checkpoint(offset)
 
                 # Simple progress bars
                 if (self.count % 10) == 0:
@@ -124,56 +155,109 @@ class MappingsImporter(object):
             self.stdout.flush()
             logger.info(str_log)
 
-            # Log remaining unhandled IDs
-            str_log = 'Remaining %s unhandled mapping IDs\n' % len(self.mapping_ids)
-            self.stdout.write(str_log)
-            self.stdout.flush()
-            logger.info(str_log)
+            self.save_checkpoint(offset, force=True)
+            self.output_unhandled_mapping_ids()
+            self.handle_deactivation_of_old_records(deactivate_old_records)
+            self.output_summary(self.count, total)
+            if self.checkpointer:
+                self.checkpointer.finish()
 
-            # Deactivate old records
-            if deactivate_old_records:
-                str_log = 'Deactivating old mappings...\n'
-                self.stdout.write(str_log)
-                logger.info(str_log)
-                for mapping_id in self.mapping_ids:
-                    try:
-                        if self.remove_mapping(mapping_id):
-                            self.count_action(ImportActionHelper.IMPORT_ACTION_DEACTIVATE)
+            if not skip_index:
+                self.update_index_if_required()
+        finally:
+            self.touched_versions.stop()
+            haystack.signal_processor = initial_signal_processor
+            haystack.signal_processor.setup()
 
-                            # Log the mapping deactivation
-                            str_log = 'Deactivated mapping: %s\n' % mapping_id
-                            self.stdout.write(str_log)
-                            logger.info(str_log)
+    def resume_from_checkpoint(self, checkpoint):
+        self.source_version = SourceVersion.objects.get(id=checkpoint.source_version_id)
+        self.mapping_ids = self.checkpointer.resume(checkpoint)
+        # Versions changed by the failed run have to be indexed as well, they are already part of the checkpoint
+        self.touched_versions.add(self.checkpointer.touched_ids)
+        self.touched_versions.pop_recent_ids()
+        self.action_count = checkpoint.get_action_count()
+        self.count = checkpoint.lines_handled
+        self.mappings_file.seek(checkpoint.offset)
+        str_log = 'Resuming import after line %s of the previous run...\n' % checkpoint.lines_handled
+        self.stdout.write(str_log)
+        logger.info(str_log)
+
+    def save_checkpoint(self, offset, force=False):
+        touched_ids = self.touched_versions.pop_recent_ids()
+        if self.checkpointer:
+            self.checkpointer.add_touched_ids(touched_ids)
+            self.checkpointer.save(offset, self.count, self.action_count, force=force)
+
+    def get_import_summary(self):
+        """ Returns what a partition worker reports back to the process that merges the import """
+        return {
+            'lines_handled': self.count,
+            'action_count': self.action_count,
+            'unhandled_ids': list(self.mapping_ids),
+            'touched_ids': list(self.touched_versions.ids),
+        }
+
+    def finish_partitioned_import(self, lines_handled, total, action_count, unhandled_ids, touched_ids,
+                                  test_mode=False, deactivate_old_records=False):
+        """
+        Completes an import whose partitions were imported by separate worker processes: deactivates the mappings
+        that no worker handled, displays the merged summary and indexes the versions touched by the workers once.
+        """
+        initial_signal_processor = haystack.signal_processor
+        try:
+            haystack.signal_processor.teardown()
+            haystack.signal_processor = haystack.signals.BaseSignalProcessor
+            self.touched_versions.start()
+            self.touched_versions.add(touched_ids)
 
-                    except InvalidStateException as exc:
-                        str_log = 'Failed to inactivate mapping on ID %s! %s\n' % (mapping_id, exc.args[0])
-                        self.stderr.write(str_log)
-                        logger.warning(str_log)
-            else:
-                str_log = 'Skipping deactivation loop...\n'
-                self.stdout.write(str_log)
-                logger.info(str_log)
+            self.action_count = action_count
+            self.test_mode = test_mode
+            self.mapping_ids = unhandled_ids
+            self.output_unhandled_mapping_ids()
+            self.handle_deactivation_of_old_records(deactivate_old_records)
+            self.output_summary(lines_handled, total)
+            self.update_index_if_required()
+        finally:
+            self.touched_versions.stop()
+            haystack.signal_processor = initial_signal_processor
+            haystack.signal_processor.setup()
 
-            # Display final summary
-            str_log = 'Finished importing mappings!\n'
+    def output_unhandled_mapping_ids(self):
+        # Log remaining unhandled IDs
+        str_log = 'Remaining %s unhandled mapping IDs\n' % len(self.mapping_ids)
+        self.stdout.write(str_log)
+        self.stdout.flush()
+        logger.info(str_log)
+
+    def handle_deactivation_of_old_records(self, deactivate_old_records):
+        # Deactivate old records
+        if deactivate_old_records:
+            str_log = 'Deactivating old mappings...\n'
             self.stdout.write(str_log)
             logger.info(str_log)
-            str_log = ImportActionHelper.get_progress_descriptor(
-                'mappings', self.count, total, self.action_count)
-            self.stdout.write(str_log, ending='\r')
+            mapping_version_ids = list(self.mapping_ids)
+            for start in range(0, len(mapping_version_ids), DEACTIVATION_QUERY_SIZE):
+                self.deactivate_mappings(mapping_version_ids[start:start + DEACTIVATION_QUERY_SIZE])
+        else:
+            str_log = 'Skipping deactivation loop...\n'
+            self.stdout.write(str_log)
             logger.info(str_log)
 
-            actions = self.action_count
-            update_index_required = actions.get(ImportActionHelper.IMPORT_ACTION_ADD, 0) > 0
-            update_index_required |= actions.get(ImportActionHelper.IMPORT_ACTION_UPDATE, 0) > 0
-
-            if update_index_required:
-                logger.info('Indexing objects updated since {}'.format(import_start_time.strftime("%Y-%m-%dT%H:%M:%S")))
-                update_index.Command().handle(start_date=import_start_time.strftime("%Y-%m-%dT%H:%M:%S"), verbosity=2,
-                                              workers=4, batchsize=100)
-        finally:
-            haystack.signal_processor = initial_signal_processor
-            haystack.signal_processor.setup()
+    def output_summary(self, lines_handled, total):
+        # Display final summary
+        str_log = 'Finished importing mappings!\n'
+        self.stdout.write(str_log)
+        logger.info(str_log)
+        str_log = ImportActionHelper.get_progress_descriptor(
+            'mappings', lines_handled, total, self.action_count)
+        self.stdout.write(str_log, ending='\r')
+        logger.info(str_log)
+
+    def update_index_if_required(self):
+        touched_ids = self.touched_versions.ids
+        if touched_ids:
+            logger.info('Indexing %s created or changed mapping versions' % len(touched_ids))
+            update_ids_in_index(MappingVersion, touched_ids, workers=INDEX_WORKERS)
 
     def handle_mapping(self, data):
         """ Handle importing of a single mapping """
@@ -227,12 +311,22 @@ class MappingsImporter(object):
             mapping_version = MappingVersion.objects.get(versioned_object_id=mapping.id, is_latest_version=True)
 
             # Finish updating the mapping
-            update_action = self.update_mapping(mapping, data)
+            update_action = self.update_mapping(mapping, data, mapping_version)
 
             # Remove ID from the mapping list so that we know that mapping has been handled
-            try:
-                self.mapping_ids.remove(mapping_version.id)
-            except KeyError:
+            handled_id = mapping_version.id
+            replayed_ids = []
+            if handled_id not in self.mapping_ids and self.checkpointer:
+                # A resumed import finds the versions created by the failed run after its last checkpoint
+                replayed_ids, handled_id = self.checkpointer.find_replayed_versions(mapping_version, self.mapping_ids)
+                self.touched_versions.add(replayed_ids)
+            if handled_id in self.mapping_ids:
+                self.mapping_ids.remove(handled_id)
+                if replayed_ids:
+                    self.touched_versions.add([handled_id])
+                if self.checkpointer:
+                    self.checkpointer.add_handled_id(handled_id)
+            elif not replayed_ids:
                 str_log = 'Key not found. Could not remove key %s from list of mapping IDs: %s\n' % (mapping.id, data)
                 self.stderr.write(str_log)
                 logger.warning(str_log)
@@ -272,9 +366,14 @@ class MappingsImporter(object):
 
         return ImportActionHelper.IMPORT_ACTION_ADD
 
-    def update_mapping(self, mapping, data):
+    def update_mapping(self, mapping, data, mapping_version=None):
         """ Update an existing mapping """
 
+        # Unchanged mappings are skipped without building a serializer
+        if mapping_version and mapping_version.content_hash and \
+                mapping_version.content_hash == MappingVersion.get_payload_content_hash(data):
+            return ImportActionHelper.IMPORT_ACTION_NONE
+
         # Generate the diff
         diffs = {}
         if 'retired' in data and mapping.retired != data['retired']:
@@ -305,21 +404,34 @@ class MappingsImporter(object):
         # No diff, so do nothing
         return ImportActionHelper.IMPORT_ACTION_NONE
 
-    def remove_mapping(self, mapping_id):
-        """ Deactivates a mapping """
-        try:
-            mapping_version = MappingVersion.objects.get(id=mapping_id)
-            mapping = Mapping.objects.get(id = mapping_version.versioned_object_id)
-            if mapping.is_active:
-                if not self.test_mode:
-                    mapping.is_active = False
-                    mapping.save()
-                return ImportActionHelper.IMPORT_ACTION_DEACTIVATE
-            else:
-                return ImportActionHelper.IMPORT_ACTION_NONE
-        except:
-            raise InvalidStateException(
-                "Cannot deactivate mapping %s because it doesn't exist!" % mapping_id)
+    def deactivate_mappings(self, mapping_version_ids):
+        """ Deactivates the mappings of a block of mapping versions with a single update and reports each id """
+        mapping_ids = dict(MappingVersion.objects.filter(
+            id__in=mapping_version_ids).values_list('id', 'versioned_object_id'))
+        is_active = dict(Mapping.objects.filter(
+            id__in=list(set(mapping_ids.values()))).values_list('id', 'is_active'))
+        active_ids = [mapping_id for (mapping_id, active) in is_active.items() if active]
+        if active_ids and not self.test_mode:
+            Mapping.objects.filter(id__in=active_ids).update(is_active=False, updated_at=datetime.now())
+
+        deactivated_ids = set()
+        for mapping_version_id in mapping_version_ids:
+            mapping_id = mapping_ids.get(mapping_version_id)
+            if mapping_id not in is_active:
+                str_log = 'Failed to inactivate mapping on ID %s! Cannot deactivate mapping %s because it doesn\'t exist!\n' % (
+                    mapping_version_id, mapping_version_id)
+                self.stderr.write(str_log)
+                logger.warning(str_log)
+                continue
+            if not is_active[mapping_id] or mapping_id in deactivated_ids:
+                continue
+            deactivated_ids.add(mapping_id)
+            self.count_action(ImportActionHelper.IMPORT_ACTION_DEACTIVATE)
+
+            # Log the mapping deactivation
+            str_log = 'Deactivated mapping: %s\n' % mapping_version_id
+            self.stdout.write(str_log)
+            logger.info(str_log)
 
     def count_action(self, update_action):
         """ Increments the counter for the specified action """
@@ -327,16 +439,52 @@ class MappingsImporter(object):
             self.action_count[update_action] += 1
         else:
             self.action_count[update_action] = 1
+    def prefetching_lines(self):
+        """ Yields the lines of the input file, resolving the URLs referenced by each window of lines up front """
+        while True:
+            window = list(islice(self.mappings_file, PREFETCH_WINDOW))
+            if not window:
+                return
+            self.prefetch_references(window)
+            for line in window:
+                yield line
+
+    def prefetch_references(self, lines):
+        concept_urls = set()
+        source_urls = set()
+        for line in lines:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(data, dict):
+                continue
+            concept_urls.update(compact([data.get('from_concept_url'), data.get('to_concept_url')]))
+            source_urls.update(compact([data.get('to_source_url')]))
+        self.resolve_uris(Concept, self.concepts_cache, concept_urls)
+        self.resolve_uris(Source, self.sources_cache, source_urls)
+
+    def resolve_uris(self, model, cache, uris):
+        """ Loads the uris missing from cache with batched queries, caching uris that do not exist as None """
+        uris = [uri for uri in uris if uri not in cache]
+        for start in range(0, len(uris), URI_QUERY_SIZE):
+            chunk = uris[start:start + URI_QUERY_SIZE]
+            resolved = dict((obj.uri, obj) for obj in model.objects.filter(uri__in=chunk))
+            for uri in chunk:
+                cache[uri] = resolved.get(uri)
+
     def get_concept(self, concept_url):
+        if concept_url not in self.concepts_cache:
+            self.resolve_uris(Concept, self.concepts_cache, [concept_url])
         result = self.concepts_cache.get(concept_url)
-        if not result:
-            result = Concept.objects.get(uri=concept_url)
-            self.concepts_cache[concept_url] = result
+        if result is None:
+            raise Concept.DoesNotExist('Concept %s does not exist' % concept_url)
         return result
+
     def get_source(self, source_url):
+        if source_url not in self.sources_cache:
+            self.resolve_uris(Source, self.sources_cache, [source_url])
         result = self.sources_cache.get(source_url)
-        if not result:
-            result = Source.objects.get(uri=source_url)
-
-            self.sources_cache[source_url] = result
-        return result
\ No newline at end of file
+        if result is None:
+            raise Source.DoesNotExist('Source %s does not exist' % source_url)
+        return result
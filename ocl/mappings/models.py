@@ -1,3 +1,5 @@
+import copy
+
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.db import models
@@ -6,9 +8,10 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django_mongodb_engine.contrib import MongoDBManager
 
-from concepts.models import Concept
+from concepts.models import Concept, text_fingerprint
 from mappings.mixins import MappingValidationMixin
 from oclapi.models import BaseModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, ResourceVersionModel
+from oclapi.utils import compute_content_hash
 from sources.models import Source, SourceVersion
 from djangotoolbox.fields import SetField
 
@@ -28,6 +31,7 @@ class Mapping(MappingValidationMixin, BaseModel):
 
     class MongoMeta:
         indexes = [[('parent', 1), ('from_concept', 1)],
+                   [('from_concept', 1)],
                    [('parent'), ('to_concept', 1)],
                    [('parent', 1), ('retired', 1), ('is_active', 1)],
                    [('uri', 1)]]
@@ -322,6 +326,38 @@ class Mapping(MappingValidationMixin, BaseModel):
 
         return diffs
 
+    @classmethod
+    def get_mappings_from_concepts(cls, concepts, sources):
+        """
+        Returns the mappings from the concepts in the concepts dict, loaded with one query, by the id of the concept
+        they map from. Their concepts and sources are attached from concepts and the sources dict, loading those
+        missing with a query each, so that formatting the mappings does not resolve the same ones for every mapping.
+        """
+        mappings = list(cls.objects.filter(from_concept_id__in=concepts.keys()))
+        to_concepts = dict(concepts)
+        missing_ids = set(mapping.to_concept_id for mapping in mappings if mapping.to_concept_id) - set(concepts)
+        if missing_ids:
+            to_concepts.update((concept.id, concept) for concept in Concept.objects.filter(id__in=list(missing_ids)))
+
+        source_ids = [concept.parent_id for concept in to_concepts.values()]
+        source_ids += [mapping.parent_id for mapping in mappings] + [mapping.to_source_id for mapping in mappings]
+        Source.add_to_cache(sources, source_ids)
+        for concept in to_concepts.values():
+            if concept.parent_id in sources:
+                concept.parent = sources[concept.parent_id]
+
+        mappings_by_concept = {}
+        for mapping in mappings:
+            mapping.from_concept = concepts[mapping.from_concept_id]
+            if mapping.to_concept_id in to_concepts:
+                mapping.to_concept = to_concepts[mapping.to_concept_id]
+            if mapping.parent_id in sources:
+                mapping.parent = sources[mapping.parent_id]
+            if mapping.to_source_id in sources:
+                mapping.to_source = sources[mapping.to_source_id]
+            mappings_by_concept.setdefault(mapping.from_concept_id, []).append(mapping)
+        return mappings_by_concept
+
 
 class MappingVersion(MappingValidationMixin, ResourceVersionModel):
     parent = models.ForeignKey(Source, related_name='mappings_version_from')
@@ -336,6 +372,7 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
     is_latest_version = models.BooleanField(default=True)
     update_comment = models.TextField(null=True, blank=True)
     source_version_ids = SetField()
+    content_hash = models.TextField(null=True, blank=True)
 
     objects = MongoDBManager()
 
@@ -349,6 +386,49 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
                    [('previous_version', 1)],
                    [('uri', 1)]]
 
+    def save(self, *args, **kwargs):
+        self.content_hash = self.get_content_hash()
+        super(MappingVersion, self).save(*args, **kwargs)
+
+    def get_content_hash(self):
+        extras = copy.deepcopy(self.extras)
+        if self.extras_have_been_encoded:
+            self.decode_extras(extras)
+        return MappingVersion.compute_content_hash(
+            self.map_type, self.from_concept_id, self.to_concept_id, self.to_source_id, self.to_concept_code,
+            self.to_concept_name, self.external_id, self.retired, extras)
+
+    @classmethod
+    def get_payload_content_hash(cls, data):
+        """
+        Returns the content hash of the version that would result from the mapping JSON in data, with from_concept,
+        to_concept and to_source already resolved to model instances, or None if data cannot be fingerprinted.
+        Missing keys are hashed as field defaults, so equal hashes always mean no change.
+        """
+        retired = data.get('retired', False)
+        if not isinstance(retired, bool):
+            return None
+        return cls.compute_content_hash(
+            data.get('map_type'), getattr(data.get('from_concept'), 'id', None),
+            getattr(data.get('to_concept'), 'id', None), getattr(data.get('to_source'), 'id', None),
+            data.get('to_concept_code'), data.get('to_concept_name'), data.get('external_id'), retired,
+            data.get('extras'))
+
+    @classmethod
+    def compute_content_hash(cls, map_type, from_concept_id, to_concept_id, to_source_id, to_concept_code,
+                             to_concept_name, external_id, retired, extras):
+        return compute_content_hash({
+            'map_type': text_fingerprint(map_type),
+            'from_concept_id': text_fingerprint(from_concept_id),
+            'to_concept_id': text_fingerprint(to_concept_id),
+            'to_source_id': text_fingerprint(to_source_id),
+            'to_concept_code': text_fingerprint(to_concept_code),
+            'to_concept_name': text_fingerprint(to_concept_name),
+            'external_id': text_fingerprint(external_id),
+            'retired': bool(retired),
+            'extras': extras or {},
+        })
+
     def clone(self):
         return MappingVersion(
             mnemonic='--TEMP--',
@@ -486,10 +566,47 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
     def resource_type():
         return MAPPING_VERSION_RESOURCE_TYPE
 
+    @classmethod
+    def resolve_export_relations(cls, versions, sources):
+        """
+        Attaches their mappings and concepts, loaded with one query each, to versions and their sources from the
+        sources dict, so that serializing the versions does not resolve the same sources and owners for every mapping.
+        """
+        mappings = dict((mapping.id, mapping) for mapping in Mapping.objects.filter(
+            id__in=list(set(version.versioned_object_id for version in versions))))
+        concept_ids = set(version.from_concept_id for version in versions)
+        concept_ids.update(version.to_concept_id for version in versions if version.to_concept_id)
+        concepts = dict((concept.id, concept) for concept in Concept.objects.filter(id__in=list(concept_ids)))
+
+        source_ids = [concept.parent_id for concept in concepts.values()]
+        source_ids += [version.parent_id for version in versions] + [version.to_source_id for version in versions]
+        Source.add_to_cache(sources, source_ids)
+        for concept in concepts.values():
+            if concept.parent_id in sources:
+                concept.parent = sources[concept.parent_id]
+
+        for version in versions:
+            if version.versioned_object_id in mappings:
+                version.versioned_object = mappings[version.versioned_object_id]
+            if version.parent_id in sources:
+                version.parent = sources[version.parent_id]
+            if version.from_concept_id in concepts:
+                version.from_concept = concepts[version.from_concept_id]
+            if version.to_concept_id in concepts:
+                version.to_concept = concepts[version.to_concept_id]
+            if version.to_source_id in sources:
+                version.to_source = sources[version.to_source_id]
+
     def get_collection_versions(self):
         from collection.models import CollectionVersion
         return CollectionVersion.get_collection_versions_with_mapping(self.id)
 
+    @classmethod
+    def get_collection_memberships(cls, ids):
+        """ Returns (mapping version id, collection version id) pairs of the collection versions containing ids """
+        from collection.models import CollectionMapping
+        return CollectionMapping.objects.filter(mapping_id__in=ids).values_list('mapping_id', 'collection_id')
+
     @staticmethod
     def get_url_kwarg():
         return 'mapping_version'
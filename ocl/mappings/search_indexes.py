@@ -38,6 +38,12 @@ class MappingVersionIndex(OCLSearchIndex, indexes.Indexable):
     def get_model(self):
         return MappingVersion
 
+    def prepare_batch(self, objs):
+        versions = super(MappingVersionIndex, self).prepare_batch(objs)
+        MappingVersion.resolve_export_relations(versions, {})
+        MappingVersion.resolve_collection_ids(versions)
+        return versions
+
     def prepare(self, obj):
         self.prepared_data = super(MappingVersionIndex, self).prepare(obj)
         self.prepared_data['fromConcept'] = [obj.from_concept_url, obj.from_concept_code, obj.from_concept_name]
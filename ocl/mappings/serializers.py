@@ -126,6 +126,20 @@ class MappingVersionDetailSerializer(MappingVersionBaseSerializer):
     versioned_object_url = serializers.CharField(source='to_mapping_url')
 
 
+class MappingVersionExportSerializer(MappingVersionDetailSerializer):
+    """
+    Serializes mapping versions exactly like MappingVersionDetailSerializer. Before serializing many versions it
+    resolves their mappings and concepts in bulk and takes sources and owners from context['export_sources'], a
+    dict shared by all batches of an export.
+    """
+
+    def __init__(self, instance=None, *args, **kwargs):
+        if instance is not None and kwargs.get('many'):
+            instance = list(instance)
+            MappingVersion.resolve_export_relations(instance, kwargs.get('context', {}).get('export_sources', {}))
+        super(MappingVersionExportSerializer, self).__init__(instance, *args, **kwargs)
+
+
 class MappingListSerializer(MappingBaseSerializer):
     external_id = serializers.CharField(required=False)
     retired = serializers.BooleanField(required=False)
@@ -14,6 +14,7 @@ from django.test import Client
 from django.test.client import MULTIPART_CONTENT, FakePayload
 from django.utils.encoding import force_str
 
+from mappings.serializers import MappingVersionDetailSerializer, MappingVersionExportSerializer
 from mappings.validation_messages import OPENMRS_SINGLE_MAPPING_BETWEEN_TWO_CONCEPTS, OPENMRS_INVALID_MAPTYPE
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
 from oclapi.utils import add_user_to_org
@@ -438,6 +439,34 @@ class MappingTest(MappingBaseTest):
 
 class MappingVersionTest(MappingVersionBaseTest):
 
+    def test_export_serializer_matches_detail_serializer(self):
+        mapping_version = MappingVersion.for_mapping(self.mapping1)
+        mapping_version.mnemonic = 'tempid'
+        mapping_version.save()
+
+        versions = MappingVersion.objects.filter(versioned_object_id=self.mapping1.id)
+        export_data = MappingVersionExportSerializer(versions, many=True, context={'export_sources': {}}).data
+
+        self.assertEquals(1, len(export_data))
+        self.assertEquals(MappingVersionDetailSerializer(versions, many=True).data, export_data)
+
+    def test_content_hash_matches_payload_hash(self):
+        mapping_version = MappingVersion.for_mapping(self.mapping1)
+        mapping_version.mnemonic = 'tempid'
+        mapping_version.save()
+        self.assertIsNotNone(mapping_version.content_hash)
+
+        data = {
+            'map_type': 'Same As',
+            'from_concept': self.concept1,
+            'to_concept': self.concept2,
+            'external_id': 'versionmapping1',
+        }
+        self.assertEquals(mapping_version.content_hash, MappingVersion.get_payload_content_hash(data))
+
+        data['retired'] = True
+        self.assertNotEquals(mapping_version.content_hash, MappingVersion.get_payload_content_hash(data))
+
     def test_create_mapping_positive(self):
         mapping_version = MappingVersion(
             created_by=self.user1,
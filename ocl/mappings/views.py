@@ -52,6 +52,7 @@ class MappingBaseView(ConceptDictionaryMixin):
         return queryset
 
 class MappingVersionCsvMixin:
+    csv_format = 'mapping_versions'
 
     def get_csv_rows(self, queryset=None):
         if not queryset:
@@ -186,13 +187,26 @@ class MappingVersionsListView(MappingVersionMixin, VersionedResourceChildMixin,
 
     def get_queryset(self):
         queryset = super(MappingVersionsListView, self).get_queryset()
+        (filters, excludes) = self.get_version_filters()
+        queryset = queryset.filter(**filters)
+        if excludes:
+            queryset = queryset.exclude(**excludes)
+        return queryset
 
-        queryset = queryset.filter(is_active=True)
-        if not self.include_retired:
-            queryset = queryset.filter(~Q(retired=True))
+    def get_version_filters(self):
+        """ Returns the filter and exclude kwargs selecting the versions listed among the children """
+        filters = {'is_active': True}
         if self.updated_since:
-            queryset = queryset.filter(updated_at__gte=self.updated_since)
-        return queryset
+            filters['updated_at__gte'] = self.updated_since
+        excludes = {} if self.include_retired else {'retired': True}
+        return filters, excludes
+
+    def get_csv_query(self):
+        (filters, excludes) = self.get_version_filters()
+        filters.update(self.get_child_filters())
+        if self.updated_since:
+            filters['updated_at__gte'] = self.updated_since.isoformat()
+        return self.model, filters, excludes
 
     def get_owner(self):
         owner = None
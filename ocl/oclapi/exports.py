@@ -0,0 +1,784 @@
+"""
+Export files of source and collection versions and CSV downloads, and the storage they are written to.
+"""
+import csv
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+from cStringIO import StringIO
+
+import billiard
+from boto.s3.key import Key
+from django.conf import settings
+from django.utils.text import compress_string
+from rest_framework.utils import encoders
+
+from oclapi.utils import S3ConnectionFactory, get_class, close_db_connections, iterate_by_id
+
+# Number of concept or mapping versions serialized at a time when writing an export
+EXPORT_BATCH_SIZE = 1000
+# Number of objects fetched and formatted at a time when writing a CSV export
+CSV_BATCH_SIZE = 1000
+# Seconds the URL of a CSV export stays valid
+CSV_EXPORT_URL_EXPIRY = 600
+# Views formatting the rows of CSV exports by the get_csv_rows of a batch, by the format name the export task is given
+CSV_FORMATTERS = {
+    'concept_versions': 'concepts.views.ConceptVersionListAllView',
+    'mapping_versions': 'mappings.views.MappingListAllView',
+    'sources': 'sources.views.SourceListView',
+    'collections': 'collection.views.CollectionListView',
+}
+# Formats of export artifacts, a zip holding one JSON document or gzipped JSON lines
+EXPORT_FORMAT_JSON = 'json'
+EXPORT_FORMAT_NDJSON = 'ndjson'
+EXPORT_FORMATS = (EXPORT_FORMAT_JSON, EXPORT_FORMAT_NDJSON)
+# Children of an export, with the types used to load and serialize them
+EXPORT_CHILD_TYPES = (
+    ('concepts', 'concepts.models.ConceptVersion', 'concepts.serializers.ConceptVersionExportSerializer'),
+    ('mappings', 'mappings.models.MappingVersion', 'mappings.serializers.MappingVersionExportSerializer'),
+)
+# Changes listed for each child type in a delta export
+DELTA_EXPORT_CHANGES = ('added', 'replaced', 'removed')
+# Average number of concept or mapping versions per chunk of a chunked export, at most 4 times as many
+EXPORT_CHUNK_AVERAGE_SIZE = 1000
+EXPORT_CHUNK_MAX_SIZE = 4 * EXPORT_CHUNK_AVERAGE_SIZE
+# Chunks are shared by the exports of all versions, so one identical to an earlier chunk is stored once
+EXPORT_CHUNKS_PATH = 'chunks'
+# Seconds the chunk URLs listed by an export manifest stay valid
+EXPORT_CHUNK_URL_EXPIRY = 600
+# Size of the parts of an export upload, S3 requires at least 5MB for all parts but the last
+EXPORT_UPLOAD_PART_SIZE = 5 * 1024 * 1024
+# Largest part copied by S3 at a time when an export reuses an earlier one, S3 allows up to 5GB
+EXPORT_COPY_PART_SIZE = 1024 * 1024 * 1024
+# General purpose flag of a zip entry whose checksum and sizes follow its data
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+
+
+class ExportStorageFactory:
+    export_storage = None
+
+    @classmethod
+    def get_export_storage(cls):
+        if not cls.export_storage:
+            cls.export_storage = get_class(settings.EXPORT_STORAGE)()
+        return cls.export_storage
+
+
+class ExportStorage(object):
+    """
+    Stores export files by path. Each file written is recorded as an ExportArtifact, so exists is answered by the
+    database; a file stored before it was recorded is looked up in the backend once and recorded then.
+
+    Backends implement get_stored_size, read, read_range, write_stored, open_stored_upload, delete_stored and
+    get_url, and may implement get_sendfile_path to have the web server send files.
+    """
+
+    def exists(self, path):
+        from oclapi.models import ExportArtifact
+        if ExportArtifact.objects.filter(path=path).exists():
+            return True
+        size = self.get_stored_size(path)
+        if size is None:
+            return False
+        self.record(path, size)
+        return True
+
+    def write(self, path, data, content_type=None, content_encoding=None, last_child_update=None):
+        self.write_stored(path, data, content_type, content_encoding)
+        self.record(path, len(data), last_child_update)
+
+    def open_upload(self, path, content_type=None, last_child_update=None):
+        """ Returns a file-like object storing what is written to it at path once closed, or nothing if cancelled """
+        return RecordedUpload(self, path, self.open_stored_upload(path, content_type), last_child_update)
+
+    def get_last_child_update(self, path):
+        """ Returns the last_child_update recorded for the file at path, or None """
+        from oclapi.models import ExportArtifact
+        updates = ExportArtifact.objects.filter(path=path).values_list('last_child_update', flat=True)[:1]
+        return updates[0] if updates else None
+
+    def delete(self, path):
+        from oclapi.models import ExportArtifact
+        ExportArtifact.objects.filter(path=path).delete()
+        self.delete_stored(path)
+
+    def record(self, path, size, last_child_update=None):
+        from oclapi.models import ExportArtifact
+        ExportArtifact.objects.filter(path=path).delete()
+        ExportArtifact.objects.create(path=path, size=size, last_child_update=last_child_update)
+
+    def get_sendfile_path(self, path):
+        return None
+
+
+class S3ExportStorage(ExportStorage):
+    """ Stores exports in the S3 bucket AWS_STORAGE_BUCKET_NAME """
+
+    def __init__(self):
+        # Not validated, which would cost a request per process
+        self.bucket = S3ConnectionFactory.get_s3_connection().get_bucket(settings.AWS_STORAGE_BUCKET_NAME,
+                                                                         validate=False)
+
+    def get_stored_size(self, path):
+        key = self.bucket.get_key(path)
+        return key.size if key else None
+
+    def read(self, path):
+        return Key(self.bucket, path).get_contents_as_string()
+
+    def read_range(self, path, start, end):
+        return get_key_range(Key(self.bucket, path), start, end)
+
+    def write_stored(self, path, data, content_type=None, content_encoding=None):
+        headers = {}
+        if content_type:
+            headers['Content-Type'] = content_type
+        if content_encoding:
+            headers['Content-Encoding'] = content_encoding
+        Key(self.bucket, path).set_contents_from_string(data, headers=headers)
+
+    def open_stored_upload(self, path, content_type=None):
+        return S3MultipartUploadStream(self.bucket, path, content_type=content_type)
+
+    def delete_stored(self, path):
+        self.bucket.delete_key(path)
+
+    def get_url(self, path, expires_in):
+        return Key(self.bucket, path).generate_url(expires_in)
+
+
+class LocalExportStorage(ExportStorage):
+    """
+    Stores exports in the EXPORT_LOCAL_ROOT directory, which the web server publishes at EXPORT_LOCAL_URL. With
+    EXPORT_SENDFILE_HEADER set, export downloads are handed to the web server by that header instead, pointing to
+    the directory at EXPORT_SENDFILE_URL, e.g. an internal location of nginx with X-Accel-Redirect.
+    """
+
+    def __init__(self, root=None):
+        self.root = os.path.abspath(root or settings.EXPORT_LOCAL_ROOT)
+
+    def get_file_path(self, path):
+        file_path = os.path.abspath(os.path.join(self.root, path))
+        if not file_path.startswith(self.root + os.sep):
+            raise ValueError('Export path %s is outside of %s' % (path, self.root))
+        return file_path
+
+    def get_stored_size(self, path):
+        file_path = self.get_file_path(path)
+        return os.path.getsize(file_path) if os.path.isfile(file_path) else None
+
+    def read(self, path):
+        with open(self.get_file_path(path), 'rb') as export_file:
+            return export_file.read()
+
+    def read_range(self, path, start, end):
+        with open(self.get_file_path(path), 'rb') as export_file:
+            export_file.seek(start)
+            return export_file.read(end - start)
+
+    def write_stored(self, path, data, content_type=None, content_encoding=None):
+        upload = self.open_stored_upload(path)
+        upload.write(data)
+        upload.close()
+
+    def open_stored_upload(self, path, content_type=None):
+        return LocalUploadStream(self, self.get_file_path(path))
+
+    def delete_stored(self, path):
+        file_path = self.get_file_path(path)
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+
+    def get_url(self, path, expires_in):
+        return settings.EXPORT_LOCAL_URL + path
+
+    def get_sendfile_path(self, path):
+        if not settings.EXPORT_SENDFILE_HEADER:
+            return None
+        return settings.EXPORT_SENDFILE_URL + path
+
+
+class LocalUploadStream(object):
+    """ File-like object writing to a temporary file next to file_path, which close moves to file_path """
+
+    def __init__(self, storage, file_path):
+        self.storage = storage
+        self.file_path = file_path
+        directory = os.path.dirname(file_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = tempfile.NamedTemporaryFile(dir=directory, prefix='.upload', delete=False)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def copy(self, source_path, start, end):
+        """ Appends the bytes from start to end of the file stored at source_path """
+        with open(self.storage.get_file_path(source_path), 'rb') as source:
+            source.seek(start)
+            remaining = end - start
+            while remaining:
+                block = source.read(min(remaining, EXPORT_UPLOAD_PART_SIZE))
+                if not block:
+                    raise IOError('%s ends before byte %d' % (source_path, end))
+                self.file.write(block)
+                remaining -= len(block)
+
+    def close(self):
+        self.file.close()
+        os.rename(self.file.name, self.file_path)
+
+    def cancel(self):
+        self.file.close()
+        os.remove(self.file.name)
+
+
+class RecordedUpload(object):
+    """ Counts the bytes written to the upload stream of an export storage, to record the file once closed """
+
+    def __init__(self, storage, path, stream, last_child_update=None):
+        self.storage = storage
+        self.path = path
+        self.stream = stream
+        self.last_child_update = last_child_update
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.stream.write(data)
+
+    def copy(self, source_path, start, end):
+        self.size += end - start
+        self.stream.copy(source_path, start, end)
+
+    def close(self):
+        self.stream.close()
+        self.storage.record(self.path, self.size, self.last_child_update)
+
+    def cancel(self):
+        self.stream.cancel()
+
+def write_export_file(version, resource_type, resource_serializer_type, logger, export_format=EXPORT_FORMAT_JSON):
+    logger.info('Found %s version %s.  Looking up resource...' % (resource_type, version.mnemonic))
+    resource = version.versioned_object
+    logger.info('Found %s %s.  Serializing attributes...' % (resource_type, resource.mnemonic))
+
+    resource_serializer = get_class(resource_serializer_type)(version)
+    data = resource_serializer.data
+    resource_string = json.dumps(data, cls=encoders.JSONEncoder)
+    logger.info('Done serializing attributes.')
+
+    if export_format == EXPORT_FORMAT_NDJSON:
+        write_ndjson_export_file(version, resource_type, resource_string, logger)
+        return
+
+    storage = ExportStorageFactory.get_export_storage()
+    chunk_store = ExportChunkStore(storage)
+    membership = get_export_membership(version)
+    manifest = {'type': resource_type, 'resource': data, 'membership': membership}
+    (previous_export_path, previous_manifest) = find_reusable_export(version, membership)
+
+    last_child_update = version.last_child_update
+    logger.info('Streaming compressed export to %s...' % version.export_path)
+    upload = storage.open_upload(version.export_path, content_type='application/zip',
+                                 last_child_update=last_child_update)
+    try:
+        out = ZipStreamWriter(upload, 'export.json')
+        out.write(resource_string[:-1])
+        if previous_manifest:
+            logger.info('%s version %s has the same concepts and mappings as %s, copying its export...' % (
+                resource_type.title(), version.mnemonic, version.previous_version.mnemonic))
+            copyable_part = previous_manifest['copyable_part']
+            out.copy(previous_export_path, copyable_part['offset'], copyable_part['end'], copyable_part['size'],
+                     copyable_part['crc'])
+            for (child_type, model_type, serializer_type) in EXPORT_CHILD_TYPES:
+                manifest[child_type] = previous_manifest[child_type]
+        else:
+            # Everything after the attributes can be copied into the export of a later version
+            out.mark()
+            id_batches = {
+                'concepts': version.get_export_concept_id_batches(EXPORT_BATCH_SIZE),
+                'mappings': version.get_export_mapping_id_batches(EXPORT_BATCH_SIZE),
+            }
+            for (child_type, model_type, serializer_type) in EXPORT_CHILD_TYPES:
+                # The batches double as the chunks of the chunked export
+                chunk_batches = iterate_content_defined_batches(itertools.chain.from_iterable(id_batches[child_type]))
+                out.write(', "%s": [' % child_type)
+                manifest[child_type] = write_export_batches(out, chunk_batches, model_type, serializer_type,
+                                                            resource_type, child_type, logger, chunk_store=chunk_store)
+                out.write(']')
+            out.write('}')
+        out.close()
+        upload.close()
+    except:
+        upload.cancel()
+        raise
+    manifest['copyable_part'] = out.get_marked_part()
+    logger.info('Uploaded %d bytes to %s.' % (upload.size, version.export_path))
+
+    storage.write(version.export_manifest_path, json.dumps(manifest, cls=encoders.JSONEncoder),
+                  content_type='application/json', last_child_update=last_child_update)
+    logger.info('Uploaded manifest to %s, %d of its chunks were new.' % (version.export_manifest_path,
+                                                                         chunk_store.uploaded))
+
+
+def write_ndjson_export_file(version, resource_type, resource_string, logger):
+    """
+    Uploads the export of version as gzipped JSON lines: the attributes of version, then a line per concept and per
+    mapping, each tagged by its type attribute, so that the export can be read a line at a time.
+    """
+    export_path = version.get_export_path(EXPORT_FORMAT_NDJSON)
+    logger.info('Streaming gzipped NDJSON export to %s...' % export_path)
+    upload = ExportStorageFactory.get_export_storage().open_upload(
+        export_path, content_type='application/gzip', last_child_update=version.last_child_update)
+    try:
+        out = gzip.GzipFile(filename='export.ndjson', mode='wb', fileobj=upload)
+        out.write(resource_string + '\n')
+        id_batches = {
+            'concepts': version.get_export_concept_id_batches(EXPORT_BATCH_SIZE),
+            'mappings': version.get_export_mapping_id_batches(EXPORT_BATCH_SIZE),
+        }
+        for (child_type, model_type, serializer_type) in EXPORT_CHILD_TYPES:
+            write_export_batches(out, id_batches[child_type], model_type, serializer_type, resource_type, child_type,
+                                 logger, line_delimited=True)
+        out.close()
+        upload.close()
+    except:
+        upload.cancel()
+        raise
+    logger.info('Uploaded %d bytes to %s.' % (upload.size, export_path))
+
+
+def get_export_membership(version):
+    """ Returns the numbers of concept and mapping versions in the export of version and a digest of their ids """
+    membership = {}
+    digest = hashlib.sha1()
+    id_batches = {
+        'concepts': version.get_export_concept_id_batches(EXPORT_BATCH_SIZE),
+        'mappings': version.get_export_mapping_id_batches(EXPORT_BATCH_SIZE),
+    }
+    for (child_type, model_type, serializer_type) in EXPORT_CHILD_TYPES:
+        digest.update(child_type)
+        membership[child_type] = 0
+        for ids in id_batches[child_type]:
+            digest.update(','.join(str(id) for id in ids))
+            membership[child_type] += len(ids)
+    membership['digest'] = digest.hexdigest()
+    return membership
+
+
+def find_reusable_export(version, membership):
+    """
+    Returns the path and the manifest of the export of the previous version of version if it has the given
+    membership, or a pair of None.
+    """
+    previous_version = version.previous_version
+    if not previous_version or previous_version.mnemonic == 'HEAD':
+        return None, None
+    storage = ExportStorageFactory.get_export_storage()
+    if not storage.exists(previous_version.export_manifest_path) or not storage.exists(previous_version.export_path):
+        return None, None
+    manifest = json.loads(storage.read(previous_version.export_manifest_path))
+    if manifest.get('membership') != membership or not manifest.get('copyable_part'):
+        return None, None
+    return previous_version.export_path, manifest
+
+
+def iterate_content_defined_batches(ids, average_size=EXPORT_CHUNK_AVERAGE_SIZE, max_size=EXPORT_CHUNK_MAX_SIZE):
+    """
+    Groups ids, in order, into batches ending after an id whose hash is a multiple of average_size. As the boundaries
+    depend on the ids rather than on their positions, the batches of two versions only differ where their ids do.
+    """
+    batch = []
+    for id in ids:
+        batch.append(id)
+        if len(batch) >= max_size or int(hashlib.md5(str(id)).hexdigest()[:8], 16) % average_size == 0:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_export_chunk_path(digest):
+    return '%s/%s.json.gz' % (EXPORT_CHUNKS_PATH, digest)
+
+
+def get_export_manifest(manifest_path, expires_in=EXPORT_CHUNK_URL_EXPIRY):
+    """ Reads the manifest of a chunked export, adding the URL to download each chunk from """
+    storage = ExportStorageFactory.get_export_storage()
+    manifest = json.loads(storage.read(manifest_path))
+    for (child_type, model_type, serializer_type) in EXPORT_CHILD_TYPES:
+        for chunk in manifest[child_type]:
+            chunk['url'] = storage.get_url(get_export_chunk_path(chunk['sha1']), expires_in)
+    return manifest
+
+
+class ExportChunkStore(object):
+    """
+    Stores serialized batches of concept or mapping versions as gzipped JSON arrays keyed by the SHA-1 of the
+    array, uploading only the chunks that no earlier export has stored.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.uploaded = 0
+
+    def add(self, count, batch_string):
+        """ Stores a batch, unless an identical chunk exists, and returns its entry in the manifest """
+        chunk_string = '[%s]' % batch_string
+        digest = hashlib.sha1(chunk_string).hexdigest()
+        chunk_path = get_export_chunk_path(digest)
+        if not self.storage.exists(chunk_path):
+            self.storage.write(chunk_path, compress_string(chunk_string), content_type='application/json',
+                               content_encoding='gzip')
+            self.uploaded += 1
+        return {'sha1': digest, 'count': count, 'size': len(chunk_string)}
+
+
+def write_delta_export_file(version, from_version, logger):
+    """
+    Uploads the concept and mapping versions added, replaced and removed between from_version and the source version,
+    serialized like in the full export, as a zip holding delta.json.
+    """
+    logger.info('Comparing source version %s with %s...' % (version.mnemonic, from_version.mnemonic))
+    delta = version.get_delta_from(from_version)
+
+    delta_path = version.get_delta_export_path(from_version)
+    logger.info('Streaming compressed delta export to %s...' % delta_path)
+    upload = ExportStorageFactory.get_export_storage().open_upload(
+        delta_path, content_type='application/zip', last_child_update=version.last_child_update)
+    try:
+        out = ZipStreamWriter(upload, 'delta.json')
+        out.write('{"from_version": %s, "to_version": %s' % (json.dumps(from_version.mnemonic), json.dumps(version.mnemonic)))
+        for (child_type, model_type, serializer_type) in EXPORT_CHILD_TYPES:
+            out.write(', "%s": {' % child_type)
+            for (index, change) in enumerate(DELTA_EXPORT_CHANGES):
+                ids = delta[child_type][change]
+                id_batches = [ids[start:start + EXPORT_BATCH_SIZE] for start in range(0, len(ids), EXPORT_BATCH_SIZE)]
+                out.write('%s"%s": [' % (', ' if index else '', change))
+                write_export_batches(out, id_batches, model_type, serializer_type, 'source', '%s %s' % (change, child_type),
+                                     logger)
+                out.write(']')
+            out.write('}')
+        out.write('}')
+        out.close()
+        upload.close()
+    except:
+        upload.cancel()
+        raise
+    logger.info('Uploaded delta export to %s.' % delta_path)
+
+
+class S3MultipartUploadStream(object):
+    """
+    File-like object uploading what is written to it to an S3 key as a multipart upload, a part each time
+    part_size bytes are buffered. close completes the upload, the key does not exist until then.
+    """
+
+    def __init__(self, bucket, key_name, content_type=None, part_size=EXPORT_UPLOAD_PART_SIZE):
+        headers = {'Content-Type': content_type} if content_type else None
+        self.bucket = bucket
+        self.multipart_upload = bucket.initiate_multipart_upload(key_name, headers=headers)
+        self.part_size = part_size
+        self.buffer = []
+        self.buffered = 0
+        self.parts = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.part_size:
+            self.upload_part()
+
+    def upload_part(self):
+        self.parts += 1
+        self.multipart_upload.upload_part_from_file(StringIO(''.join(self.buffer)), self.parts)
+        self.buffer = []
+        self.buffered = 0
+
+    def copy(self, key_name, start, end):
+        """
+        Appends the bytes from start to end of another key of the bucket. Whole parts are copied by S3, while the
+        bytes that complete the buffered part or are left over are downloaded, as only the last part may be smaller
+        than part_size.
+        """
+        key = Key(self.bucket, key_name)
+        if self.buffered:
+            fill_end = min(end, start + self.part_size - self.buffered)
+            self.write(get_key_range(key, start, fill_end))
+            start = fill_end
+        while end - start >= self.part_size:
+            copy_end = min(end, start + EXPORT_COPY_PART_SIZE)
+            self.parts += 1
+            self.multipart_upload.copy_part_from_key(self.bucket.name, key_name, self.parts, start, copy_end - 1)
+            start = copy_end
+        if start < end:
+            self.write(get_key_range(key, start, end))
+
+    def close(self):
+        # Only the last part may be smaller than part_size
+        if self.buffered or not self.parts:
+            self.upload_part()
+        self.multipart_upload.complete_upload()
+
+    def cancel(self):
+        self.multipart_upload.cancel_upload()
+
+
+def get_key_range(key, start, end):
+    return key.get_contents_as_string(headers={'Range': 'bytes=%d-%d' % (start, end - 1)})
+
+
+def crc32_combine(crc1, crc2, length2):
+    """
+    Returns the CRC-32 of two strings concatenated given the CRC-32 of each and the length of the second. CRC-32 is
+    affine in its initial value, so only the effect of crc1 on length2 zero bytes has to be computed.
+    """
+    zeros = '\0' * min(length2, 1024 * 1024)
+    zeros_crc1 = crc1
+    zeros_crc0 = 0
+    remaining = length2
+    while remaining:
+        block = zeros if remaining >= len(zeros) else zeros[:remaining]
+        zeros_crc1 = zlib.crc32(block, zeros_crc1)
+        zeros_crc0 = zlib.crc32(block, zeros_crc0)
+        remaining -= len(block)
+    return (crc2 ^ zeros_crc1 ^ zeros_crc0) & 0xffffffff
+
+
+class ZipStreamWriter(object):
+    """
+    Writes a zip archive with a single deflated entry to a stream, compressing data as it is written. The stream
+    does not have to be seekable: the checksum and sizes follow the entry in a data descriptor. Zip64 is not
+    supported, so the entry is limited to 4GB.
+
+    After mark, the compressed data does not depend on the data written before, so the part of the entry written
+    afterwards can be copied into another archive by copy, given what get_marked_part returns.
+    """
+
+    def __init__(self, stream, arcname, compress_level=zlib.Z_DEFAULT_COMPRESSION):
+        self.stream = stream
+        self.arcname = arcname
+        self.compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.marked_offset = None
+        self.marked_size = 0
+        self.marked_crc = 0
+        year, month, day, hour, minute, second = time.localtime()[:6]
+        self.dos_date = (year - 1980) << 9 | month << 5 | day
+        self.dos_time = hour << 11 | minute << 5 | second // 2
+        self.header_size = self.write_to_stream(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 20, ZIP_DATA_DESCRIPTOR_FLAG, zipfile.ZIP_DEFLATED, self.dos_time,
+            self.dos_date, 0, 0, 0, len(arcname), 0) + arcname)
+
+    def write(self, data):
+        if not data:
+            return
+        self.crc = zlib.crc32(data, self.crc)
+        if self.marked_offset is not None:
+            self.marked_crc = zlib.crc32(data, self.marked_crc)
+        self.size += len(data)
+        self.compressed_size += self.write_to_stream(self.compressor.compress(data))
+
+    def mark(self):
+        self.compressed_size += self.write_to_stream(self.compressor.flush(zlib.Z_FULL_FLUSH))
+        self.marked_offset = self.header_size + self.compressed_size
+        self.marked_size = self.size
+        self.marked_crc = 0
+
+    def copy(self, path, start, end, size, crc):
+        """
+        Ends the entry with the marked part of another archive, stored from start to end of the file at path and
+        decompressing to size bytes with checksum crc. The stream has to copy it, nothing can be written afterwards.
+        """
+        self.mark()
+        self.stream.copy(path, start, end)
+        self.compressor = None
+        self.compressed_size += end - start
+        self.crc = crc32_combine(self.crc, crc, size)
+        self.size += size
+        self.marked_crc = crc
+
+    def get_marked_part(self):
+        """ Returns the location and the size and checksum of the uncompressed data of the marked part, if any """
+        if self.marked_offset is None:
+            return None
+        return {'offset': self.marked_offset, 'end': self.header_size + self.compressed_size,
+                'size': self.size - self.marked_size, 'crc': self.marked_crc & 0xffffffff}
+
+    def close(self):
+        """ Writes the end of the entry and the central directory, leaving the stream open """
+        if self.compressor:
+            self.compressed_size += self.write_to_stream(self.compressor.flush())
+        if max(self.size, self.compressed_size) > 0xffffffff:
+            raise ValueError('Zip entry %s exceeds 4GB' % self.arcname)
+        crc = self.crc & 0xffffffff
+        self.write_to_stream(struct.pack('<IIII', 0x08074b50, crc, self.compressed_size, self.size))
+
+        directory_offset = self.header_size + self.compressed_size + 16
+        directory = struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, ZIP_DATA_DESCRIPTOR_FLAG, zipfile.ZIP_DEFLATED, self.dos_time,
+            self.dos_date, crc, self.compressed_size, self.size, len(self.arcname), 0, 0, 0, 0, 0644 << 16, 0
+        ) + self.arcname
+        self.write_to_stream(directory)
+        self.write_to_stream(struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, 1, 1, len(directory), directory_offset, 0))
+
+    def write_to_stream(self, data):
+        if data:
+            self.stream.write(data)
+        return len(data)
+
+
+def write_export_batches(out, id_batches, model_type, serializer_type, resource_type, child_type, logger,
+                         chunk_store=None, line_delimited=False):
+    """
+    Writes the versions of model_type with the ids of each batch, serialized by serializer_type, to out as the
+    elements of a JSON array, or as JSON lines if line_delimited. With EXPORT_SERIALIZATION_WORKERS set the batches
+    are serialized by a process pool. Given a chunk_store, each batch is also stored as a chunk and the manifest
+    entries of the chunks are returned.
+    """
+    workers = settings.EXPORT_SERIALIZATION_WORKERS
+    if workers > 1:
+        serialized_batches = serialize_export_batches_in_parallel(id_batches, model_type, serializer_type,
+                                                                  line_delimited, workers)
+    else:
+        # Sources and owners are resolved once for all batches
+        export_sources = {}
+        serialized_batches = (
+            serialize_export_batch((model_type, serializer_type, ids, line_delimited, None), export_sources)
+            for ids in id_batches)
+
+    written = 0
+    chunks = []
+    for (count, batch_string) in serialized_batches:
+        logger.info('Serialized %s %d - %d.' % (child_type, written + 1, written + count))
+        if written and batch_string and not line_delimited:
+            out.write(', ')
+        out.write(batch_string)
+        if chunk_store and count:
+            chunks.append(chunk_store.add(count, batch_string))
+        written += count
+
+    if written:
+        logger.info('Done serializing %d %s.' % (written, child_type))
+    else:
+        logger.info('%s has no %s to serialize.' % (resource_type.title(), child_type))
+    return chunks
+
+
+def serialize_export_batches_in_parallel(id_batches, model_type, serializer_type, line_delimited, workers):
+    """
+    Fans the batches out to a pool of worker processes, each serializing a batch into a chunk file, and yields the
+    serialized batches in their original order. Uses billiard, as the daemon processes of Celery may not fork with
+    multiprocessing.
+    """
+    chunk_dir = tempfile.mkdtemp()
+    chunks = ((model_type, serializer_type, ids, line_delimited, os.path.join(chunk_dir, 'chunk_%d.json' % index))
+              for (index, ids) in enumerate(id_batches))
+    close_db_connections()
+    pool = billiard.Pool(workers)
+    try:
+        for (count, chunk_filename) in pool.imap(serialize_export_batch, chunks):
+            with open(chunk_filename, 'rb') as chunk_file:
+                batch_string = chunk_file.read()
+            os.remove(chunk_filename)
+            yield count, batch_string
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+
+def serialize_export_batch(chunk, export_sources=None):
+    """
+    Serializes the versions of a (model type, serializer type, ids, line delimited, chunk filename) chunk as JSON
+    array elements or as JSON lines, taking sources from and adding them to the export_sources dict. Returns the
+    number of ids and either the serialized string or, given a chunk filename, that file after writing to it.
+    """
+    model_type, serializer_type, ids, line_delimited, chunk_filename = chunk
+    versions = get_class(model_type).objects.filter(id__in=list(ids))
+    serializer = get_class(serializer_type)(versions, many=True, context={'export_sources': (
+        export_sources if export_sources is not None else {})})
+    if line_delimited:
+        batch_string = ''.join(json.dumps(data, cls=encoders.JSONEncoder) + '\n' for data in serializer.data)
+    else:
+        batch_string = json.dumps(serializer.data, cls=encoders.JSONEncoder)[1:-1]
+    if chunk_filename is None:
+        return len(ids), batch_string
+    with open(chunk_filename, 'wb') as chunk_file:
+        chunk_file.write(batch_string)
+    return len(ids), chunk_filename
+
+
+def get_csv_export_path(filename, is_owner):
+    _dir = 'downloads/creator/' if is_owner else 'downloads/reader/'
+    return _dir + filename + '.csv.gz'
+
+
+def get_csv_queryset(model, filters, excludes):
+    queryset = model.objects.filter(**filters)
+    return queryset.exclude(**excludes) if excludes else queryset
+
+
+def get_last_update(queryset):
+    """ Returns the latest updated_at of the objects of queryset, or None if it is empty """
+    updates = queryset.order_by('-updated_at').values_list('updated_at', flat=True)[:1]
+    return updates[0] if updates else None
+
+
+def get_csv_formatter(csv_format):
+    return get_class(CSV_FORMATTERS[csv_format])() if csv_format else None
+
+
+def iterate_csv_batches(queryset, formatter=None, batch_size=CSV_BATCH_SIZE):
+    """
+    Yields the field names and the rows of the CSV of queryset for every batch_size objects, ordered by id and
+    formatted by the get_csv_rows of formatter if given.
+    """
+    for ids in iterate_by_id(queryset.values_list('id', flat=True), batch_size):
+        batch = queryset.model.objects.filter(id__in=ids).order_by('id')
+        values = formatter.get_csv_rows(batch) if formatter else batch.values()
+        rows = list(values)
+        yield values.field_names, rows
+
+
+def format_csv_value(value):
+    if value is None:
+        return ''
+    return unicode(value).encode('utf-8')
+
+
+def write_csv_export_file(queryset, path, formatter=None, storage=None, batch_size=CSV_BATCH_SIZE):
+    """
+    Streams the CSV of queryset, formatted by formatter, gzipped to path of the export storage in batches. The
+    latest updated_at of the rows is recorded as its last_child_update, which tells whether the CSV is current.
+    """
+    storage = storage or ExportStorageFactory.get_export_storage()
+    upload = storage.open_upload(path, content_type='application/gzip', last_child_update=get_last_update(queryset))
+    try:
+        out = gzip.GzipFile(filename=path.split('/')[-1][:-3], mode='wb', fileobj=upload)
+        writer = csv.writer(out)
+        header_written = False
+        for (field_names, rows) in iterate_csv_batches(queryset, formatter, batch_size):
+            if not header_written:
+                writer.writerow([format_csv_value(field_name) for field_name in field_names])
+                header_written = True
+            for row in rows:
+                writer.writerow([format_csv_value(row.get(field_name)) for field_name in field_names])
+        out.close()
+        upload.close()
+    except:
+        upload.cancel()
+        raise
+    return upload.size
@@ -1,15 +1,26 @@
 from optparse import make_option
+import hashlib
+import json
 import logging
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zlib
+from datetime import datetime
 from django.core.management import BaseCommand, CommandError
 from rest_framework.authtoken.models import Token
 from oclapi.permissions import HasPrivateAccess
-from sources.models import Source
+from sources.models import Source, SourceVersion
 from cProfile import Profile
 
 __author__ = 'misternando,paynejd'
 logger = logging.getLogger('batch')
 
+MANAGE_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))),
+                         'manage.py')
+
 
 class ImportActionHelper(object):
     """ Import action constants """
@@ -115,7 +126,29 @@ class ImportCommand(BaseCommand):
                     action='store',
                     dest='error_output_file',
                     default=None,
-                    help="Name of the csv file to redirect validation errors to")
+                    help="Name of the csv file to redirect validation errors to"),
+        make_option('--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=None,
+                    help='Number of lines to read per batch. New concepts in a batch are validated in memory and inserted with bulk writes.'),
+        make_option('--workers',
+                    action='store',
+                    dest='workers',
+                    type='int',
+                    default=1,
+                    help='Number of processes to import with. The input file is partitioned by a hash of the record key.'),
+        make_option('--resume',
+                    action='store_true',
+                    dest='resume',
+                    default=False,
+                    help='Resume an earlier import of the same file into the source from its last checkpoint.'),
+        make_option('--worker-summary-file',
+                    action='store',
+                    dest='worker_summary_file',
+                    default=None,
+                    help='Used by --workers: imports a single partition and writes its summary to this file.')
     )
 
 
@@ -170,13 +203,24 @@ class ImportCommand(BaseCommand):
         logger.info('Import begins user %s source %s' % (user, source))
         try:
             with open(input_filename, 'rb') as input_file:
-                total = sum(1 for line in input_file)
+                total = 0
+                file_hash = hashlib.sha1()
+                for line in input_file:
+                    total += 1
+                    file_hash.update(line)
                 options['total'] = total
+                # Identifies the checkpoints of this import
+                options['file_hash'] = file_hash.hexdigest()
                 self.stdout.write('Importing %d record(s)...\n' % total)
                 logger.info('Importing %d record(s)...' % total)
         except IOError:
             raise CommandError('Could not open input file %s' % input_filename)
 
+        if (options.get('workers') or 1) > 1 and not options.get('worker_summary_file'):
+            self.import_in_workers(user, source, input_filename, options)
+            logger.info('Import finished')
+            return
+
         # Open the file a second time to pass to the import function
         try:
             input_file = open(input_filename, 'rb')
@@ -184,9 +228,151 @@ class ImportCommand(BaseCommand):
             raise CommandError('Could not open input file %s' % input_filename)
 
         # Perform the import
-        self.do_import(user, source, input_file, options)
+        if options.get('worker_summary_file'):
+            # The process that started this worker merges the results and updates the search index
+            options['skip_index'] = True
+        importer = self.do_import(user, source, input_file, options)
+        if options.get('worker_summary_file'):
+            with open(options['worker_summary_file'], 'w') as summary_file:
+                json.dump(importer.get_import_summary(), summary_file)
         logger.info('Import finished')
 
     def do_import(self, user, source, input_file, options):
-        """ Should be overwritten to actually perform the import """
+        """ Should be overwritten to actually perform the import and return the importer """
         pass
+
+    def create_importer(self, user, source, input_file, options):
+        """ Should be overwritten to return the importer used by do_import """
+        pass
+
+    def get_partition_key(self, data):
+        """ Should be overwritten to return the key of a record, records with equal keys are imported by the same worker """
+        return None
+
+    def get_partition(self, line, workers):
+        try:
+            key = self.get_partition_key(json.loads(line))
+        except ValueError:
+            key = None
+        if key is None:
+            return 0
+        return (zlib.crc32(unicode(key).encode('utf-8')) & 0xffffffff) % workers
+
+    def import_in_workers(self, user, source, input_filename, options):
+        """
+        Splits the input file into partitions by record key and imports each partition in a separate process running
+        this command. Afterwards merges the summaries and validation errors of the workers, deactivates records that
+        no worker handled, indexes the versions touched by the workers once and recomputes the counters of the affected source versions.
+        """
+        workers = options['workers']
+        work_dir = tempfile.mkdtemp()
+        try:
+            partition_filenames = self.partition_input_file(input_filename, work_dir, workers)
+
+            source_versions = [SourceVersion.get_head_of(source)]
+            if options.get('new_version'):
+                existing_versions = SourceVersion.objects.filter(versioned_object_id=source.id, mnemonic=options['new_version'])
+                if options.get('resume') and existing_versions:
+                    # Created by the run that is resumed
+                    source_versions.append(existing_versions[0])
+                else:
+                    source_versions.append(self.create_new_source_version(source, options['new_version'], source_versions[0]))
+
+            processes = []
+            for index, partition_filename in enumerate(partition_filenames):
+                args = [sys.executable, MANAGE_PY, self.__module__.split('.')[-1],
+                        '--token=%s' % options['token'], '--source=%s' % source.id,
+                        '--worker-summary-file=%s' % os.path.join(work_dir, 'summary_%s.json' % index),
+                        '--error-output-file=%s' % os.path.join(work_dir, 'errors_%s.csv' % index)]
+                if options.get('test-only'):
+                    args.append('--test-only')
+                if options.get('batch_size'):
+                    args.append('--batch-size=%s' % options['batch_size'])
+                if options.get('resume'):
+                    args.append('--resume')
+                args.append(partition_filename)
+                self.stdout.write('Starting import worker %s of %s...\n' % (index + 1, workers))
+                processes.append(subprocess.Popen(args))
+
+            failed_workers = [index for index, process in enumerate(processes) if process.wait() != 0]
+
+            lines_handled = 0
+            action_count = {}
+            unhandled_ids = None
+            touched_ids = set()
+            for index in range(workers):
+                summary_filename = os.path.join(work_dir, 'summary_%s.json' % index)
+                if not os.path.exists(summary_filename):
+                    continue
+                with open(summary_filename) as summary_file:
+                    summary = json.load(summary_file)
+                lines_handled += summary['lines_handled']
+                for action, count in summary['action_count'].items():
+                    action_count[int(action)] = action_count.get(int(action), 0) + count
+                # Every worker starts with all ids of the source version and removes the ones it handled
+                worker_unhandled_ids = set(summary['unhandled_ids'])
+                unhandled_ids = worker_unhandled_ids if unhandled_ids is None else unhandled_ids & worker_unhandled_ids
+                touched_ids.update(summary['touched_ids'])
+
+            self.merge_validation_errors(work_dir, workers, options.get('error_output_file'))
+
+            deactivate_old_records = options.get('deactivate_old_records')
+            if failed_workers and deactivate_old_records:
+                self.stderr.write('Skipping deactivation because import workers %s failed\n' % failed_workers)
+                deactivate_old_records = False
+
+            importer = self.create_importer(user, source, None, options)
+            importer.finish_partitioned_import(
+                lines_handled, options['total'], action_count, unhandled_ids or set(), touched_ids,
+                test_mode=bool(options.get('test-only')), deactivate_old_records=deactivate_old_records)
+
+            if not options.get('test-only'):
+                # Counters were incremented concurrently, recompute them from the versions now that all workers are done
+                for source_version in source_versions:
+                    SourceVersion.objects.get(id=source_version.id).save()
+        finally:
+            shutil.rmtree(work_dir)
+
+        if failed_workers:
+            raise CommandError('Import workers %s failed' % failed_workers)
+
+    def partition_input_file(self, input_filename, work_dir, workers):
+        partition_filenames = [os.path.join(work_dir, 'partition_%s.json' % index) for index in range(workers)]
+        partition_files = [open(filename, 'wb') for filename in partition_filenames]
+        try:
+            with open(input_filename, 'rb') as input_file:
+                for line in input_file:
+                    partition_files[self.get_partition(line, workers)].write(line)
+        finally:
+            for partition_file in partition_files:
+                partition_file.close()
+        return partition_filenames
+
+    def create_new_source_version(self, source, new_version, head_version):
+        try:
+            source_version = SourceVersion.for_base_object(source, new_version, previous_version=head_version)
+            source_version.full_clean()
+            source_version.save()
+            source_version.seed_concepts()
+            source_version.seed_mappings()
+        except Exception as exc:
+            raise CommandError('Failed to create new source version due to %s' % exc.args[0])
+        return source_version
+
+    def merge_validation_errors(self, work_dir, workers, output_file_name=None):
+        """ Concatenates the validation error CSVs written by the workers below a single header """
+        header = u'MNEMONIC;ERROR;JSON'
+        error_filenames = [os.path.join(work_dir, 'errors_%s.csv' % index) for index in range(workers)]
+        error_filenames = [filename for filename in error_filenames if os.path.exists(filename)]
+        if not error_filenames:
+            return
+
+        output_file_name = output_file_name or 'bulk_import_validation_errors_%s.csv' % datetime.now().strftime('%Y%m%d%H%M%S')
+        with open(output_file_name, 'w+') as output:
+            output.write(header)
+            for filename in error_filenames:
+                with open(filename) as error_file:
+                    # Skip the header written by the worker
+                    error_file.read(len(header))
+                    shutil.copyfileobj(error_file, output)
+        self.stdout.write('Validation errors written to %s\n' % output_file_name)
@@ -8,9 +8,16 @@ class Command(ImportCommand):
 
     def do_import(self, user, source, input_file, options):
         """ Performs the import of JSON lines concept file into OCL """
+        importer = self.create_importer(user, source, input_file, options)
+        importer.import_concepts(**options)
+        return importer
+
+    def create_importer(self, user, source, input_file, options):
         validation_logger = None
         output_file_name = options.get('error_output_file', False)
         if output_file_name:
             validation_logger = ValidationLogger(output_file_name=output_file_name)
-        importer = ConceptsImporter(source, input_file, user, self.stdout, self.stderr, validation_logger=validation_logger)
-        importer.import_concepts(**options)
\ No newline at end of file
+        return ConceptsImporter(source, input_file, user, self.stdout, self.stderr, validation_logger=validation_logger)
+
+    def get_partition_key(self, data):
+        return data.get('id')
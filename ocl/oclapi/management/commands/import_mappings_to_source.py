@@ -11,5 +11,13 @@ class Command(ImportCommand):
 
     def do_import(self, user, source, input_file, options):
         """ Perform the mapping import """
-        importer = MappingsImporter(source, input_file, self.stdout, self.stderr, user)
+        importer = self.create_importer(user, source, input_file, options)
         importer.import_mappings(**options)
+        return importer
+
+    def create_importer(self, user, source, input_file, options):
+        return MappingsImporter(source, input_file, self.stdout, self.stderr, user)
+
+    def get_partition_key(self, data):
+        # Mappings of a concept are imported by the same worker, so duplicates within the file stay ordered
+        return data.get('from_concept_url')
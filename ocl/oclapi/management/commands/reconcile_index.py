@@ -0,0 +1,44 @@
+from optparse import make_option
+
+from django.core.management import BaseCommand, CommandError
+from django.db.models import get_model
+
+from oclapi.management.reconcile import Reconciler, RECONCILE_BATCH_SIZE
+from oclapi.utils import haystack_connections
+
+
+class Command(BaseCommand):
+    help = 'Repair the Solr documents that are missing, stale or orphaned compared to Mongo. ' \
+           'Reconciles all indexed models if none are given.'
+    args = '[app_label.ModelName ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=RECONCILE_BATCH_SIZE,
+                    help='Number of ids read from Mongo or Solr at a time.'),
+        make_option('--dry-run',
+                    action='store_true',
+                    dest='dry_run',
+                    default=False,
+                    help='Only count the documents that differ, without repairing them.'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            models = []
+            for label in args:
+                model = get_model(*label.split('.')) if '.' in label else None
+                if model is None:
+                    raise CommandError('Unknown model %s, expected app_label.ModelName' % label)
+                models.append(model)
+        else:
+            models = haystack_connections['default'].get_unified_index().get_indexed_models()
+
+        for model in models:
+            reconciler = Reconciler(model, batch_size=options['batch_size'], dry_run=options['dry_run'])
+            counts = reconciler.run()
+            self.stdout.write('%s: %d missing, %d stale, %d orphaned documents%s' % (
+                reconciler.model_key, counts['missing'], counts['stale'], counts['orphaned'],
+                ' found' if options['dry_run'] else ' repaired'))
@@ -0,0 +1,47 @@
+from optparse import make_option
+
+from django.core.management import BaseCommand, CommandError
+from django.db.models import get_model
+
+from oclapi.management.reindex import Reindexer, REINDEX_BATCH_SIZE
+from oclapi.utils import haystack_connections
+
+
+class Command(BaseCommand):
+    help = 'Reindex models in Solr in parallel, by ranges of ids. Reindexes all indexed models if none are given.'
+    args = '[app_label.ModelName ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers',
+                    action='store',
+                    dest='workers',
+                    type='int',
+                    default=1,
+                    help='Number of processes to index with, each indexing its own range of ids.'),
+        make_option('--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=REINDEX_BATCH_SIZE,
+                    help='Number of documents sent to Solr in one update.'),
+        make_option('--resume',
+                    action='store_true',
+                    dest='resume',
+                    default=False,
+                    help='Continue the unfinished ranges of an interrupted reindex instead of starting over.'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            models = []
+            for label in args:
+                model = get_model(*label.split('.')) if '.' in label else None
+                if model is None:
+                    raise CommandError('Unknown model %s, expected app_label.ModelName' % label)
+                models.append(model)
+        else:
+            models = haystack_connections['default'].get_unified_index().get_indexed_models()
+
+        for model in models:
+            reindexer = Reindexer(model, workers=options['workers'], batch_size=options['batch_size'])
+            indexed = reindexer.run(resume=options['resume'])
+            self.stdout.write('Reindexed %d %s documents' % (indexed, reindexer.model_key))
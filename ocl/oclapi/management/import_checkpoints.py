@@ -0,0 +1,117 @@
+""" Checkpoints of concept and mapping imports, used to resume a failed import """
+from oclapi.models import ImportCheckpoint, ImportCheckpointIds
+
+# Number of input lines between two checkpoints
+CHECKPOINT_INTERVAL = 1000
+# Number of ids stored per ImportCheckpointIds document
+IDS_CHUNK_SIZE = 10000
+
+
+class ImportCheckpointer(object):
+    """
+    Persists the progress of an import of a file into a source: the offset of the first line not imported yet, the
+    action counts, the ids that are still awaiting deactivation and the ids of the versions that have to be indexed.
+    The ids pending when the import started are stored once, afterwards only the ids handled or touched since the
+    previous checkpoint are added, so a checkpoint costs a few writes regardless of the size of the source.
+    """
+
+    def __init__(self, import_type, source, file_hash, interval=CHECKPOINT_INTERVAL):
+        self.import_type = import_type
+        self.source = source
+        self.file_hash = file_hash
+        self.interval = interval
+        self.checkpoint = None
+        self.handled_ids = []
+        self.new_touched_ids = []
+        self.touched_ids = set()
+        self.saved_lines_handled = 0
+        self.resumed = False
+
+    def load(self):
+        """ Returns the checkpoint left by an unfinished run of the same import, or None """
+        checkpoints = ImportCheckpoint.objects.filter(
+            import_type=self.import_type, source_id=self.source.id, file_hash=self.file_hash).order_by('-updated_at')
+        return checkpoints[0] if checkpoints else None
+
+    def start(self, source_version, pending_ids, started_at):
+        """ Discards checkpoints of earlier runs and records the state the import starts from """
+        self.discard()
+        self.checkpoint = ImportCheckpoint.objects.create(
+            import_type=self.import_type, source_id=self.source.id, file_hash=self.file_hash,
+            source_version_id=source_version.id, action_count={}, started_at=started_at)
+        self.save_ids(list(pending_ids), None)
+        self.saved_lines_handled = 0
+
+    def resume(self, checkpoint):
+        """
+        Continues from checkpoint and returns the ids that were still awaiting deactivation at its offset. The ids of
+        the versions touched before the offset are collected in touched_ids.
+        """
+        self.checkpoint = checkpoint
+        self.saved_lines_handled = checkpoint.lines_handled
+        self.resumed = True
+        # Ids saved by a checkpoint that was not completed are handled again
+        ImportCheckpointIds.objects.filter(checkpoint_id=checkpoint.id, offset__gt=checkpoint.offset).delete()
+
+        pending_ids = set()
+        handled_ids = set()
+        for chunk in ImportCheckpointIds.objects.filter(checkpoint_id=checkpoint.id):
+            if chunk.touched:
+                self.touched_ids.update(chunk.ids)
+            elif chunk.offset is None:
+                pending_ids.update(chunk.ids)
+            else:
+                handled_ids.update(chunk.ids)
+        return pending_ids - handled_ids
+
+    def find_replayed_versions(self, version, pending_ids):
+        """
+        Walks back from version over the versions created since the import started and not recorded by the
+        checkpoint, which a failed run wrote after its last checkpoint. Returns their ids and the id of the pending
+        version they replaced, or None.
+        """
+        replayed_ids = []
+        if not self.resumed:
+            return replayed_ids, None
+        while version.id not in pending_ids and version.created_at >= self.checkpoint.started_at:
+            replayed_ids.append(version.id)
+            if not version.previous_version_id:
+                return replayed_ids, None
+            version = type(version).objects.get(id=version.previous_version_id)
+        return replayed_ids, version.id if version.id in pending_ids else None
+
+    def add_handled_id(self, handled_id):
+        self.handled_ids.append(handled_id)
+
+    def add_touched_ids(self, touched_ids):
+        self.new_touched_ids.extend(touched_ids)
+
+    def save(self, offset, lines_handled, action_count, force=False):
+        """ Records that all lines before offset are imported, at most once every interval lines unless forced """
+        if not force and lines_handled - self.saved_lines_handled < self.interval:
+            return
+        self.save_ids(self.handled_ids, offset)
+        self.handled_ids = []
+        self.save_ids(self.new_touched_ids, offset, touched=True)
+        self.new_touched_ids = []
+        ImportCheckpoint.objects.filter(id=self.checkpoint.id).update(
+            offset=offset, lines_handled=lines_handled,
+            action_count=dict((str(action), count) for (action, count) in action_count.items()))
+        self.saved_lines_handled = lines_handled
+
+    def save_ids(self, ids, offset, touched=False):
+        for start in range(0, len(ids), IDS_CHUNK_SIZE):
+            ImportCheckpointIds.objects.create(
+                checkpoint_id=self.checkpoint.id, offset=offset, ids=ids[start:start + IDS_CHUNK_SIZE],
+                touched=touched)
+
+    def finish(self):
+        """ Removes the checkpoint once the import is complete """
+        self.discard()
+        self.checkpoint = None
+
+    def discard(self):
+        checkpoint_ids = list(ImportCheckpoint.objects.filter(
+            import_type=self.import_type, source_id=self.source.id, file_hash=self.file_hash).values_list('id', flat=True))
+        ImportCheckpointIds.objects.filter(checkpoint_id__in=checkpoint_ids).delete()
+        ImportCheckpoint.objects.filter(id__in=checkpoint_ids).delete()
@@ -0,0 +1,177 @@
+"""
+Reconciliation of the search index with Mongo. The (id, last update) pairs of a model are read from Mongo and from
+Solr in the same order of ids and merged, so that only the documents missing from the index, stale in it or left in it
+for deleted objects are indexed again or removed, instead of rebuilding the whole index.
+"""
+import logging
+import re
+import time
+from datetime import datetime
+
+from oclapi.search_index_queue import get_model_key, update_index
+from oclapi.utils import haystack_connections, iterate_by_id
+
+logger = logging.getLogger('batch')
+
+# Number of (id, last update) pairs read from Mongo or Solr at a time
+RECONCILE_BATCH_SIZE = 5000
+# Number of documents repaired in one update
+RECONCILE_REPAIR_BATCH_SIZE = 1000
+# Stored field of the indexes holding the time the object was last updated
+LAST_UPDATE_FIELD = 'lastUpdate'
+
+MISSING = 'missing'
+STALE = 'stale'
+ORPHANED = 'orphaned'
+DIFFERENCES = (MISSING, STALE, ORPHANED)
+
+# Dates as Solr returns them, e.g. 2017-01-01T12:00:00.123Z
+INDEX_TIMESTAMP_REGEX = re.compile(
+    r'^(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})T(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})'
+    r'(?:\.(?P<fraction>\d+))?Z$')
+
+
+def get_index(model):
+    return haystack_connections['default'].get_unified_index().get_index(model)
+
+
+def normalize_timestamp(value):
+    """ Drops what Solr does not store of a datetime, its time zone and the precision below milliseconds """
+    if value is None:
+        return None
+    return value.replace(tzinfo=None, microsecond=value.microsecond // 1000 * 1000)
+
+
+def parse_index_timestamp(value):
+    """
+    Parses a date returned by Solr, keeping its milliseconds. pysolr's own conversion drops the fractional seconds,
+    which would make every document look stale next to the normalized timestamps of Mongo.
+    """
+    if value is None:
+        return None
+    match = INDEX_TIMESTAMP_REGEX.match(value)
+    if not match:
+        raise ValueError('Unexpected date in the index: %s' % value)
+    microsecond = int((match.group('fraction') or '0')[:6].ljust(6, '0'))
+    return normalize_timestamp(datetime(
+        int(match.group('year')), int(match.group('month')), int(match.group('day')), int(match.group('hour')),
+        int(match.group('minute')), int(match.group('second')), microsecond))
+
+
+def get_last_update_attr(index):
+    """ Returns the attribute of the model that the LAST_UPDATE_FIELD of index holds, None if it has no such field """
+    field = index.fields.get(LAST_UPDATE_FIELD)
+    return field.model_attr if field is not None else None
+
+
+def iterate_database_timestamps(index, batch_size=RECONCILE_BATCH_SIZE):
+    """
+    Yields the (id, last update) pairs of the objects index covers, ordered by id. The last update is None for
+    indexes without a LAST_UPDATE_FIELD, which are only checked for missing and orphaned documents.
+    """
+    last_update_attr = get_last_update_attr(index)
+    if not last_update_attr:
+        for batch in iterate_by_id(index.index_queryset().values_list('id', flat=True), batch_size):
+            for id in batch:
+                yield (id, None)
+        return
+    for batch in iterate_by_id(index.index_queryset().values_list('id', last_update_attr), batch_size):
+        for (id, last_update) in batch:
+            yield (id, normalize_timestamp(last_update))
+
+
+def iterate_index_timestamps(backend, model, has_last_update=True, batch_size=RECONCILE_BATCH_SIZE):
+    """
+    Yields the (id, last update) pairs of the documents of model in the index, ordered by id. Each batch is selected
+    with a range following the last id of the previous one, like iterate_by_id, rather than by a deep offset.
+    """
+    fields = 'django_id,%s' % LAST_UPDATE_FIELD if has_last_update else 'django_id'
+    last_id = None
+    while True:
+        filters = ['django_ct:%s' % get_model_key(model)]
+        if last_id is not None:
+            # Each range is used once, caching it would only evict the filters of searches
+            filters.append('{!cache=false}django_id:{"%s" TO *]' % last_id)
+        docs = backend.conn.search('*:*', fq=filters, fl=fields, sort='django_id asc', rows=batch_size).docs
+        for doc in docs:
+            yield (doc['django_id'], parse_index_timestamp(doc.get(LAST_UPDATE_FIELD)))
+        if len(docs) < batch_size:
+            return
+        last_id = docs[-1]['django_id']
+
+
+def ensure_ascending(pairs, name):
+    """ Passes pairs through, failing if their ids are not strictly ascending, which the merge relies on """
+    last_id = None
+    for pair in pairs:
+        if last_id is not None and pair[0] <= last_id:
+            raise ValueError('Ids of %s are not in ascending order: %s after %s' % (name, pair[0], last_id))
+        last_id = pair[0]
+        yield pair
+
+
+def diff_timestamps(database_pairs, index_pairs):
+    """
+    Merges the (id, last update) pairs of the database and of the index, both ordered by id, and yields an (id,
+    difference) pair for each id that is missing from the index, stale in it or orphaned in it
+    """
+    database_pairs = ensure_ascending(database_pairs, 'the database')
+    index_pairs = ensure_ascending(index_pairs, 'the index')
+    database_pair = next(database_pairs, None)
+    index_pair = next(index_pairs, None)
+    while database_pair is not None or index_pair is not None:
+        if index_pair is None or (database_pair is not None and database_pair[0] < index_pair[0]):
+            yield (database_pair[0], MISSING)
+            database_pair = next(database_pairs, None)
+        elif database_pair is None or index_pair[0] < database_pair[0]:
+            yield (index_pair[0], ORPHANED)
+            index_pair = next(index_pairs, None)
+        else:
+            if database_pair[1] != index_pair[1]:
+                yield (database_pair[0], STALE)
+            database_pair = next(database_pairs, None)
+            index_pair = next(index_pairs, None)
+
+
+class Reconciler(object):
+    """
+    Finds the documents of a model that differ from Mongo with one pass over the ids of both and repairs them: the
+    current state of missing and stale objects is indexed, the documents of objects that no longer exist are removed.
+    """
+
+    def __init__(self, model, batch_size=RECONCILE_BATCH_SIZE, repair_batch_size=RECONCILE_REPAIR_BATCH_SIZE,
+                 dry_run=False):
+        self.model = model
+        self.model_key = get_model_key(model)
+        self.batch_size = batch_size
+        self.repair_batch_size = repair_batch_size
+        self.dry_run = dry_run
+
+    def run(self):
+        """ Returns the number of documents found per difference, which are repaired unless it is a dry run """
+        index = get_index(self.model)
+        backend = haystack_connections['default'].get_backend()
+        started_at = time.time()
+        logger.info('Reconciling the index of %s...' % self.model_key)
+
+        differences = diff_timestamps(
+            iterate_database_timestamps(index, self.batch_size),
+            iterate_index_timestamps(backend, self.model, bool(get_last_update_attr(index)), self.batch_size))
+        counts = dict((difference, 0) for difference in DIFFERENCES)
+        pending = []
+        for (id, difference) in differences:
+            counts[difference] += 1
+            if self.dry_run:
+                continue
+            pending.append('%s:%s' % (self.model_key, id))
+            if len(pending) >= self.repair_batch_size:
+                update_index(pending)
+                pending = []
+        if pending:
+            update_index(pending)
+
+        if not self.dry_run and sum(counts.values()):
+            backend.conn.commit()
+        logger.info('Reconciled the index of %s in %.1f seconds: %d missing, %d stale, %d orphaned.' % (
+            self.model_key, time.time() - started_at, counts[MISSING], counts[STALE], counts[ORPHANED]))
+        return counts
@@ -0,0 +1,136 @@
+""" Reindex of whole models, partitioned into ranges of ids that are indexed by separate processes """
+import logging
+import multiprocessing
+import time
+
+from django.db.models import get_model
+
+from oclapi.models import ReindexCheckpoint
+from oclapi.utils import haystack_connections, iterate_by_id, close_db_connections
+
+logger = logging.getLogger('batch')
+
+# Number of documents sent to Solr in one update
+REINDEX_BATCH_SIZE = 1000
+# Seconds between two reports of the progress of a parallel reindex
+REINDEX_REPORT_INTERVAL = 30
+
+
+def get_model_key(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+def get_index(model):
+    return haystack_connections['default'].get_unified_index().get_index(model)
+
+
+def get_id_partitions(queryset, count):
+    """
+    Splits the ids of queryset into count contiguous ranges of about the same size, as (lower_id, upper_id) pairs
+    of the id before the range and the last id of the range, None for the open ends.
+    """
+    total = queryset.count()
+    ids = queryset.order_by('id').values_list('id', flat=True)
+    # Each bound costs a query skipping to it on the _id index. Fewer ranges are returned for fewer ids than count.
+    offsets = sorted(set(total * partition / count for partition in range(1, count)) - set([0]))
+    bounds = [None] + [ids[offset - 1] for offset in offsets] + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def filter_id_range(queryset, lower_id, upper_id):
+    if lower_id is not None:
+        queryset = queryset.filter(id__gt=lower_id)
+    if upper_id is not None:
+        queryset = queryset.filter(id__lte=upper_id)
+    return queryset
+
+
+class Reindexer(object):
+    """
+    Pushes all objects of a model that its search index covers to Solr. The ids are split into one range per worker
+    process. Each worker reads its range with a cursor on the id and records the last id indexed in a
+    ReindexCheckpoint after every batch, so that an interrupted reindex can be resumed where it stopped.
+    """
+
+    def __init__(self, model, workers=1, batch_size=REINDEX_BATCH_SIZE, report_interval=REINDEX_REPORT_INTERVAL):
+        self.model = model
+        self.model_key = get_model_key(model)
+        self.workers = max(workers, 1)
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+
+    def get_checkpoints(self):
+        return ReindexCheckpoint.objects.filter(model=self.model_key).order_by('partition')
+
+    def start(self):
+        """ Discards the checkpoints of an earlier reindex and creates those of the ranges of a new one """
+        self.discard()
+        queryset = get_index(self.model).index_queryset()
+        for (partition, (lower_id, upper_id)) in enumerate(get_id_partitions(queryset, self.workers)):
+            ReindexCheckpoint.objects.create(model=self.model_key, partition=partition, lower_id=lower_id,
+                                             upper_id=upper_id)
+
+    def discard(self):
+        self.get_checkpoints().delete()
+
+    def run(self, resume=False):
+        """ Reindexes the model, or the ranges an earlier reindex did not finish if resuming. Returns the count. """
+        if not (resume and self.get_checkpoints().exists()):
+            self.start()
+        checkpoints = list(self.get_checkpoints().filter(finished=False))
+        already_indexed = self.get_indexed_count()
+        started_at = time.time()
+        logger.info('Reindexing %s in %d ranges, %d documents indexed already...' % (
+            self.model_key, len(checkpoints), already_indexed))
+
+        partitions = [(self.model_key, checkpoint.id, self.batch_size) for checkpoint in checkpoints]
+        if self.workers > 1 and len(partitions) > 1:
+            close_db_connections()
+            pool = multiprocessing.Pool(min(self.workers, len(partitions)))
+            try:
+                result = pool.map_async(reindex_partition, partitions)
+                while not result.ready():
+                    result.wait(self.report_interval)
+                    self.report(already_indexed, started_at)
+                result.get()
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for partition in partitions:
+                reindex_partition(partition)
+
+        haystack_connections['default'].get_backend().conn.commit()
+        indexed = self.report(already_indexed, started_at)
+        self.discard()
+        return indexed
+
+    def get_indexed_count(self):
+        return sum(self.get_checkpoints().values_list('indexed', flat=True))
+
+    def report(self, already_indexed, started_at):
+        """ Logs the number of documents indexed and the documents per second since the reindex (re)started """
+        indexed = self.get_indexed_count()
+        elapsed = max(time.time() - started_at, 0.001)
+        logger.info('Indexed %d %s documents, %.1f per second.' % (
+            indexed, self.model_key, (indexed - already_indexed) / elapsed))
+        return indexed
+
+
+def reindex_partition(partition):
+    """ Indexes the range of a (model key, checkpoint id, batch size) partition, at module level to run in a pool """
+    (model_key, checkpoint_id, batch_size) = partition
+    checkpoint = ReindexCheckpoint.objects.get(id=checkpoint_id)
+    model = get_model(*model_key.split('.'))
+    index = get_index(model)
+    backend = haystack_connections['default'].get_backend()
+
+    queryset = filter_id_range(index.index_queryset(), checkpoint.last_id or checkpoint.lower_id,
+                               checkpoint.upper_id)
+    indexed = checkpoint.indexed
+    for batch in iterate_by_id(queryset, batch_size):
+        backend.update(index, batch)
+        indexed += len(batch)
+        ReindexCheckpoint.objects.filter(id=checkpoint_id).update(last_id=batch[-1].id, indexed=indexed)
+    ReindexCheckpoint.objects.filter(id=checkpoint_id).update(finished=True)
+    return indexed
@@ -4,6 +4,8 @@ from time import time
 from django.utils.termcolors import colorize
 from rest_framework.authtoken.models import Token
 
+from oclapi.search_index_queue import begin_index_update_buffer, end_index_update_buffer, reset_index_update_buffer
+
 request_logger = logging.getLogger('request_logger')
 MAX_BODY_LENGTH = 50000
 
@@ -79,3 +81,18 @@ class FixMalformedLimitParamMiddleware(object):
             if 'limit' not in query_dict_copy:
                 query_dict_copy['limit'] = 100
             request.GET = query_dict_copy
+
+
+class IndexUpdateBufferMiddleware(object):
+    """
+    Buffers the search index updates queued while handling a request, so that they are pushed to the index update
+    queue once, deduplicated, when the response is ready
+    """
+
+    def process_request(self, request):
+        reset_index_update_buffer()
+        begin_index_update_buffer()
+
+    def process_response(self, request, response):
+        end_index_update_buffer()
+        return response
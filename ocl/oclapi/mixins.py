@@ -1,8 +1,12 @@
+import uuid
+
 from django.core.urlresolvers import resolve
-from oclapi.utils import compact, write_csv_to_s3, get_csv_from_s3
+from oclapi.exports import ExportStorageFactory, get_csv_export_path, get_csv_queryset, get_last_update, \
+    CSV_EXPORT_URL_EXPIRY
 from rest_framework.mixins import ListModelMixin
 from rest_framework.response import Response
-from oclapi.utils import compact, extract_values
+from rest_framework.reverse import reverse
+from oclapi.utils import compact, extract_values, compute_content_hash
 from users.models import UserProfile
 from oclapi.filters import SearchQuerySetWrapper
 from mappings.models import Mapping
@@ -113,7 +117,13 @@ class ListWithHeadersMixin(ListModelMixin):
         return map(lambda o: o.id, self.object_list[0:100])
 
     def get_csv(self, request, queryset=None):
-        filename, url, prepare_new_file, is_member = None, None, True, False
+        """
+        Returns the URL of the CSV of the list if a current one is stored, otherwise queues a task writing it and
+        returns a handle of the task, which the csvexport view reports the state and the URL of the CSV for. Views
+        listing more rows than a request should read describe them by get_csv_query, returning their model and the
+        filter and exclude kwargs selecting them.
+        """
+        filename, prepare_new_file, is_member = None, True, False
 
         parent = self.get_parent()
 
@@ -125,21 +135,34 @@ class ListWithHeadersMixin(ListModelMixin):
         try:
             path = request.__dict__.get('_request').path
             filename = '_'.join(compact(path.split('/'))).replace('.', '_')
-            kwargs = {
-                'filename': filename,
-            }
+            # Lists of the same path filtered by other params are stored apart
+            filename += '_' + compute_content_hash(sorted(request.QUERY_PARAMS.lists()))
         except Exception:
-            kwargs = {}
-
-        if filename and prepare_new_file:
-            url = get_csv_from_s3(filename, is_member)
-
-        if not url:
-            queryset = queryset or self._get_query_set_from_view(is_member)
-            data = self.get_csv_rows(queryset) if hasattr(self, 'get_csv_rows') else queryset.values()
-            url = write_csv_to_s3(data, is_member, **kwargs)
+            pass
 
-        return Response({'url': url}, status=200)
+        export_path = get_csv_export_path(filename or str(uuid.uuid4()), is_member)
+        # The task selects the rows again, so only plain data is sent: the model, the filters and the format name
+        csv_query = self.get_csv_query() if is_member and hasattr(self, 'get_csv_query') else None
+        if csv_query:
+            (model, filters, excludes) = csv_query
+        else:
+            if queryset is None:
+                queryset = self._get_query_set_from_view(is_member)
+            # Only the ids of the rows are read in the request
+            (model, filters, excludes) = (queryset.model, {'id__in': list(queryset.values_list('id', flat=True))}, {})
+        model_label = '%s.%s' % (model._meta.app_label, model._meta.module_name)
+
+        storage = ExportStorageFactory.get_export_storage()
+        if filename and prepare_new_file and storage.exists(export_path):
+            # A stored CSV is current while the latest update of its rows is the one it was written after
+            last_update = get_last_update(get_csv_queryset(model, filters, excludes))
+            if last_update and storage.get_last_child_update(export_path) == last_update:
+                return Response({'url': storage.get_url(export_path, CSV_EXPORT_URL_EXPIRY)}, status=200)
+
+        from tasks import export_csv
+        task = export_csv.delay(model_label, filters, excludes, export_path, getattr(self, 'csv_format', None))
+        task_url = reverse('csvexport-list', request=request) + '?task=' + task.id
+        return Response({'task': task.id, 'state': task.state, 'task_url': task_url}, status=202)
 
     def _is_member(self, parent, requesting_user):
         if not parent or type(parent).__name__ in ['UserProfile', 'Organization']:
@@ -179,15 +202,34 @@ class ListWithHeadersMixin(ListModelMixin):
 
 
 class ConceptVersionCSVFormatterMixin():
+    csv_format = 'concept_versions'
+
     def get_csv_rows(self, queryset=None):
-        if not queryset:
+        """ Formats the rows of queryset, a batch of the CSV export task, as their relations are fetched at once """
+        if queryset is None:
             queryset = self.get_queryset()
 
         values = queryset.values('id', 'external_id', 'uri', 'concept_class', 'datatype', 'retired', 'names',
                                             'descriptions', 'created_by', 'created_at')
 
-        for value in values:
-            concept_ver = self.model.objects.get(id=value.pop('id'))
+        # The concept versions, concepts, sources and mappings of the rows are fetched once for the batch
+        self.format_csv_batch(list(values), {})
+
+        values.field_names.extend(['Owner','Source','Concept ID','Preferred Name','Preferred Name Locale','Concept Class','Datatype','Retired','Synonyms','Description'
+                                      ,'External ID','Mappings','Attributes','Last Updated','Updated By','URI'])
+        del values.field_names[0:10]
+        return values
+
+    def format_csv_batch(self, rows, sources):
+        concept_versions = dict((concept_ver.id, concept_ver) for concept_ver in self.model.objects.filter(
+            id__in=[value['id'] for value in rows]))
+        self.model.resolve_export_relations(concept_versions.values(), sources)
+        concepts = dict((concept_ver.versioned_object_id, concept_ver.versioned_object)
+                        for concept_ver in concept_versions.values())
+        concept_mappings = Mapping.get_mappings_from_concepts(concepts, sources)
+
+        for value in rows:
+            concept_ver = concept_versions[value.pop('id')]
             value['Owner'] = concept_ver.owner
             value['Source'] = concept_ver.parent_resource
             value['Concept ID']  = concept_ver.versioned_object.mnemonic
@@ -219,29 +261,22 @@ class ConceptVersionCSVFormatterMixin():
 
             #Include mappings
             value['Mappings'] = ''
-            concept_mappings = Mapping.objects.filter(from_concept=concept_ver.versioned_object)
-            if concept_mappings:
-                mappings = []
-                for mapping in concept_mappings:
-                    row = mapping.owner + ' / ' + mapping.parent.name + ' / ' + mapping.from_concept_code + ' : ' \
-                          + mapping.from_concept_name + ' <' + mapping.map_type +'> ' \
-                          + mapping.to_source_owner_mnemonic + ' / ' + mapping.to_source_name
-                    if (mapping.to_concept):
-                        row = row + ' / ' + mapping.to_concept.mnemonic + ' : ' + mapping.to_concept.display_name + ' [Internal]'
-                    else:
-                        concept_code = mapping.to_concept_code if mapping.to_concept_code else ''
-                        concept_name = mapping.to_concept_name if mapping.to_concept_name else ''
-                        row = row + ' / ' + concept_code + ' : ' + concept_name + ' [External]'
-                    mappings.append(row)
+            mappings = []
+            for mapping in concept_mappings.get(concept_ver.versioned_object_id, []):
+                row = mapping.owner + ' / ' + mapping.parent.name + ' / ' + mapping.from_concept_code + ' : ' \
+                      + mapping.from_concept_name + ' <' + mapping.map_type +'> ' \
+                      + mapping.to_source_owner_mnemonic + ' / ' + mapping.to_source_name
+                if (mapping.to_concept):
+                    row = row + ' / ' + mapping.to_concept.mnemonic + ' : ' + mapping.to_concept.display_name + ' [Internal]'
+                else:
+                    concept_code = mapping.to_concept_code if mapping.to_concept_code else ''
+                    concept_name = mapping.to_concept_name if mapping.to_concept_name else ''
+                    row = row + ' / ' + concept_code + ' : ' + concept_name + ' [External]'
+                mappings.append(row)
 
+            if mappings:
                 value['Mappings'] = '; '.join(mappings)
 
-
-        values.field_names.extend(['Owner','Source','Concept ID','Preferred Name','Preferred Name Locale','Concept Class','Datatype','Retired','Synonyms','Description'
-                                      ,'External ID','Mappings','Attributes','Last Updated','Updated By','URI'])
-        del values.field_names[0:10]
-        return values
-
     def join_values(self, objects):
         localize_text_keys = ['name', 'locale', 'type']
         return ', '.join(
@@ -281,11 +281,43 @@ class ResourceVersionModel(BaseModel):
         return Collection.objects.filter(id__in=list(collection_ids))
 
     def get_collection_ids(self):
+        if hasattr(self, '_collection_ids'):
+            return self._collection_ids
         return list(self.get_collections().values_list('id', flat=True))
 
     def get_collection_version_ids(self):
+        if hasattr(self, '_collection_version_ids'):
+            return self._collection_version_ids
         return list(self.get_collection_versions().values_list('id', flat=True))
 
+    @classmethod
+    def resolve_collection_ids(cls, versions):
+        """
+        Loads the ids of the collections and collection versions containing versions with three queries, so that
+        get_collection_ids and get_collection_version_ids of versions return them without a query per version.
+        """
+        from collection.models import Collection, CollectionVersion
+        membership = {}
+        for (version_id, collection_version_id) in cls.get_collection_memberships([version.id for version in versions]):
+            membership.setdefault(version_id, set()).add(collection_version_id)
+
+        collection_version_ids = set().union(*membership.values())
+        collection_versions = list(CollectionVersion.objects.filter(
+            id__in=list(collection_version_ids)).values_list('id', 'versioned_object_id'))
+        collection_ids = list(Collection.objects.filter(
+            id__in=list(set(collection_id for (_, collection_id) in collection_versions))).values_list('id', flat=True))
+
+        # In the order the queries of get_collection_ids and get_collection_version_ids return them
+        version_positions = dict((version_id, position) for (position, (version_id, _)) in enumerate(collection_versions))
+        collection_positions = dict((collection_id, position) for (position, collection_id) in enumerate(collection_ids))
+        collection_of_version = dict(collection_versions)
+        for version in versions:
+            ids = [id for id in membership.get(version.id, []) if id in version_positions]
+            version._collection_version_ids = sorted(ids, key=version_positions.get)
+            version._collection_ids = sorted(set(collection_of_version[id] for id in ids if
+                                                 collection_of_version[id] in collection_positions),
+                                             key=collection_positions.get)
+
     @classmethod
     def get_latest_version_of(cls, versioned_object):
         versions = versioned_object.get_version_model().objects.filter(versioned_object_id=versioned_object.id, is_active=True).order_by('-created_at')
@@ -317,6 +349,21 @@ class ConceptContainerModel(SubResourceBaseModel):
     class Meta(SubResourceBaseModel.Meta):
         abstract = True
 
+    @classmethod
+    def resolve_owners(cls, containers):
+        """ Attaches their owners to containers, loaded with one query per type of owner """
+        ids_by_type = {}
+        for container in containers:
+            ids_by_type.setdefault(container.parent_type_id, set()).add(container.parent_id)
+        owners = {}
+        for (type_id, ids) in ids_by_type.items():
+            owner_model = ContentType.objects.get_for_id(type_id).model_class()
+            owners.update(((type_id, owner.id), owner) for owner in owner_model.objects.filter(id__in=list(ids)))
+        for container in containers:
+            owner = owners.get((container.parent_type_id, container.parent_id))
+            if owner is not None:
+                container.parent = owner
+
     @property
     def owner(self):
         return self.parent
@@ -655,6 +702,69 @@ class ConceptContainerVersionModel(ResourceVersionModel):
     def clear_all_processing(type):
         type.objects.all().update(_background_process_ids=set())
 
+class ImportCheckpoint(models.Model):
+    """
+    Progress of a concept or mapping import into a source, identified by the hash of the input file. Written every
+    few lines so that a failed import can be resumed at the offset of the first line that was not imported yet.
+    """
+    import_type = models.TextField()
+    source_id = models.TextField()
+    file_hash = models.TextField()
+    source_version_id = models.TextField()
+    offset = models.IntegerField(default=0)
+    lines_handled = models.IntegerField(default=0)
+    action_count = DictField()
+    started_at = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def get_action_count(self):
+        # Keys of Mongo documents are strings
+        return dict((int(action), count) for (action, count) in self.action_count.items())
+
+
+class ImportCheckpointIds(models.Model):
+    """
+    A chunk of ids belonging to an import checkpoint: either ids awaiting deactivation when the import started
+    (offset is None) or ids handled by the lines before offset. Kept apart from the checkpoint so that no document
+    has to hold all ids of a large source. Chunks marked as touched hold the ids of the versions created or changed
+    by the lines before offset, which still have to be indexed.
+    """
+    checkpoint_id = models.TextField()
+    offset = models.IntegerField(null=True)
+    ids = ListField()
+    touched = models.BooleanField(default=False)
+
+
+class ReindexCheckpoint(models.Model):
+    """
+    Progress of the reindex of one range of ids of a model, the ids after lower_id up to and including upper_id,
+    either of which may be open. last_id is the last id indexed, where a resumed reindex of the range continues.
+    """
+    model = models.TextField()
+    partition = models.IntegerField()
+    lower_id = models.TextField(null=True)
+    upper_id = models.TextField(null=True)
+    last_id = models.TextField(null=True)
+    indexed = models.IntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class ExportArtifact(models.Model):
+    """
+    A file written by the export storage, so that whether an export exists, and its size, can be told without a
+    request to the storage backend. last_child_update is the one of the exported version, if any.
+    """
+    path = models.TextField()
+    size = models.IntegerField()
+    last_child_update = models.DateTimeField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class MongoMeta:
+        indexes = [[('path', 1)]]
+
+
 @receiver(post_save, sender=User)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     if instance and created:
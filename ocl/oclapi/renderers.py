@@ -1,3 +1,4 @@
+import json
 import tempfile
 import zipfile
 from django.core.servers.basehttp import FileWrapper
@@ -22,3 +23,15 @@ class ZippedJSONRenderer(JSONRenderer):
         temp.seek(0)
         return wrapper
 
+
+class NDJSONRenderer(JSONRenderer):
+    """ Renders a list as one JSON document per line. Also lets ?format=ndjson through content negotiation """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return ''
+        records = data if isinstance(data, (list, tuple)) else [data]
+        return ''.join(json.dumps(record, cls=self.encoder_class, ensure_ascii=self.ensure_ascii) + '\n'
+                       for record in records)
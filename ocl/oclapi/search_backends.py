@@ -1,6 +1,10 @@
 
+from xml.etree import ElementTree
+
 from haystack.backends.solr_backend import SolrSearchBackend, SolrEngine
+from haystack.constants import ID
 from haystack.fields import CharField, MultiValueField
+from pysolr import SolrError
 
 __author__ = 'misternando'
 
@@ -75,8 +79,34 @@ class OCLSolrBackend(SolrSearchBackend):
         return (content_field_name, schema_fields)
 
     def update(self, index, iterable, commit=False):
+        if hasattr(index, 'prepare_batch'):
+            iterable = index.prepare_batch(iterable)
         super(OCLSolrBackend, self).update(index, iterable, commit=commit)
 
+    def add_to_multi_valued_fields(self, model, ids, values, commit=False):
+        """
+        Adds the values of the field name: value dict to the multi-valued fields of the documents of the objects of
+        model with ids, in one request of atomic updates that leave the other fields of the documents as they are
+        instead of rendering them again. The documents must be indexed already, as Solr creates a document holding
+        just the id and these fields for a missing one.
+        """
+        if not ids:
+            return
+        message = ElementTree.Element('add')
+        for id in ids:
+            doc = ElementTree.SubElement(message, 'doc')
+            ElementTree.SubElement(doc, 'field', name=ID).text = '%s.%s.%s' % (
+                model._meta.app_label, model._meta.module_name, id)
+            for (field_name, value) in values.items():
+                ElementTree.SubElement(doc, 'field', name=field_name, update='add').text = unicode(value)
+
+        try:
+            self.conn._update(ElementTree.tostring(message, encoding='utf-8'), commit=commit)
+        except (IOError, SolrError) as e:
+            if not self.silently_fail:
+                raise
+            self.log.error("Failed to update documents in Solr: %s", e)
+
     def remove(self, obj_or_string, commit=False):
         super(OCLSolrBackend, self).remove(obj_or_string, commit=commit)
 
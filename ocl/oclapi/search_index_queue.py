@@ -0,0 +1,227 @@
+"""
+Queue of search index updates. Saving or deleting an indexed object queues its (model, id) pair instead of updating
+Solr in the request. The pairs are kept in a Redis sorted set, scored by the time they were first queued, so an object
+changed several times before the queue is flushed is indexed once. A task on the dedicated indexing queue flushes it,
+sending the current state of up to INDEX_UPDATE_BATCH_SIZE objects per Solr update. A flush moves each batch to a set of
+updates in progress and removes it from there only once Solr has been updated, so a failed or interrupted flush leaves
+its batch to be queued again.
+
+Requests and import batches buffer the pairs in memory and push them to Redis once, when they end.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+from django.db.models import get_model
+
+INDEX_QUEUE_KEY = 'oclapi:index_queue'
+# Pairs taken from the queue by a flush that has not updated Solr with them yet
+INDEX_QUEUE_IN_PROGRESS_KEY = 'oclapi:index_queue:in_progress'
+# Set while a flush of the queue is scheduled, so that pushes do not schedule one each
+INDEX_QUEUE_FLUSH_SCHEDULED_KEY = 'oclapi:index_queue:flush_scheduled'
+# Expiry of the scheduled flag, in case the scheduled flush is lost
+INDEX_QUEUE_FLUSH_SCHEDULED_EXPIRY = 300
+# Seconds a flush waits after being scheduled, so that the updates of concurrent requests are sent together
+INDEX_QUEUE_FLUSH_COUNTDOWN = 1
+# Number of objects sent to Solr in one update
+INDEX_UPDATE_BATCH_SIZE = 1000
+
+# Moves the ARGV[1] pairs queued first to the updates in progress, keeping their scores, and returns them with scores
+CLAIM_INDEX_UPDATES_SCRIPT = """
+local pairs = redis.call('ZRANGE', KEYS[1], 0, ARGV[1] - 1, 'WITHSCORES')
+for i = 1, #pairs, 2 do
+    redis.call('ZADD', KEYS[2], pairs[i + 1], pairs[i])
+end
+if #pairs > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, ARGV[1] - 1)
+end
+return pairs
+"""
+
+
+class IndexUpdateBuffer(threading.local):
+    def __init__(self):
+        self.depth = 0
+        self.pairs = set()
+
+
+buffer = IndexUpdateBuffer()
+redis_connection = None
+
+
+def get_redis_connection():
+    global redis_connection
+    if redis_connection is None:
+        redis_connection = redis.StrictRedis.from_url(
+            settings.INDEX_QUEUE_REDIS_URL or settings.CELERY_RESULT_BACKEND)
+    return redis_connection
+
+
+def is_index_queue_enabled():
+    # Imported here, as haystack imports the signal processor of the settings when it is first imported
+    import haystack
+    from oclapi.signals import QueuedSignalProcessor
+    return isinstance(haystack.signal_processor, QueuedSignalProcessor)
+
+
+def get_model_key(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.module_name)
+
+
+def queue_index_update(model, ids):
+    """ Queues the objects of model with ids for an index update, which removes those that no longer exist """
+    if not is_index_queue_enabled():
+        return
+    import haystack
+    from haystack.exceptions import NotHandled
+    try:
+        haystack.connections['default'].get_unified_index().get_index(model)
+    except NotHandled:
+        return
+    pairs = set('%s:%s' % (get_model_key(model), id) for id in ids if id)
+    if buffer.depth:
+        buffer.pairs.update(pairs)
+    else:
+        push_index_updates(pairs)
+
+
+def begin_index_update_buffer():
+    buffer.depth += 1
+
+
+def end_index_update_buffer():
+    buffer.depth -= 1
+    if not buffer.depth:
+        push_buffered_index_updates()
+
+
+def reset_index_update_buffer():
+    """ Pushes what a buffer left open, e.g. by a request that failed before its end was handled, and closes it """
+    buffer.depth = 0
+    push_buffered_index_updates()
+
+
+@contextmanager
+def buffer_index_updates():
+    """ Buffers the index updates queued in the block, pushing them once it ends """
+    begin_index_update_buffer()
+    try:
+        yield
+    finally:
+        end_index_update_buffer()
+
+
+def push_buffered_index_updates():
+    pairs = buffer.pairs
+    buffer.pairs = set()
+    push_index_updates(pairs)
+
+
+def push_index_updates(pairs):
+    """ Adds pairs to the queue, keeping the time those already queued were first queued, and schedules a flush """
+    if not pairs:
+        return
+    connection = get_redis_connection()
+    now = time.time()
+    args = []
+    for pair in pairs:
+        args += [now, pair]
+    connection.execute_command('ZADD', INDEX_QUEUE_KEY, 'NX', *args)
+    if connection.set(INDEX_QUEUE_FLUSH_SCHEDULED_KEY, 1, ex=INDEX_QUEUE_FLUSH_SCHEDULED_EXPIRY, nx=True):
+        from tasks import flush_index_queue
+        flush_index_queue.apply_async(countdown=INDEX_QUEUE_FLUSH_COUNTDOWN)
+
+
+def claim_index_updates(count):
+    """
+    Moves the count pairs queued first from the queue to the updates in progress and returns them with the times
+    they were queued. Pushes made meanwhile queue the pairs again, so changes made while they are sent are not lost.
+    """
+    values = get_redis_connection().eval(
+        CLAIM_INDEX_UPDATES_SCRIPT, 2, INDEX_QUEUE_KEY, INDEX_QUEUE_IN_PROGRESS_KEY, count)
+    return [(values[i], float(values[i + 1])) for i in range(0, len(values), 2)]
+
+
+def complete_index_updates(pairs):
+    """ Removes pairs, sent to Solr, from the updates in progress """
+    if pairs:
+        get_redis_connection().zrem(INDEX_QUEUE_IN_PROGRESS_KEY, *pairs)
+
+
+def requeue_index_updates(scored_pairs):
+    """ Moves (pair, queued at) pairs back from the updates in progress to the queue, keeping when they were queued """
+    if not scored_pairs:
+        return
+    args = []
+    for (pair, score) in scored_pairs:
+        args += [score, pair]
+    pipe = get_redis_connection().pipeline()
+    pipe.execute_command('ZADD', INDEX_QUEUE_KEY, 'NX', *args)
+    pipe.zrem(INDEX_QUEUE_IN_PROGRESS_KEY, *[pair for (pair, score) in scored_pairs])
+    pipe.execute()
+
+
+def requeue_interrupted_index_updates():
+    """
+    Queues again the updates left in progress by a flush that did not end, e.g. because its worker was killed. Those
+    of a flush still running are then sent twice, which only costs an extra update.
+    """
+    scored_pairs = get_redis_connection().zrange(INDEX_QUEUE_IN_PROGRESS_KEY, 0, -1, withscores=True)
+    requeue_index_updates(scored_pairs)
+    return len(scored_pairs)
+
+
+def flush_index_queue(batch_size=INDEX_UPDATE_BATCH_SIZE):
+    """
+    Indexes the current state of the queued objects until the queue is empty and returns their number. A batch that
+    fails is queued again before the error is raised. Also serves as a barrier for tests, which flush the queue
+    before searching.
+    """
+    # Pushes from here on schedule another flush, those before are handled by this one
+    get_redis_connection().delete(INDEX_QUEUE_FLUSH_SCHEDULED_KEY)
+    requeue_interrupted_index_updates()
+    flushed = 0
+    scored_pairs = claim_index_updates(batch_size)
+    while scored_pairs:
+        pairs = [pair for (pair, score) in scored_pairs]
+        try:
+            update_index(pairs)
+        except Exception:
+            requeue_index_updates(scored_pairs)
+            raise
+        complete_index_updates(pairs)
+        flushed += len(pairs)
+        scored_pairs = claim_index_updates(batch_size)
+    return flushed
+
+
+def update_index(pairs):
+    """ Updates the index of the objects of the model.id:id pairs that exist and removes those that do not """
+    ids_by_model = {}
+    for pair in pairs:
+        (model_key, id) = pair.split(':', 1)
+        ids_by_model.setdefault(model_key, set()).add(id)
+
+    import haystack
+    connection = haystack.connections['default']
+    backend = connection.get_backend()
+    for (model_key, ids) in ids_by_model.items():
+        model = get_model(*model_key.split('.'))
+        index = connection.get_unified_index().get_index(model)
+        objects = list(index.index_queryset().filter(id__in=list(ids)))
+        if objects:
+            backend.update(index, objects)
+        for id in ids - set(obj.id for obj in objects):
+            backend.remove('%s.%s' % (model_key, id))
+
+
+def get_index_queue_stats():
+    """ Returns the number of queued objects and the seconds the object queued first has been waiting """
+    connection = get_redis_connection()
+    oldest = connection.zrange(INDEX_QUEUE_KEY, 0, 0, withscores=True)
+    return {
+        'size': connection.zcard(INDEX_QUEUE_KEY),
+        'lag': time.time() - oldest[0][1] if oldest else 0,
+    }
@@ -10,6 +10,12 @@ class OCLSearchIndex(SearchIndex):
     def get_updated_field(self):
         return 'updated_at'
 
+    def prepare_batch(self, objs):
+        """
+        Called by the search backend with a batch of objects before preparing them. Indexes load what preparing the
+        objects needs for the whole batch here, instead of once per object. Returns the objects as a list.
+        """
+        return list(objs)
 
     def prepare(self, obj):
         self.prepared_data = super(OCLSearchIndex, self).prepare(obj)
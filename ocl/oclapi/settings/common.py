@@ -119,6 +119,7 @@ class Common(Configuration):
         'django.contrib.auth.middleware.AuthenticationMiddleware',
         'django.contrib.messages.middleware.MessageMiddleware',
         'oclapi.middlewares.RequestLogMiddleware',
+        'oclapi.middlewares.IndexUpdateBufferMiddleware',
     )
 
     ROOT_URLCONF = 'urls'
@@ -184,6 +185,7 @@ class Common(Configuration):
             # from the database when displying the create form. See https://github.com/OpenConceptLab/oclapi/issues/532
             #'rest_framework.renderers.BrowsableAPIRenderer',
             'oclapi.renderers.ZippedJSONRenderer',
+            'oclapi.renderers.NDJSONRenderer',
         ),
         'DEFAULT_CONTENT_NEGOTIATION_CLASS': 'oclapi.negotiation.OptionallyCompressContentNegotiation',
         # Use hyperlinked styles by default.
@@ -265,7 +267,9 @@ class Common(Configuration):
     # RealtimeSignalProcessor will update the index for every mongo update, sometimes at
     # the cost of performance. BaseSignalProcessor does not update the index at all, which
     # means the index must be updated manually (e.g. using the haystack update_index command).
-    HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+    # QueuedSignalProcessor queues the updated objects, which a worker of the indexing queue
+    # indexes in batches.
+    HAYSTACK_SIGNAL_PROCESSOR = 'oclapi.signals.QueuedSignalProcessor'
     HAYSTACK_ITERATOR_LOAD_PER_QUERY = 25
     HAYSTACK_SEARCH_RESULTS_PER_PAGE = 25
     # Override to properly support Mongo identifiers with alphanumerics
@@ -273,11 +277,26 @@ class Common(Configuration):
 
     # Celery settings
     CELERY_RESULT_BACKEND = 'redis://redis.openconceptlab.org:6379/0'
+    # Redis holding the search index update queue, CELERY_RESULT_BACKEND if not set
+    INDEX_QUEUE_REDIS_URL = os.environ.get('INDEX_QUEUE_REDIS_URL')
     # Set these in your postactivate hook if you use virtualenvwrapper
     AWS_ACCESS_KEY_ID=os.environ.get('AWS_ACCESS_KEY_ID', '')
     AWS_SECRET_ACCESS_KEY=os.environ.get('AWS_SECRET_ACCESS_KEY', '')
     AWS_STORAGE_BUCKET_NAME=os.environ.get('AWS_STORAGE_BUCKET_NAME', '')
 
+    # Number of processes serializing the concepts and mappings of an export in parallel, 0 serializes in the task
+    EXPORT_SERIALIZATION_WORKERS = int(os.environ.get('EXPORT_SERIALIZATION_WORKERS', 0))
+
+    # Storage of export files: oclapi.exports.S3ExportStorage, or oclapi.exports.LocalExportStorage for a directory
+    # published by the web server
+    EXPORT_STORAGE = os.environ.get('EXPORT_STORAGE', 'oclapi.exports.S3ExportStorage')
+    EXPORT_LOCAL_ROOT = os.environ.get('EXPORT_LOCAL_ROOT', '/var/lib/oclapi/exports')
+    EXPORT_LOCAL_URL = os.environ.get('EXPORT_LOCAL_URL', '/exports/')
+    # Header handing local export downloads to the web server, e.g. X-Accel-Redirect or X-Sendfile, and the URL
+    # under which the web server finds EXPORT_LOCAL_ROOT for it
+    EXPORT_SENDFILE_HEADER = os.environ.get('EXPORT_SENDFILE_HEADER', '')
+    EXPORT_SENDFILE_URL = os.environ.get('EXPORT_SENDFILE_URL', '/protected-exports/')
+
     # Model that stores auxiliary user profile attributes.
     # A user must have a profile in order to access the system.
     # (A profile is created automatically for any user created using the 'POST /users' endpoint.)
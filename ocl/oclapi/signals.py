@@ -0,0 +1,13 @@
+from haystack.signals import RealtimeSignalProcessor
+
+from oclapi.search_index_queue import queue_index_update
+
+
+class QueuedSignalProcessor(RealtimeSignalProcessor):
+    """ Queues the objects saved or deleted for an index update instead of updating the index right away """
+
+    def handle_save(self, sender, instance, **kwargs):
+        queue_index_update(sender, [instance.id])
+
+    def handle_delete(self, sender, instance, **kwargs):
+        queue_index_update(sender, [instance.id])
@@ -1,10 +1,34 @@
+import csv
+import gzip
+import json
+import os
+import tempfile
+import zipfile
+from StringIO import StringIO
+from datetime import datetime, timedelta
+from xml.etree import ElementTree
+
+from boto.s3.connection import S3Connection
 from django.contrib.auth.models import User
-from oclapi.models import ACCESS_TYPE_EDIT
+from django.test.client import RequestFactory
+from mock import patch, Mock
+from moto import mock_s3
+from oclapi.models import ACCESS_TYPE_EDIT, ExportArtifact
 from orgs.models import Organization
+from orgs.views import OrganizationListView
+from rest_framework.request import Request
 from sources.models import Source, SourceVersion
 from users.models import UserProfile
 from test_helper.base import OclApiBaseTestCase
-from oclapi.utils import compact, extract_values
+from oclapi.management.commands.import_concepts_to_source import Command as ImportConceptsCommand
+from oclapi.management.reconcile import diff_timestamps, normalize_timestamp, iterate_index_timestamps, \
+    parse_index_timestamp, MISSING, STALE, ORPHANED
+from oclapi.management.reindex import get_id_partitions, filter_id_range
+from oclapi.search_index_queue import buffer_index_updates, queue_index_update
+from oclapi.utils import compact, extract_values, compute_content_hash, LRUCache, SavedIdsRecorder, iterate_by_id, \
+    haystack_connections
+from oclapi.exports import S3MultipartUploadStream, ZipStreamWriter, iterate_content_defined_batches, ExportChunkStore, \
+    serialize_export_batch, write_export_batches, LocalExportStorage, write_csv_export_file
 
 class ResourceVersionModelBaseTest(OclApiBaseTestCase):
 
@@ -102,3 +126,312 @@ class UtilsTest(OclApiBaseTestCase):
         self.assertListEqual(extract_values({'k1': 1, 'k2': '2', 'k3': None, 'k4': 'foobar'}, ['k2', 'k1', 'k3']), ['2', 1, None])
         self.assertListEqual(extract_values({'k1': '2'}, ['k1']), ['2'])
         self.assertListEqual(extract_values({'k1': 1}, ['k1']), [1])
+
+    def test_compute_content_hash(self):
+        self.assertEquals(compute_content_hash({'a': 1, 'b': [u'x', None]}), compute_content_hash({'b': ['x', None], 'a': 1}))
+        self.assertNotEquals(compute_content_hash({'a': 1}), compute_content_hash({'a': '1'}))
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = None
+        self.assertEquals(1, cache['a'])
+        cache['c'] = 3
+        self.assertTrue('b' not in cache)
+        self.assertTrue('a' in cache)
+        self.assertEquals(2, len(cache))
+        self.assertEquals(None, cache.get('b', None))
+
+    def test_iterate_by_id(self):
+        organizations = [Organization.objects.create(name='org%s' % index, mnemonic='batched%s' % index) for index in range(5)]
+        batches = list(iterate_by_id(Organization.objects.filter(mnemonic__startswith='batched'), 2))
+
+        self.assertEquals([2, 2, 1], [len(batch) for batch in batches])
+        self.assertEquals(sorted(organization.id for organization in organizations),
+                          [organization.id for batch in batches for organization in batch])
+
+    def test_zip_stream_writer(self):
+        stream = StringIO()
+        writer = ZipStreamWriter(stream, 'export.json')
+        writer.write('{"concepts": [')
+        writer.write('1, 2, 3]}')
+        writer.close()
+
+        archive = zipfile.ZipFile(StringIO(stream.getvalue()))
+        self.assertEquals(None, archive.testzip())
+        self.assertEquals('{"concepts": [1, 2, 3]}', archive.read('export.json'))
+
+    @mock_s3
+    def test_s3_multipart_upload_stream(self):
+        bucket = S3Connection().create_bucket('exports')
+        part_size = 5 * 1024 * 1024
+        upload = S3MultipartUploadStream(bucket, 'export.zip', part_size=part_size)
+        upload.write('a' * part_size)
+        upload.write('b')
+        self.assertEquals(None, bucket.get_key('export.zip'))
+        upload.close()
+
+        self.assertEquals(2, upload.parts)
+        self.assertEquals('a' * part_size + 'b', bucket.get_key('export.zip').get_contents_as_string())
+
+    def test_iterate_content_defined_batches(self):
+        ids = ['%024x' % index for index in range(1000)]
+        batches = list(iterate_content_defined_batches(ids, average_size=16, max_size=64))
+        del ids[500]
+        batches_after_removal = list(iterate_content_defined_batches(ids, average_size=16, max_size=64))
+
+        self.assertEquals(ids, [id for batch in batches_after_removal for id in batch])
+        self.assertTrue(max(len(batch) for batch in batches) <= 64)
+        changed_batches = [batch for batch in batches_after_removal if batch not in batches]
+        self.assertEquals(1, len(changed_batches))
+        self.assertTrue(ids[500] in changed_batches[0])
+
+    def test_export_chunk_store(self):
+        storage = LocalExportStorage(tempfile.mkdtemp())
+        chunk_store = ExportChunkStore(storage)
+        chunk = chunk_store.add(2, '{"id": "1"}, {"id": "2"}')
+        self.assertEquals(chunk, ExportChunkStore(storage).add(2, '{"id": "1"}, {"id": "2"}'))
+
+        self.assertEquals(1, chunk_store.uploaded)
+        self.assertEquals(2, chunk['count'])
+        self.assertEquals(['%s.json.gz' % chunk['sha1']], os.listdir(os.path.join(storage.root, 'chunks')))
+
+    def test_local_export_storage(self):
+        storage = LocalExportStorage(tempfile.mkdtemp())
+        storage.write('org/v1.zip', 'abcdef')
+        upload = storage.open_upload('org/v2.zip')
+        upload.write('xy')
+        upload.copy('org/v1.zip', 2, 5)
+        self.assertFalse(storage.exists('org/v2.zip'))
+        upload.close()
+
+        self.assertEquals('xycde', storage.read('org/v2.zip'))
+        self.assertEquals('cd', storage.read_range('org/v2.zip', 2, 4))
+        self.assertEquals(5, ExportArtifact.objects.get(path='org/v2.zip').size)
+        storage.delete('org/v2.zip')
+        self.assertFalse(storage.exists('org/v2.zip'))
+
+        # Files stored before they were recorded are recorded when first found
+        with open(os.path.join(storage.root, 'org', 'v3.zip'), 'wb') as export_file:
+            export_file.write('abc')
+        self.assertTrue(storage.exists('org/v3.zip'))
+        self.assertEquals(3, ExportArtifact.objects.get(path='org/v3.zip').size)
+        self.assertRaises(ValueError, storage.exists, '../v1.zip')
+
+    @mock_s3
+    def test_zip_stream_writer_copy(self):
+        bucket = S3Connection().create_bucket('exports')
+        upload = S3MultipartUploadStream(bucket, 'v1.zip')
+        writer = ZipStreamWriter(upload, 'export.json')
+        writer.write('{"id": "v1"')
+        writer.mark()
+        writer.write(', "concepts": [1, 2, 3]}')
+        writer.close()
+        upload.close()
+        marked_part = writer.get_marked_part()
+
+        upload = S3MultipartUploadStream(bucket, 'v2.zip')
+        writer = ZipStreamWriter(upload, 'export.json')
+        writer.write('{"id": "v2", "released": true')
+        writer.copy('v1.zip', marked_part['offset'], marked_part['end'], marked_part['size'],
+                    marked_part['crc'])
+        writer.close()
+        upload.close()
+
+        archive = zipfile.ZipFile(StringIO(bucket.get_key('v2.zip').get_contents_as_string()))
+        self.assertEquals(None, archive.testzip())
+        self.assertEquals('{"id": "v2", "released": true, "concepts": [1, 2, 3]}', archive.read('export.json'))
+        self.assertEquals(marked_part['size'], writer.get_marked_part()['size'])
+        self.assertEquals(marked_part['crc'], writer.get_marked_part()['crc'])
+
+    def test_serialize_export_batch_line_delimited(self):
+        organizations = [Organization.objects.create(name='org%s' % index, mnemonic='lines%s' % index) for index in range(2)]
+        ids = [organization.id for organization in organizations]
+        chunk = ('orgs.models.Organization', 'orgs.serializers.OrganizationListSerializer', ids, True, None)
+        (count, batch_string) = serialize_export_batch(chunk)
+        lines = batch_string.split('\n')
+
+        self.assertEquals(2, count)
+        self.assertEquals('', lines[-1])
+        self.assertItemsEqual(['lines0', 'lines1'], [json.loads(line)['id'] for line in lines[:-1]])
+
+        (count, array_string) = serialize_export_batch(chunk[:3] + (False, None))
+        self.assertItemsEqual([json.loads(line) for line in lines[:-1]], json.loads('[%s]' % array_string))
+
+    def test_write_export_batches_in_parallel(self):
+        organizations = [Organization.objects.create(name='org%s' % index, mnemonic='parallel%s' % index)
+                         for index in range(5)]
+        id_batches = [[organization.id for organization in organizations[start:start + 2]] for start in range(0, 5, 2)]
+        args = ('orgs.models.Organization', 'orgs.serializers.OrganizationListSerializer', 'source', 'organizations',
+                Mock())
+
+        serial_out = StringIO()
+        with self.settings(EXPORT_SERIALIZATION_WORKERS=0):
+            write_export_batches(serial_out, id_batches, *args)
+
+        parallel_out = StringIO()
+        chunk_dir = tempfile.mkdtemp()
+        with self.settings(EXPORT_SERIALIZATION_WORKERS=2), \
+                patch('oclapi.exports.tempfile.mkdtemp', return_value=chunk_dir):
+            write_export_batches(parallel_out, id_batches, *args)
+
+        self.assertEquals(serial_out.getvalue(), parallel_out.getvalue())
+        self.assertEquals(['parallel%s' % index for index in range(5)],
+                          [data['id'] for data in json.loads('[%s]' % parallel_out.getvalue())])
+        self.assertFalse(os.path.exists(chunk_dir))
+
+    def test_write_csv_export_file(self):
+        for index in range(3):
+            Organization.objects.create(name=u'org\xe9%s' % index, mnemonic='csv%s' % index)
+        storage = LocalExportStorage(tempfile.mkdtemp())
+        queryset = Organization.objects.filter(mnemonic__startswith='csv')
+        write_csv_export_file(queryset, 'downloads/reader/orgs.csv.gz', storage=storage, batch_size=2)
+
+        rows = list(csv.reader(gzip.open(os.path.join(storage.root, 'downloads', 'reader', 'orgs.csv.gz'))))
+        mnemonic_index = rows[0].index('mnemonic')
+        self.assertEquals(4, len(rows))
+        self.assertItemsEqual(['csv0', 'csv1', 'csv2'], [row[mnemonic_index] for row in rows[1:]])
+        self.assertIn('org\xc3\xa90', [row[rows[0].index('name')] for row in rows[1:]])
+        self.assertTrue(storage.exists('downloads/reader/orgs.csv.gz'))
+
+    def test_export_csv_task(self):
+        from tasks import export_csv
+        organizations = [Organization.objects.create(name='org%s' % index, mnemonic='csvtask%s' % index)
+                         for index in range(4)]
+        storage = LocalExportStorage(tempfile.mkdtemp())
+        with patch('oclapi.exports.ExportStorageFactory.get_export_storage', return_value=storage):
+            path = export_csv('orgs.organization', {'mnemonic__startswith': 'csvtask'}, {'mnemonic': 'csvtask1'},
+                              'downloads/reader/orgs_task.csv.gz')
+
+        rows = list(csv.reader(gzip.open(os.path.join(storage.root, 'downloads', 'reader', 'orgs_task.csv.gz'))))
+        self.assertEquals('downloads/reader/orgs_task.csv.gz', path)
+        expected_ids = sorted(organization.id for organization in organizations if organization.mnemonic != 'csvtask1')
+        self.assertEquals(expected_ids, [row[rows[0].index('id')] for row in rows[1:]])
+
+    def test_get_csv_serves_current_export(self):
+        from tasks import export_csv
+        organization = Organization.objects.create(name='org', mnemonic='csvcache')
+        queryset = Organization.objects.filter(mnemonic='csvcache')
+        storage = LocalExportStorage(tempfile.mkdtemp())
+
+        def get_csv(params):
+            request = Request(RequestFactory().get('/orgs/', params))
+            return OrganizationListView().get_csv(request, queryset)
+
+        def run_export(*args):
+            export_csv(*args)
+            return Mock(id='task', state='SUCCESS')
+
+        with patch('oclapi.mixins.ExportStorageFactory.get_export_storage', return_value=storage), \
+                patch('oclapi.exports.ExportStorageFactory.get_export_storage', return_value=storage), \
+                patch('tasks.export_csv.delay', side_effect=run_export) as delay:
+            self.assertEquals(202, get_csv({'csv': 'true'}).status_code)
+            self.assertEquals(200, get_csv({'csv': 'true'}).status_code)
+            self.assertEquals(1, delay.call_count)
+
+            # Other params and later updates are exported again
+            self.assertEquals(202, get_csv({'csv': 'true', 'includeRetired': 'true'}).status_code)
+            Organization.objects.filter(id=organization.id).update(updated_at=datetime.now() + timedelta(minutes=1))
+            self.assertEquals(202, get_csv({'csv': 'true'}).status_code)
+            self.assertEquals(3, delay.call_count)
+
+    def test_buffer_index_updates(self):
+        with patch('oclapi.search_index_queue.is_index_queue_enabled', return_value=True), \
+                patch('oclapi.search_index_queue.push_index_updates') as push_index_updates:
+            with buffer_index_updates():
+                queue_index_update(Organization, ['1', '2'])
+                with buffer_index_updates():
+                    queue_index_update(Organization, ['1'])
+                self.assertFalse(push_index_updates.called)
+
+        push_index_updates.assert_called_once_with(set(['orgs.organization:1', 'orgs.organization:2']))
+
+    def test_saved_ids_recorder(self):
+        recorder = SavedIdsRecorder(Organization)
+        recorder.start()
+        try:
+            organization = Organization.objects.create(name='recorded', mnemonic='recorded')
+            recorder.add(['other-id', organization.id])
+        finally:
+            recorder.stop()
+        Organization.objects.create(name='not-recorded', mnemonic='not-recorded')
+
+        self.assertEquals(set([organization.id, 'other-id']), recorder.ids)
+        self.assertEquals([organization.id, 'other-id'], recorder.pop_recent_ids())
+        self.assertEquals([], recorder.pop_recent_ids())
+
+
+class ImportCommandTest(OclApiBaseTestCase):
+    def test_get_partition(self):
+        command = ImportConceptsCommand()
+        self.assertEquals(command.get_partition('{"id": "1", "names": []}', 4), command.get_partition('{"id": "1"}', 4))
+        self.assertEquals(0, command.get_partition('not json', 4))
+        partitions = set(command.get_partition('{"id": "%s"}' % mnemonic, 4) for mnemonic in range(100))
+        self.assertEquals(set(range(4)), partitions)
+
+
+class ReindexTest(OclApiBaseTestCase):
+    def test_get_id_partitions(self):
+        ids = [Organization.objects.create(name='org', mnemonic='reindex%s' % index).id for index in range(7)]
+        queryset = Organization.objects.filter(id__in=ids)
+
+        partitions = get_id_partitions(queryset, 3)
+        self.assertEquals(3, len(partitions))
+        self.assertEquals(None, partitions[0][0])
+        self.assertEquals(None, partitions[-1][1])
+        ranges = [list(filter_id_range(queryset, lower_id, upper_id).order_by('id').values_list('id', flat=True))
+                  for (lower_id, upper_id) in partitions]
+        self.assertEquals(sorted(ids), sum(ranges, []))
+        self.assertEquals([2, 2, 3], [len(ids_in_range) for ids_in_range in ranges])
+
+        self.assertEquals([(None, None)], get_id_partitions(queryset, 1))
+        self.assertEquals(7, len(get_id_partitions(queryset, 10)))
+
+
+class ReconcileTest(OclApiBaseTestCase):
+    def test_diff_timestamps(self):
+        updated_at = datetime(2017, 1, 1, 12, 0, 0, 123456)
+        database_pairs = [('a', updated_at), ('b', updated_at), ('d', updated_at), ('f', updated_at)]
+        index_pairs = [('b', normalize_timestamp(updated_at)), ('c', updated_at), ('d', datetime(2016, 1, 1)),
+                       ('e', updated_at)]
+
+        database_pairs = [(id, normalize_timestamp(last_update)) for (id, last_update) in database_pairs]
+
+        differences = list(diff_timestamps(iter(database_pairs), iter(index_pairs)))
+        self.assertEquals([('a', MISSING), ('c', ORPHANED), ('d', STALE), ('e', ORPHANED), ('f', MISSING)], differences)
+
+    def test_diff_index_timestamps_with_milliseconds(self):
+        backend = haystack_connections['default'].get_backend()
+        docs = [{'django_id': 'a', 'lastUpdate': '2017-01-01T12:00:00.123Z'},
+                {'django_id': 'b', 'lastUpdate': '2017-01-01T12:00:00Z'}]
+        with patch.object(backend.conn, 'search') as search:
+            search.return_value.docs = docs
+            index_pairs = list(iterate_index_timestamps(backend, Organization))
+
+        database_pairs = [('a', normalize_timestamp(datetime(2017, 1, 1, 12, 0, 0, 123456))),
+                          ('b', normalize_timestamp(datetime(2017, 1, 1, 12, 0, 0)))]
+        self.assertEquals([], list(diff_timestamps(iter(database_pairs), iter(index_pairs))))
+
+    def test_parse_index_timestamp(self):
+        self.assertEquals(datetime(2017, 1, 1, 12, 0, 0, 120000), parse_index_timestamp('2017-01-01T12:00:00.12Z'))
+        self.assertEquals(datetime(2017, 1, 1, 12, 0, 0, 123000), parse_index_timestamp('2017-01-01T12:00:00.1234Z'))
+        self.assertEquals(None, parse_index_timestamp(None))
+
+    def test_diff_timestamps_out_of_order(self):
+        with self.assertRaises(ValueError):
+            list(diff_timestamps(iter([('b', None), ('a', None)]), iter([])))
+
+
+class SearchBackendTest(OclApiBaseTestCase):
+    def test_add_to_multi_valued_fields(self):
+        backend = haystack_connections['default'].get_backend()
+        with patch.object(backend.conn, '_update') as update:
+            backend.add_to_multi_valued_fields(Organization, ['1', '2'], {'source_version': 'v1'})
+
+        message = ElementTree.fromstring(update.call_args[0][0])
+        self.assertEquals(['orgs.organization.1', 'orgs.organization.2'],
+                          [doc.find("field[@name='id']").text for doc in message.findall('doc')])
+        for doc in message.findall('doc'):
+            field = doc.find("field[@name='source_version']")
+            self.assertEquals(('add', 'v1'), (field.get('update'), field.text))
+        self.assertFalse(update.call_args[1]['commit'])
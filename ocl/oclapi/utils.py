@@ -1,25 +1,28 @@
+import collections
+import hashlib
 import json
-import os
-import zipfile
-import tempfile
+import math
 
+import billiard
 import haystack
-from boto.s3.key import Key
 from boto.s3.connection import S3Connection
 from haystack.utils import loading
 from rest_framework.reverse import reverse
-from rest_framework.utils import encoders
 from django.core.urlresolvers import NoReverseMatch
 from operator import is_not, itemgetter
-from djqscsv import csv_file_for
 
 from django.conf import settings
+from django.db import connections
+from django.db.models.signals import post_save
 
 
 __author__ = 'misternando'
 
 haystack_connections = loading.ConnectionHandler(settings.HAYSTACK_CONNECTIONS)
 
+# Number of documents given a new version id in one atomic update request, which carries just the id and the value
+ATOMIC_UPDATE_BATCH_SIZE = 5000
+
 
 class S3ConnectionFactory:
     s3_connection = None
@@ -109,131 +112,41 @@ def get_class(kls):
     return m
 
 
-def write_export_file(version, resource_type, resource_serializer_type, logger):
-    cwd = cd_temp()
-    logger.info('Writing export file to tmp directory: %s' % cwd)
-
-    logger.info('Found %s version %s.  Looking up resource...' % (resource_type, version.mnemonic))
-    resource = version.versioned_object
-    logger.info('Found %s %s.  Serializing attributes...' % (resource_type, resource.mnemonic))
-
-    resource_serializer = get_class(resource_serializer_type)(version)
-    data = resource_serializer.data
-    resource_string = json.dumps(data, cls=encoders.JSONEncoder)
-    logger.info('Done serializing attributes.')
-
-    with open('export.json', 'wb') as out:
-        out.write('%s, "concepts": [' % resource_string[:-1])
-
-    batch_size = 1000
-    if resource_type == 'collection':
-        total_concepts = version.get_concepts_count()
-    else:
-        total_concepts = version.get_concepts().filter(is_active=True).count()
-
-    if total_concepts:
-        logger.info('%s has %d concepts. Getting them in batches of %d...' % (resource_type.title(), total_concepts, batch_size))
-        concept_serializer_class = get_class('concepts.serializers.ConceptVersionDetailSerializer')
-        for start in range(0, total_concepts, batch_size):
-            end = min(start + batch_size, total_concepts)
-            logger.info('Serializing concepts %d - %d...' % (start+1, end))
-            if resource_type == 'collection':
-                concept_versions = version.get_concepts(start, end)
-            else:
-                concept_versions = version.get_concepts().filter(is_active=True)[start:end]
-            concept_serializer = concept_serializer_class(concept_versions, many=True)
-            concept_data = concept_serializer.data
-            concept_string = json.dumps(concept_data, cls=encoders.JSONEncoder)
-            concept_string = concept_string[1:-1]
-            with open('export.json', 'ab') as out:
-                out.write(concept_string)
-                if end != total_concepts:
-                    out.write(', ')
-        logger.info('Done serializing concepts.')
-    else:
-        logger.info('%s has no concepts to serialize.' % (resource_type.title()))
-
-    with open('export.json', 'ab') as out:
-        out.write('], "mappings": [')
-
-    if resource_type == 'collection':
-        total_mappings = version.get_mappings_count()
-    else:
-        total_mappings = version.get_mappings().filter(is_active=True).count()
-
-    if total_mappings:
-        logger.info('%s has %d mappings. Getting them in batches of %d...' % (resource_type.title(), total_mappings, batch_size))
-        mapping_serializer_class = get_class('mappings.serializers.MappingVersionDetailSerializer')
-        for start in range(0, total_mappings, batch_size):
-            end = min(start + batch_size, total_mappings)
-            logger.info('Serializing mappings %d - %d...' % (start+1, end))
-            if resource_type == 'collection':
-                mappings = version.get_mappings(start, end)
-            else:
-                mappings = version.get_mappings().filter(is_active=True)[start:end]
-            mapping_serializer = mapping_serializer_class(mappings, many=True)
-            mapping_data = mapping_serializer.data
-            mapping_string = json.dumps(mapping_data, cls=encoders.JSONEncoder)
-            mapping_string = mapping_string[1:-1]
-            with open('export.json', 'ab') as out:
-                out.write(mapping_string)
-                if end != total_mappings:
-                    out.write(', ')
-        logger.info('Done serializing mappings.')
-    else:
-        logger.info('%s has no mappings to serialize.' % (resource_type.title()))
-
-    with open('export.json', 'ab') as out:
-        out.write(']}')
-
-    with zipfile.ZipFile('export.zip', 'w', zipfile.ZIP_DEFLATED) as zip:
-        zip.write('export.json')
-
-    logger.info(os.path.abspath('export.zip'))
-
-    logger.info('Done compressing.  Uploading...')
-    k = Key(S3ConnectionFactory.get_export_bucket())
-    k.key = version.export_path
-    k.set_contents_from_filename('export.zip')
-    logger.info('Uploaded to %s.' % k.key)
-    os.chdir(cwd)
-
-
-def write_csv_to_s3(data, is_owner, **kwargs):
-    cwd = cd_temp()
-    csv_file = csv_file_for(data, **kwargs)
-    csv_file.close()
-    zip_file_name = csv_file.name + '.zip'
-    with zipfile.ZipFile(zip_file_name, 'w', zipfile.ZIP_DEFLATED) as zip:
-        zip.write(csv_file.name)
-
-    bucket = S3ConnectionFactory.get_export_bucket()
-    k = Key(bucket)
-    _dir = 'downloads/creator/' if is_owner else 'downloads/reader/'
-    k.key = _dir + zip_file_name
-    k.set_contents_from_filename(zip_file_name)
-
-    os.chdir(cwd)
-    return bucket.get_key(k.key).generate_url(expires_in=60)
-
-
-def get_csv_from_s3(filename, is_owner):
-    _dir = 'downloads/creator' if is_owner else 'downloads/reader'
-    filename = _dir + filename + '.csv.zip'
-    bucket = S3ConnectionFactory.get_export_bucket()
-    key = bucket.get_key(filename)
-    return key.generate_url(expires_in=600) if key else None
-
-
-def cd_temp():
-    cwd = os.getcwd()
-    tmpdir = tempfile.mkdtemp()
-    os.chdir(tmpdir)
-    return cwd
+def iterate_by_id(queryset, batch_size):
+    """
+    Yields the objects of queryset in lists of batch_size ordered by id. Each batch is selected with a range on the
+    id following the previous batch instead of a skip, so that later batches cost no more than the first one.
+    """
+    last_id = None
+    while True:
+        batch_queryset = queryset.order_by('id')
+        if last_id is not None:
+            batch_queryset = batch_queryset.filter(id__gt=last_id)
+        batch = list(batch_queryset[:batch_size])
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        # values_list('id', flat=True) querysets yield the ids themselves, values_list('id', ...) tuples starting with it
+        if isinstance(batch[-1], basestring):
+            last_id = batch[-1]
+        elif isinstance(batch[-1], tuple):
+            last_id = batch[-1][0]
+        else:
+            last_id = batch[-1].id
+
+
+def close_db_connections():
+    """ Closes the database connections of this process, so that processes forked afterwards do not share them """
+    for connection in connections.all():
+        connection.close()
 
 
 def update_search_index(object):
-    if isinstance(haystack.signal_processor, haystack.signals.RealtimeSignalProcessor):
+    from oclapi.search_index_queue import is_index_queue_enabled, queue_index_update
+    if is_index_queue_enabled():
+        queue_index_update(type(object), [object.id])
+    elif isinstance(haystack.signal_processor, haystack.signals.RealtimeSignalProcessor):
         object_type = type(object)
         default_connection = haystack_connections['default']
         unified_index = default_connection.get_unified_index()
@@ -245,7 +158,10 @@ def update_search_index(object):
         backend.update(index, object)
 
 def remove_from_search_index(type, id):
-    if isinstance(haystack.signal_processor, haystack.signals.RealtimeSignalProcessor):
+    from oclapi.search_index_queue import is_index_queue_enabled, queue_index_update
+    if is_index_queue_enabled():
+        queue_index_update(type, [id])
+    elif isinstance(haystack.signal_processor, haystack.signals.RealtimeSignalProcessor):
         default_connection = haystack_connections['default']
         backend = default_connection.get_backend()
 
@@ -267,21 +183,104 @@ def update_all_in_index(model, qs):
     do_update(default_connection, backend, index, qs)
 
 
-def do_update(connection, backend, index, qs, batch_size=1000):
-    total = qs.count()
-    for start in range(0, total, batch_size):
-        end = min(start + batch_size, total)
+def add_to_index_fields(model, id_batches, values):
+    """
+    Adds the values of the field name: value dict to the multi-valued index fields of the objects of model with the ids
+    of id_batches, one atomic update per batch, and returns the number of objects updated
+    """
+    backend = haystack_connections['default'].get_backend()
+    updated = 0
+    for ids in id_batches:
+        backend.add_to_multi_valued_fields(model, ids, values)
+        updated += len(ids)
+    return updated
+
 
-        # Get a clone of the QuerySet so that the cache doesn't bloat up
-        # in memory. Useful when reindexing large amounts of data.
-        small_cache_qs = qs.all()
-        current_qs = small_cache_qs[start:end]
-        backend.update(index, current_qs)
+def do_update(connection, backend, index, qs, batch_size=1000):
+    # Batches follow the last id of the previous one rather than an offset, which costs more with every batch
+    for batch in iterate_by_id(qs, batch_size):
+        backend.update(index, batch)
 
         # Clear out the DB connections queries because it bloats up RAM.
         connection.queries = []
 
 
+def update_ids_in_index(model, ids, workers=0, batch_size=1000):
+    """
+    Pushes the objects of model with the given ids to the search index, batch_size objects per update. With more
+    than one worker the sorted ids are split into contiguous ranges that are indexed by separate processes, forked
+    with billiard as the daemon processes of Celery, which run bulk imports, may not fork with multiprocessing.
+    """
+    ids = sorted(set(ids))
+    if not ids:
+        return
+    if workers > 1 and len(ids) > batch_size:
+        partition_size = int(math.ceil(len(ids) / float(workers)))
+        partitions = [(model, ids[start:start + partition_size], batch_size)
+                      for start in range(0, len(ids), partition_size)]
+        close_db_connections()
+        pool = billiard.Pool(len(partitions))
+        try:
+            pool.map(update_ids_partition_in_index, partitions)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        update_ids_partition_in_index((model, ids, batch_size))
+
+
+def update_ids_partition_in_index(partition):
+    """ Indexes one (model, ids, batch_size) partition, defined at module level so that it can run in a pool """
+    model, ids, batch_size = partition
+    default_connection = haystack_connections['default']
+    unified_index = default_connection.get_unified_index()
+    index = unified_index.get_index(model)
+    backend = default_connection.get_backend()
+    for start in range(0, len(ids), batch_size):
+        backend.update(index, model.objects.filter(id__in=ids[start:start + batch_size]))
+
+
+class SavedIdsRecorder(object):
+    """
+    Collects the ids of the instances of model saved between start and stop, plus the ids added explicitly for
+    writes that bypass the post_save signal. Ids recorded since the last pop_recent_ids are kept apart as well.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.ids = set()
+        self.recent_ids = []
+        self.dispatch_uid = 'saved_ids_recorder_%s' % id(self)
+
+    def start(self):
+        post_save.connect(self.record, sender=self.model, weak=False, dispatch_uid=self.dispatch_uid)
+
+    def stop(self):
+        post_save.disconnect(sender=self.model, dispatch_uid=self.dispatch_uid)
+
+    def record(self, sender, instance=None, **kwargs):
+        if instance is not None and instance.id:
+            self.add([instance.id])
+
+    def add(self, ids):
+        for _id in ids:
+            if _id not in self.ids:
+                self.ids.add(_id)
+                self.recent_ids.append(_id)
+
+    def pop_recent_ids(self):
+        recent_ids = self.recent_ids
+        self.recent_ids = []
+        return recent_ids
+
+
+def compute_content_hash(content):
+    """
+    Returns the SHA-1 hex digest of the canonical JSON representation of content (sorted keys, no whitespace).
+    """
+    return hashlib.sha1(json.dumps(content, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
 def compact(_list):
     return filter(None, _list)
 
@@ -290,3 +289,31 @@ def extract_values(_dict, keys):
     values = itemgetter(*keys)(_dict)
     values = values if type(values).__name__ == 'tuple'  or type(values).__name__ == 'list' else [values]
     return list(values)
+
+
+class LRUCache(object):
+    """ Mapping that holds at most max_size entries and evicts the least recently used entry first """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, key):
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        return self[key] if key in self.entries else default
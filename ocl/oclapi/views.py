@@ -1,3 +1,5 @@
+import json
+
 import dateutil.parser
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
@@ -14,8 +16,9 @@ from rest_framework.response import Response
 from concepts.serializers import ConceptVersionDetailSerializer
 from mappings.serializers import MappingVersionDetailSerializer
 from oclapi.mixins import PathWalkerMixin
-from oclapi.models import ResourceVersionModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, ACCESS_TYPE_NONE
+from oclapi.models import ResourceVersionModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, ACCESS_TYPE_NONE, HEAD
 from oclapi.permissions import HasPrivateAccess, CanEditConceptDictionary, CanViewConceptDictionary, HasOwnership
+from oclapi.exports import get_export_manifest, EXPORT_FORMATS, EXPORT_FORMAT_JSON, ExportStorageFactory
 from users.models import UserProfile
 
 from sources.models import SourceVersion
@@ -26,6 +29,7 @@ INCLUDE_MAPPINGS_PARAM = 'includeMappings'
 LIMIT_PARAM = 'limit'
 INCLUDE_RETIRED_PARAM = 'includeRetired'
 OFFSET_PARAM = 'offset'
+EXPORT_FORMAT_PARAM = 'format'
 DEFAULT_OFFSET = 0
 
 
@@ -45,6 +49,28 @@ def parse_updated_since_param(request):
     return None
 
 
+def parse_export_format_param(request):
+    export_format = request.QUERY_PARAMS.get(EXPORT_FORMAT_PARAM)
+    return export_format if export_format in EXPORT_FORMATS else EXPORT_FORMAT_JSON
+
+
+def get_export_download_response(export_path, expires_in=60):
+    """
+    Redirects to a URL the export file at export_path can be downloaded from, or has the web server send it if the
+    export storage supports that.
+    """
+    storage = ExportStorageFactory.get_export_storage()
+    sendfile_path = storage.get_sendfile_path(export_path)
+    if sendfile_path:
+        response = HttpResponse(content_type='application/octet-stream')
+        response[settings.EXPORT_SENDFILE_HEADER] = sendfile_path
+        response['Content-Disposition'] = 'attachment; filename="%s"' % export_path.split('/')[-1]
+        return response
+    response = HttpResponse(status=303)
+    response['Location'] = storage.get_url(export_path, expires_in)
+    return response
+
+
 def parse_boolean_query_param(request, param, default=None):
     val = request.QUERY_PARAMS.get(param, default)
     if val is None:
@@ -365,15 +391,17 @@ class VersionedResourceChildMixin(ConceptDictionaryMixin):
                 self.parent_resource_version = ResourceVersionModel.get_latest_version_of(self.parent_resource)
 
     def get_queryset(self):
+        queryset = super(ConceptDictionaryMixin, self).get_queryset()
+        return queryset.filter(**self.get_child_filters())
+
+    def get_child_filters(self):
+        """ Returns the filter kwargs selecting the children of the parent resource version """
         if isinstance(self.parent_resource_version, SourceVersion):
-            queryset = super(ConceptDictionaryMixin, self).get_queryset()
-            queryset = queryset.filter(source_version_ids__contains=self.parent_resource_version.id)
-            return queryset
-        else:
-            all_children = getattr(self.parent_resource_version, self.child_list_attribute) or []
-            queryset = super(ConceptDictionaryMixin, self).get_queryset()
-            queryset = queryset.filter(id__in=all_children)
-            return queryset
+            return {'source_version_ids__contains': self.parent_resource_version.id}
+        children = getattr(self.parent_resource_version, self.child_list_attribute)
+        if callable(children):
+            children = children()
+        return {'id__in': children or []}
 
 
 class ResourceVersionMixin(BaseAPIView, PathWalkerMixin):
@@ -412,3 +440,38 @@ class ResourceAttributeChildMixin(BaseAPIView, PathWalkerMixin):
         super(ResourceAttributeChildMixin, self).initialize(request, path_info_segment, **kwargs)
         self.resource_version_path_info = self.get_parent_in_path(path_info_segment)
         self.resource_version = self.get_object_for_path(self.resource_version_path_info, request)
+
+
+class ExportManifestMixin(object):
+    """
+    Serves the manifest of the chunked export of a source or collection version at .../:version/export/manifest/,
+    listing the chunks with the URLs to download them from.
+    """
+
+    def initialize(self, request, path_info_segment, **kwargs):
+        # The resource version is two levels above .../export/manifest/
+        super(ExportManifestMixin, self).initialize(request, self.get_parent_in_path(path_info_segment), **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        version = self.get_object()
+        if version.mnemonic == HEAD:
+            return HttpResponse(status=405)
+
+        if not version.has_export_manifest():
+            return HttpResponse(status=204)
+
+        response = HttpResponse(json.dumps(get_export_manifest(version.export_manifest_path)),
+                                content_type='application/json')
+        # The chunk URLs expire, so the manifest must not be cached by a client
+        response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response['Pragma'] = 'no-cache'
+        response['Expires'] = '0'
+        response['Last-Updated'] = version.last_child_update.isoformat()
+        response['Last-Updated-Timezone'] = settings.TIME_ZONE
+        return response
+
+    def post(self, request, *args, **kwargs):
+        return HttpResponse(status=405)
+
+    def delete(self, request, *args, **kwargs):
+        return HttpResponse(status=405)
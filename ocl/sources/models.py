@@ -14,18 +14,35 @@ from djangotoolbox.fields import DictField
 
 from oclapi.models import ConceptContainerModel, ConceptContainerVersionModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW
 from oclapi.rawqueries import RawQueries
-from oclapi.utils import S3ConnectionFactory, update_search_index, reverse_resource
+from oclapi.utils import update_search_index, reverse_resource, iterate_by_id
+from oclapi.exports import ExportStorageFactory, EXPORT_FORMAT_JSON, EXPORT_FORMAT_NDJSON
 
 SOURCE_TYPE = 'Source'
 
 HEAD = 'HEAD'
 
+# Number of ids per query when comparing the members of two source versions
+DELTA_QUERY_SIZE = 10000
+
+
 class Source(ConceptContainerModel):
     source_type = models.TextField(blank=True)
 
     class MongoMeta:
         indexes = [[('uri', 1)]]
 
+    @classmethod
+    def add_to_cache(cls, sources, source_ids):
+        """
+        Loads the sources with source_ids that are missing from the sources dict into it with a single query, along
+        with their owners
+        """
+        missing_ids = [source_id for source_id in set(source_ids) if source_id and source_id not in sources]
+        if missing_ids:
+            missing_sources = list(cls.objects.filter(id__in=missing_ids))
+            cls.resolve_owners(missing_sources)
+            sources.update((source.id, source) for source in missing_sources)
+
     def delete(self, **kwargs):
         resource_used_message = '''Source %s cannot be deleted because others have created mapping or references that point to it.
                 To delete this source, you must first delete all linked mappings and references.''' % self.uri
@@ -193,6 +210,12 @@ class SourceVersion(ConceptContainerVersionModel):
 
         update_search_index(concept_version)
 
+    def add_new_concept_versions(self, count):
+        """ Accounts for new concept versions that were inserted already carrying this version in source_version_ids """
+        updated_at = datetime.now()
+        SourceVersion.objects.filter(id=self.id).update(active_concepts=F('active_concepts')+count, last_concept_update=updated_at,
+                                                        last_child_update=updated_at, updated_at=updated_at)
+
     def has_concept_version(self, concept_version):
         return self.id in concept_version.source_version_ids
 
@@ -239,6 +262,27 @@ class SourceVersion(ConceptContainerVersionModel):
         from mappings.models import MappingVersion
         return MappingVersion.objects.filter(source_version_ids__contains=self.id).values_list('id', flat=True)
 
+    def get_delta_from(self, from_version):
+        """
+        Compares the concept and mapping versions of this source version with the ones of from_version. Returns, per
+        child type, the ids of the versions that were added, that replaced a version of the same concept or mapping,
+        and that were removed.
+        """
+        from concepts.models import ConceptVersion
+        from mappings.models import MappingVersion
+        return {
+            'concepts': get_membership_delta(ConceptVersion, from_version.get_concept_ids(), self.get_concept_ids()),
+            'mappings': get_membership_delta(MappingVersion, from_version.get_mapping_ids(), self.get_mapping_ids()),
+        }
+
+    def get_export_concept_id_batches(self, batch_size):
+        """ Yields the ids of the active concept versions of this source version in order, batch_size at a time """
+        return iterate_by_id(self.get_concepts().filter(is_active=True).values_list('id', flat=True), batch_size)
+
+    def get_export_mapping_id_batches(self, batch_size):
+        """ Yields the ids of the active mapping versions of this source version in order, batch_size at a time """
+        return iterate_by_id(self.get_mappings().filter(is_active=True).values_list('id', flat=True), batch_size)
+
     def seed_concepts(self):
         seed_concepts_from = self.head_sibling()
         if seed_concepts_from:
@@ -278,12 +322,26 @@ class SourceVersion(ConceptContainerVersionModel):
             self.external_id = obj.external_id
 
 
-    def get_export_key(self):
-        bucket = S3ConnectionFactory.get_export_bucket()
-        return bucket.get_key(self.export_path)
+    def has_export(self, export_format=EXPORT_FORMAT_JSON):
+        return ExportStorageFactory.get_export_storage().exists(self.get_export_path(export_format))
+
+    def get_export_path(self, export_format=EXPORT_FORMAT_JSON):
+        if export_format == EXPORT_FORMAT_NDJSON:
+            return '%s.ndjson.gz' % self.export_path[:-len('.zip')]
+        return self.export_path
 
-    def has_export(self):
-        return bool(self.get_export_key())
+    def has_export_manifest(self):
+        return ExportStorageFactory.get_export_storage().exists(self.export_manifest_path)
+
+    @property
+    def export_manifest_path(self):
+        return '%s.manifest.json' % self.export_path[:-len('.zip')]
+
+    def has_delta_export(self, from_version):
+        return ExportStorageFactory.get_export_storage().exists(self.get_delta_export_path(from_version))
+
+    def get_delta_export_path(self, from_version):
+        return '%s.delta.%s.zip' % (self.export_path[:-len('.zip')], from_version.mnemonic)
 
     @property
     def export_path(self):
@@ -350,6 +408,31 @@ class SourceVersion(ConceptContainerVersionModel):
             extras=source.extras,
         )
 
+def get_membership_delta(version_model, from_ids, to_ids):
+    """
+    Classifies the concept or mapping versions that are members of only one of two source versions, given the ids
+    of the members of each, by the concept or mapping they version.
+    """
+    from_ids = set(from_ids)
+    to_ids = set(to_ids)
+    removed_ids = from_ids - to_ids
+    added_ids = to_ids - from_ids
+    changed_ids = list(removed_ids | added_ids)
+
+    versioned_object_ids = {}
+    for start in range(0, len(changed_ids), DELTA_QUERY_SIZE):
+        versioned_object_ids.update(version_model.objects.filter(
+            id__in=changed_ids[start:start + DELTA_QUERY_SIZE]).values_list('id', 'versioned_object_id'))
+    removed_objects = set(versioned_object_ids.get(version_id) for version_id in removed_ids)
+    added_objects = set(versioned_object_ids.get(version_id) for version_id in added_ids)
+
+    return {
+        'added': sorted(version_id for version_id in added_ids if versioned_object_ids.get(version_id) not in removed_objects),
+        'replaced': sorted(version_id for version_id in added_ids if versioned_object_ids.get(version_id) in removed_objects),
+        'removed': sorted(version_id for version_id in removed_ids if versioned_object_ids.get(version_id) not in added_objects),
+    }
+
+
 @receiver(post_save)
 def propagate_owner_status(sender, instance=None, created=False, **kwargs):
     if created:
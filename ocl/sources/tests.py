@@ -12,13 +12,13 @@ from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from mock import mock
 
-from concepts.models import Concept, LocalizedText
+from concepts.models import Concept, ConceptVersion, LocalizedText
 from concepts.validation_messages import OPENMRS_SHORT_NAME_CANNOT_BE_PREFERRED
 from concepts.validators import message_with_name_details
 from oclapi.models import ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, LOOKUP_SOURCES
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
 from orgs.models import Organization
-from sources.models import Source, SourceVersion
+from sources.models import Source, SourceVersion, get_membership_delta
 from test_helper.base import OclApiBaseTestCase, create_concept, create_source, create_user, create_localized_text
 from users.models import UserProfile
 
@@ -774,6 +774,28 @@ class SourceVersionTest(SourceBaseTest):
 
         self.assertItemsEqual(source_version2.get_concept_ids(), self.source1.get_head().get_concept_ids())
 
+    def test_get_membership_delta(self):
+        head = SourceVersion(name='head', mnemonic='HEAD', versioned_object=self.source1, released=True,
+                             created_by=self.user1, updated_by=self.user1)
+        head.full_clean()
+        head.save()
+
+        (concept1, _) = create_concept(mnemonic='concept1', user=self.user1, source=self.source1)
+        (concept2, _) = create_concept(mnemonic='concept2', user=self.user1, source=self.source1)
+        (concept3, _) = create_concept(mnemonic='concept3', user=self.user1, source=self.source1)
+        concept1_version = ConceptVersion.objects.get(versioned_object_id=concept1.id)
+        concept2_version = ConceptVersion.objects.get(versioned_object_id=concept2.id)
+        concept3_version = ConceptVersion.objects.get(versioned_object_id=concept3.id)
+        ConceptVersion.persist_clone(concept1_version.clone(), self.user1)
+        new_concept1_version = ConceptVersion.objects.filter(versioned_object_id=concept1.id).order_by('-created_at')[0]
+
+        delta = get_membership_delta(ConceptVersion, [concept1_version.id, concept2_version.id],
+                                     [new_concept1_version.id, concept3_version.id])
+
+        self.assertEquals(delta['added'], [concept3_version.id])
+        self.assertEquals(delta['replaced'], [new_concept1_version.id])
+        self.assertEquals(delta['removed'], [concept2_version.id])
+
     def test_head_sibling(self):
         source_version1 = SourceVersion(
             name='head',
@@ -2,7 +2,8 @@ from django.conf.urls import patterns, url, include
 from sources.feeds import SourceFeed
 from sources.views import SourceListView, SourceRetrieveUpdateDestroyView, SourceVersionRetrieveUpdateView, \
     SourceVersionChildListView, SourceVersionListView, SourceVersionRetrieveUpdateDestroyView, SourceExtrasView, \
-    SourceExtraRetrieveUpdateDestroyView, SourceVersionExportView, SourceVersionProcessingView
+    SourceExtraRetrieveUpdateDestroyView, SourceVersionExportView, SourceVersionProcessingView, \
+    SourceVersionDeltaExportView, SourceVersionExportManifestView
 from oclapi.models import NAMESPACE_PATTERN, CONCEPT_ID_PATTERN
 
 __author__ = 'misternando'
@@ -20,6 +21,8 @@ urlpatterns = patterns('',
     url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/$', SourceVersionRetrieveUpdateDestroyView.as_view(), name='sourceversion-detail'),
     url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/children/$', SourceVersionChildListView.as_view(), {'list_children': True}, name='sourceversion-child-list'),
     url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/export/$', SourceVersionExportView.as_view(), name='sourceversion-export'),
+    url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/export/delta/$', SourceVersionDeltaExportView.as_view(), name='sourceversion-export-delta'),
+    url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/export/manifest/$', SourceVersionExportManifestView.as_view(), name='sourceversion-export-manifest'),
     url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/extras/$', SourceExtrasView.as_view(), name='sourceversion-extras'),
     url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/extras/(?P<extra>' + CONCEPT_ID_PATTERN + ')/$', SourceExtraRetrieveUpdateDestroyView.as_view(), name='sourceversion-extra'),
     url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/mappings/', include('mappings.urls')),
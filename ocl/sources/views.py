@@ -19,12 +19,13 @@ from mappings.serializers import MappingVersionDetailSerializer
 from oclapi.mixins import ListWithHeadersMixin
 from oclapi.permissions import HasAccessToVersionedObject, CanEditConceptDictionaryVersion, CanViewConceptDictionary, \
     CanViewConceptDictionaryVersion, CanEditConceptDictionary, HasOwnership
-from oclapi.views import ResourceVersionMixin, ResourceAttributeChildMixin, ConceptDictionaryUpdateMixin, ConceptDictionaryCreateMixin, ConceptDictionaryExtrasView, ConceptDictionaryExtraRetrieveUpdateDestroyView, parse_updated_since_param, parse_boolean_query_param
+from oclapi.views import ResourceVersionMixin, ResourceAttributeChildMixin, ConceptDictionaryUpdateMixin, ConceptDictionaryCreateMixin, ConceptDictionaryExtrasView, ConceptDictionaryExtraRetrieveUpdateDestroyView, parse_updated_since_param, parse_boolean_query_param, ExportManifestMixin, parse_export_format_param, get_export_download_response
 from sources.filters import SourceSearchFilter
 from sources.models import Source, SourceVersion
 from oclapi.rawqueries import RawQueries
+from oclapi.exports import EXPORT_FORMAT_JSON, ExportStorageFactory
 from sources.serializers import SourceCreateSerializer, SourceListSerializer, SourceDetailSerializer, SourceVersionDetailSerializer, SourceVersionListSerializer, SourceVersionCreateSerializer, SourceVersionUpdateSerializer
-from tasks import export_source
+from tasks import export_source, export_source_delta
 from celery_once import AlreadyQueued
 from users.models import UserProfile
 from orgs.models import Organization
@@ -109,6 +110,7 @@ class SourceListView(SourceBaseView,
 
     serializer_class = SourceCreateSerializer
     filter_backends = [SourceSearchFilter]
+    csv_format = 'sources'
     solr_fields = {
         'sourceType': {'sortable': False, 'filterable': True, 'facet': True},
         'name': {'sortable': True, 'filterable': False},
@@ -362,24 +364,19 @@ class SourceVersionExportView(ResourceAttributeChildMixin):
 
     def get(self, request, *args, **kwargs):
         version = self.get_object()
-        logger.debug('Export requested for source version %s - Requesting AWS-S3 key' % version)
+        logger.debug('Export requested for source version %s - Looking up export' % version)
         if version.mnemonic == 'HEAD':
             return HttpResponse(status=405)
 
-        key = version.get_export_key()
-        url, status = None, 204
+        export_format = parse_export_format_param(request)
 
-        if key:
-            logger.debug('   Key retreived for source version %s - Generating URL' % version)
-            url, status = key.generate_url(60), 303
-            logger.debug('   URL retreived for source version %s - Responding to client' % version)
+        if version.has_export(export_format):
+            logger.debug('   Export exists for source version %s - Responding to client' % version)
+            response = get_export_download_response(version.get_export_path(export_format))
         else:
-            logger.debug('   Key does not exist for source version %s' % version)
+            logger.debug('   Export does not exist for source version %s' % version)
             return HttpResponse(status=204)
 
-        response = HttpResponse(status=status)
-        response['Location'] = url
-
         # Set headers to ensure sure response is not cached by a client
         response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
         response['Pragma'] = 'no-cache'
@@ -414,11 +411,14 @@ class SourceVersionExportView(ResourceAttributeChildMixin):
         logger.debug('Source Export requested for version %s (post)' % version)
         status = 303
 
-        if not version.has_export():
-            status = self.handle_export_source_version()
+        export_format = parse_export_format_param(request)
+        if not version.has_export(export_format):
+            status = self.handle_export_source_version(export_format)
         else:
             response = HttpResponse(status=status)
             response['URL']=self.resource_version_path_info+'export/'
+            if export_format != EXPORT_FORMAT_JSON:
+                response['URL'] += '?format=' + export_format
             return response
         return HttpResponse(status=status)
 
@@ -433,19 +433,92 @@ class SourceVersionExportView(ResourceAttributeChildMixin):
 
         if not permitted:
             return HttpResponseForbidden()
-        if version.has_export():
-            key = version.get_export_key()
-            if key:
-                key.delete()
-                return HttpResponse(status=200)
+        export_format = parse_export_format_param(request)
+        if version.has_export(export_format):
+            storage = ExportStorageFactory.get_export_storage()
+            storage.delete(version.get_export_path(export_format))
+            # The chunks may be shared with other versions, only the manifest goes
+            if export_format == EXPORT_FORMAT_JSON and version.has_export_manifest():
+                storage.delete(version.export_manifest_path)
+            return HttpResponse(status=200)
 
         return HttpResponse(status=204)
 
-    def handle_export_source_version(self):
+    def handle_export_source_version(self, export_format=EXPORT_FORMAT_JSON):
         version = self.get_object()
         try:
-            export_source.delay(version.id)
+            export_source.delay(version.id, export_format)
             return 202
         except AlreadyQueued:
             return 409
 
+
+class SourceVersionExportManifestView(ExportManifestMixin, SourceVersionExportView):
+    pass
+
+
+class SourceVersionDeltaExportView(SourceVersionExportView):
+
+    def initialize(self, request, path_info_segment, **kwargs):
+        # The resource version is two levels above .../export/delta/
+        super(SourceVersionDeltaExportView, self).initialize(
+            request, self.get_parent_in_path(path_info_segment), **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        version = self.get_object()
+        if version.mnemonic == 'HEAD':
+            return HttpResponse(status=405)
+        from_version = self.get_from_version(request)
+        if isinstance(from_version, HttpResponse):
+            return from_version
+
+        logger.debug('Delta export from %s requested for source version %s' % (from_version, version))
+        if not version.has_delta_export(from_version):
+            logger.debug('   Delta export does not exist for source version %s' % version)
+            return HttpResponse(status=204)
+
+        response = get_export_download_response(version.get_delta_export_path(from_version))
+
+        # Set headers to ensure sure response is not cached by a client
+        response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response['Pragma'] = 'no-cache'
+        response['Expires'] = '0'
+        response['Last-Updated'] = version.last_child_update.isoformat()
+        response['Last-Updated-Timezone'] = settings.TIME_ZONE
+        return response
+
+    def post(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        version = self.get_object()
+        if version.mnemonic == 'HEAD':
+            return HttpResponse(status=405)
+        from_version = self.get_from_version(request)
+        if isinstance(from_version, HttpResponse):
+            return from_version
+
+        logger.debug('Delta export from %s requested for source version %s (post)' % (from_version, version))
+        if version.has_delta_export(from_version):
+            response = HttpResponse(status=303)
+            response['URL'] = self.resource_version_path_info + 'export/delta/?from=' + from_version.mnemonic
+            return response
+        try:
+            export_source_delta.delay(version.id, from_version.id)
+            return HttpResponse(status=202)
+        except AlreadyQueued:
+            return HttpResponse(status=409)
+
+    def delete(self, request, *args, **kwargs):
+        return HttpResponse(status=405)
+
+    def get_from_version(self, request):
+        """ Returns the version of the same source named by the from parameter, or the error response """
+        from_mnemonic = request.QUERY_PARAMS.get('from')
+        if not from_mnemonic:
+            return HttpResponse(status=400)
+        from_versions = SourceVersion.objects.filter(
+            versioned_object_id=self.get_object().versioned_object_id, mnemonic=from_mnemonic)
+        if not from_versions:
+            return HttpResponse(status=404)
+        return from_versions[0]
+
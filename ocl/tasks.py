@@ -14,9 +14,13 @@ from configurations import importer
 importer.install()
 
 from celery import Celery
+from celery.schedules import crontab
 from celery.utils.log import get_task_logger
 from celery_once import QueueOnce
-from oclapi.utils import update_all_in_index, write_export_file
+from oclapi.models import HEAD
+from oclapi.utils import update_all_in_index, add_to_index_fields, iterate_by_id, ATOMIC_UPDATE_BATCH_SIZE
+from oclapi.exports import write_export_file, write_delta_export_file, write_csv_export_file, get_csv_formatter, \
+    get_csv_queryset, EXPORT_FORMAT_JSON
 
 import json
 from rest_framework.test import APIRequestFactory
@@ -27,9 +31,13 @@ celery = Celery('tasks', backend='redis://', broker='django://')
 celery.config_from_object('django.conf:settings')
 celery.conf.ONCE_REDIS_URL = celery.conf.CELERY_RESULT_BACKEND
 celery.conf.CELERY_ROUTES = {'tasks.bulk_import': {'queue': 'bulk_import'},
-                           'tasks.bulk_priority_import': {'queue': 'bulk_priority_import'}}
+                           'tasks.bulk_priority_import': {'queue': 'bulk_priority_import'},
+                           'tasks.flush_index_queue': {'queue': 'indexing'}}
 celery.conf.CELERY_TASK_RESULT_EXPIRES = 259200 #72 hours
 celery.conf.CELERY_TRACK_STARTED = True
+celery.conf.CELERYBEAT_SCHEDULE = {
+    'reconcile-search-index': {'task': 'tasks.reconcile_search_index', 'schedule': crontab(hour=2, minute=0)},
+}
 
 @celery.task(base=QueueOnce, bind=True)
 def data_integrity_checks(self):
@@ -42,17 +50,17 @@ def find_broken_references(self):
     return broken_references
 
 @celery.task(base=QueueOnce, bind=True)
-def bulk_import(self, to_import, username, update_if_exists):
+def bulk_import(self, upload_id, username, update_if_exists):
     from manage.imports.bulk_import import BulkImport
-    return BulkImport().run_import(to_import, username, update_if_exists)
+    return BulkImport(task=self).run_import(upload_id, username, update_if_exists)
 
 @celery.task(base=QueueOnce, bind=True)
-def bulk_priority_import(self, to_import, username, update_if_exists):
+def bulk_priority_import(self, upload_id, username, update_if_exists):
     from manage.imports.bulk_import import BulkImport
-    return BulkImport().run_import(to_import, username, update_if_exists)
+    return BulkImport(task=self).run_import(upload_id, username, update_if_exists)
 
 @celery.task(base=QueueOnce, bind=True)
-def export_source(self, version_id):
+def export_source(self, version_id, export_format=EXPORT_FORMAT_JSON):
     from sources.models import SourceVersion
 
     logger.info('Finding source version...')
@@ -61,25 +69,58 @@ def export_source(self, version_id):
     version.add_processing(self.request.id)
     try:
         logger.info('Found source version %s.  Beginning export...' % version.mnemonic)
-        write_export_file(version, 'source', 'sources.serializers.SourceVersionExportSerializer', logger)
+        write_export_file(version, 'source', 'sources.serializers.SourceVersionExportSerializer', logger,
+                          export_format=export_format)
         logger.info('Export complete!')
+        # HEAD changes after the version is created, so it is no base for a delta
+        previous_version = version.previous_version
+        if export_format == EXPORT_FORMAT_JSON and previous_version and previous_version.mnemonic != HEAD:
+            write_delta_export_file(version, previous_version, logger)
     finally:
         version.remove_processing(self.request.id)
 
 
 @celery.task(base=QueueOnce, bind=True)
-def export_collection(self, version_id):
+def export_source_delta(self, version_id, from_version_id):
+    from sources.models import SourceVersion
+
+    version = SourceVersion.objects.get(id=version_id)
+    from_version = SourceVersion.objects.get(id=from_version_id)
+    version.add_processing(self.request.id)
+    try:
+        write_delta_export_file(version, from_version, logger)
+    finally:
+        version.remove_processing(self.request.id)
+
+
+@celery.task(base=QueueOnce, bind=True)
+def export_collection(self, version_id, export_format=EXPORT_FORMAT_JSON):
     from collection.models import CollectionVersion
     logger.info('Finding collection version...')
     version = CollectionVersion.objects.get(id=version_id)
     version.add_processing(self.request.id)
     try:
         logger.info('Found collection version %s.  Beginning export...' % version.mnemonic)
-        write_export_file(version, 'collection', 'collection.serializers.CollectionVersionExportSerializer', logger)
+        write_export_file(version, 'collection', 'collection.serializers.CollectionVersionExportSerializer', logger,
+                          export_format=export_format)
         logger.info('Export complete!')
     finally:
         version.remove_processing(self.request.id)
 
+# Sent as JSON, so that only plain data describing the rows reaches the broker
+@celery.task(bind=True, serializer='json')
+def export_csv(self, model_label, filters, excludes, path, csv_format=None):
+    """
+    Writes the CSV of the objects of the app_label.model_name model matching the filters and not the excludes kwargs,
+    formatted by the formatter of csv_format if given, and returns its path
+    """
+    from django.db.models import get_model
+    queryset = get_csv_queryset(get_model(*model_label.split('.')), filters, excludes)
+    logger.info('Writing CSV of %s to %s...' % (model_label, path))
+    size = write_csv_export_file(queryset, path, get_csv_formatter(csv_format))
+    logger.info('Uploaded %d bytes to %s.' % (size, path))
+    return path
+
 @celery.task(bind = True)
 def update_children_for_resource_version(self, version_id, _type):
     from concepts.models import ConceptVersion
@@ -88,15 +129,21 @@ def update_children_for_resource_version(self, version_id, _type):
     _resource = resource(version_id, _type)
     _resource.add_processing(self.request.id)
     try:
-        concept_versions = _resource.get_concepts()
-        mapping_versions = _resource.get_mappings()
-
-        logger.info('Indexing %s concepts...' % concept_versions.count())
-
-        update_all_in_index(ConceptVersion, concept_versions)
-        logger.info('Indexing %s mappings...' % mapping_versions.count())
-
-        update_all_in_index(MappingVersion, mapping_versions)
+        # The children are indexed already, they only lack the id of the new version. A new collection version is
+        # seeded from its HEAD, so its children hold the id of the collection itself already.
+        if _type == 'source':
+            values = {'source_version': _resource.id}
+            concept_id_batches = iterate_by_id(_resource.get_concept_ids(), ATOMIC_UPDATE_BATCH_SIZE)
+            mapping_id_batches = iterate_by_id(_resource.get_mapping_ids(), ATOMIC_UPDATE_BATCH_SIZE)
+        else:
+            values = {'collection_version': _resource.id}
+            concept_id_batches = _resource.get_export_concept_id_batches(ATOMIC_UPDATE_BATCH_SIZE)
+            mapping_id_batches = _resource.get_export_mapping_id_batches(ATOMIC_UPDATE_BATCH_SIZE)
+
+        logger.info('Adding %s to the index of concepts...' % values)
+        logger.info('Updated %d concepts.' % add_to_index_fields(ConceptVersion, concept_id_batches, values))
+        logger.info('Adding %s to the index of mappings...' % values)
+        logger.info('Updated %d mappings.' % add_to_index_fields(MappingVersion, mapping_id_batches, values))
 
     finally:
         _resource.remove_processing(self.request.id)
@@ -106,6 +153,29 @@ def update_search_index_task(self, model, query):
     logger.info('Updating search index for %s...' % model.__name__)
     update_all_in_index(model, query)
 
+@celery.task(base=QueueOnce, bind=True)
+def reconcile_search_index(self):
+    from oclapi.management.reconcile import Reconciler
+    from oclapi.utils import haystack_connections
+    for model in haystack_connections['default'].get_unified_index().get_indexed_models():
+        Reconciler(model).run()
+
+# Seconds before a flush of the index queue that failed is retried
+INDEX_QUEUE_FLUSH_RETRY_COUNTDOWN = 30
+
+@celery.task(bind=True)
+def flush_index_queue(self):
+    from oclapi.search_index_queue import flush_index_queue as flush, get_index_queue_stats
+    stats = get_index_queue_stats()
+    logger.info('Flushing %d queued index updates, the oldest queued %.1f seconds ago...' % (
+        stats['size'], stats['lag']))
+    try:
+        flushed = flush()
+    except Exception as exc:
+        # The batch that failed is back in the queue, the retry sends it again
+        raise self.retry(exc=exc, countdown=INDEX_QUEUE_FLUSH_RETRY_COUNTDOWN)
+    logger.info('Indexed %d objects.' % flushed)
+
 def resource(version_id, type):
     from sources.models import SourceVersion
     from collection.models import CollectionVersion